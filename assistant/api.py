@@ -1,29 +1,321 @@
+import atexit
+import concurrent.futures
+import functools
 import json
+import os
+import threading
+
 import pika
 
+from . import localbroker
+
 PIKA_QUEUE = "assistant"
+PIKA_DEAD_LETTER_QUEUE = "assistant.dead"
+PIKA_EVENTS_EXCHANGE = "assistant.events"  # topic exchange, key is the event
+PIKA_EVENTS_QUEUE = "assistant.events"
+PIKA_JOBS_QUEUE = "assistant.jobs"  # run commands, "assistant.jobs.<label>"
+PIKA_RESULTS_QUEUE = "assistant.results"  # "<name>.<id>" per Dispatcher
+PIKA_WORKERS_EXCHANGE = "assistant.workers"  # topic exchange, worker hellos
+# Environment variable with the json of the event that triggered a run.
+EVENT_ENV = "ASSISTANT_EVENT"
 PIKA_HOST = "localhost"
+PIKA_PORT = 5672
+# Unix socket of a localbroker.LocalBroker, used instead of RabbitMQ if set.
+LOCAL_SOCKET_ENV = "ASSISTANT_LOCAL_SOCKET"
+LOCAL_SOCKET = os.environ.get(LOCAL_SOCKET_ENV)
+_TRANSPORT_ERRORS = (pika.exceptions.AMQPError, localbroker.BrokerError)
+
+
+def _connect(host=None, port=None):
+    """Blocking connection to the local broker, or to RabbitMQ."""
+    if LOCAL_SOCKET and not host:
+        return localbroker.BlockingConnection(LOCAL_SOCKET)
+    return pika.BlockingConnection(pika.ConnectionParameters(
+        host=host or PIKA_HOST, port=port or PIKA_PORT))
+
+def use_local(path):
+    """Use the local broker at path, here and in jobs started from here."""
+    global LOCAL_SOCKET
+    LOCAL_SOCKET = os.environ[LOCAL_SOCKET_ENV] = os.path.abspath(path)
+
+def serve_local(path):
+    """Start a local broker in this process and use it."""
+    b = localbroker.LocalBroker(os.path.abspath(path)).start()
+    use_local(path)
+    return b
+
+
+class PublishException(Exception):
+    """Publishing failed again after a reconnect. The first sent messages
+    were published (and committed, with confirm=True) before that."""
+    def __init__(self, sent, error):
+        super().__init__(f'Published {sent} messages, then: {error!r}')
+        self.sent = sent
+
+
+class Publisher:
+    """Keeps one connection and channel per process and reuses them for
+    every message. Reconnects once if the broker dropped the connection.
+    With confirm=True every publish_many() is a transaction: it waits once,
+    on commit, until the broker took all of its messages. With an
+    exchange messages go to that topic exchange instead of the queue.
+    Without a queue nothing is declared, publish() then needs a routing
+    key (e.g. a reply queue)."""
+    def __init__(self, host=None, port=None, queue=PIKA_QUEUE, confirm=False,
+                 exchange=None):
+        self.host = host
+        self.port = port
+        self.queue = queue
+        self.confirm = confirm
+        self.exchange = exchange
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._channel = None
+
+    def _connect(self):
+        self._conn = _connect(self.host, self.port)
+        self._channel = self._conn.channel()
+        if self.exchange:
+            self._channel.exchange_declare(exchange=self.exchange,
+                                           exchange_type='topic')
+        elif self.queue:
+            self._channel.queue_declare(queue=self.queue)
+        if self.confirm:
+            # Unlike confirm_delivery, one round-trip for many messages.
+            self._channel.tx_select()
+        self._pid = os.getpid()
+
+    def _is_connected(self):
+        if self._pid != os.getpid():
+            # Forked child: the inherited socket belongs to the parent.
+            self._conn = self._channel = None
+            return False
+        return bool(self._conn and self._conn.is_open
+                    and self._channel.is_open)
+
+    def _reset(self):
+        conn, self._conn, self._channel = self._conn, None, None
+        if conn and conn.is_open:
+            try:
+                conn.close()
+            except _TRANSPORT_ERRORS:
+                pass
+
+    def publish(self, body, routing_key=None):
+        self.publish_many([body], routing_key)
+
+    def publish_many(self, bodies, routing_key=None):
+        """Publish in order. After a reconnect publishing resumes from the
+        first message that was not published (committed) yet. A second
+        failure raises PublishException."""
+        exchange = self.exchange or ''
+        routing_key = routing_key or self.queue
+        with self._lock:
+            sent = 0
+            retried = False
+            while sent < len(bodies):
+                try:
+                    if not self._is_connected():
+                        self._connect()
+                    # Services heartbeats and notices a closed socket early.
+                    self._conn.process_data_events(time_limit=0)
+                    for body in bodies[sent:]:
+                        self._channel.basic_publish(exchange=exchange,
+                            routing_key=routing_key, body=body)
+                        if not self.confirm:
+                            sent += 1
+                    if self.confirm:
+                        self._channel.tx_commit()
+                        sent = len(bodies)
+                except _TRANSPORT_ERRORS as e:
+                    self._reset()
+                    if retried:
+                        raise PublishException(sent, e) from e
+                    retried = True
+
+    def close(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._reset()
+
+
+class BatchPublishException(Exception):
+    pass
+
+class Batch:
+    """Buffers messages and publishes them in one transaction once max_size
+    messages are buffered, max_delay seconds passed since the first
+    buffered message, or the with-block exits."""
+    def __init__(self, publisher, max_size=100, max_delay=1.0):
+        self.publisher = publisher
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.delivered = 0
+        self._lock = threading.Lock()
+        self._buf = []
+        self._timer = None
+        self._error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.flush()
+        except BatchPublishException:
+            if not exc_type:
+                raise
+
+    def send(self, msg:dict):
+        self._raise_pending_error()
+        with self._lock:
+            self._buf.append(json.dumps(msg))
+            if len(self._buf) < self.max_size:
+                if not self._timer:
+                    self._timer = threading.Timer(self.max_delay,
+                                                  self._flush_on_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            bodies, self._buf = self._buf, []
+            if bodies:
+                try:
+                    self.publisher.publish_many(bodies)
+                except PublishException as e:
+                    # Keep undelivered messages for the next flush.
+                    self.delivered += e.sent
+                    self._buf = bodies[e.sent:] + self._buf
+                    raise BatchPublishException(
+                        f'{len(self._buf)} messages not delivered') from e
+                self.delivered += len(bodies)
+        self._raise_pending_error()
+
+    def _flush_on_timer(self):
+        try:
+            self.flush()
+        except BatchPublishException as e:
+            self._error = e
+
+    def _raise_pending_error(self):
+        if e := self._error:
+            self._error = None
+            raise e
+
+
+_publisher = Publisher()
+_confirm_publisher = Publisher(confirm=True)
+_event_publisher = Publisher(exchange=PIKA_EVENTS_EXCHANGE)
+atexit.register(_publisher.close)
+atexit.register(_confirm_publisher.close)
+atexit.register(_event_publisher.close)
 
 def send_message(msg:dict):
     json_obj = json.dumps(msg)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=PIKA_HOST))
-    channel = connection.channel()
+    _publisher.publish(json_obj)
+
+def publish_event(name, data=None):
+    """Publish a named event, e.g. "backup.done". Jobs listing the name in
+    their triggers are launched, data is passed to them as json."""
+    json_obj = json.dumps({'event': name, 'data': data})
+    _event_publisher.publish(json_obj, routing_key=name)
+
+def current_event():
+    """{'event': name, 'data': data} that triggered this run, or None."""
+    if e := os.environ.get(EVENT_ENV):
+        return json.loads(e)
+
+def batch(max_size=100, max_delay=1.0):
+    """with api.batch() as b: b.send(msg) -- every message is committed by
+    the broker when the block exits, otherwise BatchPublishException."""
+    return Batch(_confirm_publisher, max_size, max_delay)
 
-    channel.queue_declare(queue=PIKA_QUEUE)
+def receiver(callback, prefetch=0, workers=None, queues=(PIKA_QUEUE,)):
+    """Consume messages of the queues and call callback(body).
+
+    Without prefetch messages are auto-acked and handled one by one on the
+    consumer thread. With prefetch, up to that many unacked messages (of all
+    the queues together) are handled by a pool of workers. A message is acked
+    once callback returns (or the Future it returns completes); failed
+    messages are moved to PIKA_DEAD_LETTER_QUEUE.
+    """
+    conn = _connect()
+    channel = conn.channel()
+    for queue in queues:
+        channel.queue_declare(queue=queue)
+
+    if not prefetch:
+        def _callback(ch, method, properties, body):
+            callback(body)
+
+        for queue in queues:
+            channel.basic_consume(queue=queue, on_message_callback=_callback,
+                                  auto_ack=True)
+        channel.start_consuming()
+        return
+
+    channel.queue_declare(queue=PIKA_DEAD_LETTER_QUEUE)
+    channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or prefetch)
+
+    def _settle(tag, body, error):
+        # Runs on the connection thread, channels are not thread-safe.
+        if error:
+            print(f'  Message moved to {PIKA_DEAD_LETTER_QUEUE}: {error!r}')
+            channel.basic_publish(exchange='',
+                routing_key=PIKA_DEAD_LETTER_QUEUE, body=body)
+        channel.basic_ack(delivery_tag=tag)
+
+    def _done(tag, body, error=None):
+        conn.add_callback_threadsafe(
+            functools.partial(_settle, tag, body, error))
+
+    def _work(tag, body):
+        try:
+            r = callback(body)
+        except Exception as e:
+            _done(tag, body, e)
+            return
+        if isinstance(r, concurrent.futures.Future):
+            r.add_done_callback(lambda f: _done(tag, body, f.exception()))
+        else:
+            _done(tag, body)
+
+    def _callback(ch, method, properties, body):
+        pool.submit(_work, method.delivery_tag, body)
 
-    channel.basic_publish(exchange='', routing_key=PIKA_QUEUE, 
-        body=json_obj)
-    connection.close()
+    for queue in queues:
+        channel.basic_consume(queue=queue, on_message_callback=_callback)
+    try:
+        channel.start_consuming()
+    finally:
+        pool.shutdown(wait=False)
 
-def receiver(callback):
-    conn = pika.BlockingConnection(pika.ConnectionParameters(host=PIKA_HOST))
+def event_receiver(callback, pattern='#', exchange=PIKA_EVENTS_EXCHANGE,
+                   queue=PIKA_EVENTS_QUEUE, exclusive=False, ready=None):
+    """Consume events matching the topic pattern, call callback(body) for
+    each on the consumer thread. An exclusive queue belongs to this
+    connection and is deleted with it. ready (threading.Event) is set
+    once messages are consumed."""
+    conn = _connect()
     channel = conn.channel()
-    channel.queue_declare(queue=PIKA_QUEUE)
+    channel.exchange_declare(exchange=exchange, exchange_type='topic')
+    channel.queue_declare(queue=queue, exclusive=exclusive,
+                          auto_delete=exclusive)
+    channel.queue_bind(queue=queue, exchange=exchange, routing_key=pattern)
 
     def _callback(ch, method, properties, body):
         callback(body)
 
-    channel.basic_consume(queue=PIKA_QUEUE, on_message_callback=_callback,
-        auto_ack=True)
-    channel.start_consuming()
\ No newline at end of file
+    channel.basic_consume(queue=queue, on_message_callback=_callback,
+                          auto_ack=True)
+    if ready:
+        ready.set()
+    channel.start_consuming()
@@ -1,4 +1,6 @@
+import argparse
 from datetime import datetime
+import functools
 import json
 import os
 import pprint
@@ -8,23 +10,64 @@ import threading
 
 from . import api
 from . import command
+from . import dag
+from . import delivery
+from . import executor
+from . import history
 from . import job
+from . import joblog
+from . import leader
 from . import messenger
+from . import remote
 from . import settings
 from . import scheduler
+from . import stats
+from . import workers
 
 
 EXCEPTIONS_LIMIT = 5
 PROMPT_STRING = '> '
+DELIVERY_WORKERS = 4
 
 
 class AssistantAddJobException(Exception):
     pass
 
+def _send_to_messenger(msg):
+    msgr_cfg = settings.messenger_cfg(settings.cached())
+    messenger.send_message(msgr_cfg, payload=msg)
+
+def _report_delivery(f):
+    if e := f.exception():
+        print(f'  Failed to deliver message: {e!r}')
+
+def _coalescing_window(job_name):
+    return settings.coalescing_window(settings.cached(), job_name)
+
+_delivery = None
+_coalescer = None
+_delivery_lock = threading.Lock()
+
+def _delivery_stage():
+    global _delivery, _coalescer
+    with _delivery_lock:
+        if not _delivery:
+            _delivery = delivery.Delivery(_send_to_messenger,
+                                          workers=DELIVERY_WORKERS)
+            cfg = settings.coalescing_cfg(settings.cached())
+            _coalescer = delivery.Coalescer(_delivery.submit,
+                _coalescing_window, cfg['file_threshold'])
+    return _delivery, _coalescer
+
 def _msg_from_broker(json_obj):
     msg = json.loads(json_obj)
-    msgr_cfg = settings.messenger_cfg(settings.from_file())
-    messenger.send_message(msgr_cfg, payload=msg)
+    d, coalescer = _delivery_stage()
+    if _coalescing_window(msg.get('job_name')):
+        f = coalescer.add(msg)
+    else:
+        f = d.submit(msg.get('job_name'), msg)
+    f.add_done_callback(_report_delivery)
+    return f
 
 def _make_cmd(job: job.Job):
     cmd = ['python', job.path]
@@ -32,43 +75,231 @@ def _make_cmd(job: job.Job):
         cmd.extend(job.params_list())
     return cmd
 
-def _job_runner(a, name):
-    cmd = _make_cmd(a.jobs.get(name))
+def _event_env(run: executor.Run):
+    return {api.EVENT_ENV: json.dumps(run.event)} if run.event else {}
+
+def _run_in_pool(pool, j: job.Job, run, log, keep_lines):
+    r_out, w_out = os.pipe()
+    r_err, w_err = os.pipe()
+    last = []
+    t = threading.Thread(target=lambda: last.extend(
+        joblog.capture([r_out, r_err], log, keep_lines)), daemon=True)
+    t.start()
+    try:
+        code, rusage = pool.run(j.path, j.params_list() or [],
+            on_start=run.started, stdout=w_out, stderr=w_err,
+            env=_event_env(run))
+    finally:
+        t.join()
+        os.close(r_out)
+        os.close(r_err)
+    return code, rusage, last
+
+def _run_in_subprocess(cmd, run, log, keep_lines):
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, start_new_session=True,
+        env=dict(os.environ, **_event_env(run)))
+    run.started(proc.pid)
+    with proc.stdout, proc.stderr:
+        last = joblog.capture([proc.stdout.fileno(), proc.stderr.fileno()],
+                              log, keep_lines)
+    # wait4 reaps the child and returns its resource usage.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    code = proc.returncode = os.waitstatus_to_exitcode(status)
+    return code, rusage, last
+
+def _forward_output(j: job.Job, code, lines):
+    text = '\n'.join([f'Job failed with exit code {code}:'] + lines)
+    try:
+        api.send_message({'job_name': j.name, 'text': text})
+    except Exception as e:
+        print(f'  Failed to forward output of <{j.name}>: {e!r}')
+
+def _job_runner(a, j: job.Job, run: executor.Run):
+    cmd = _make_cmd(j)
     dt = datetime.now().strftime('%Y/%m/%d %H:%M')
     print(f'  [{dt}] Launching scheduled job: {" ".join(cmd)}')
-    subprocess.run(cmd)
+    cfg = settings.logs_cfg(settings.cached())
+    log = joblog.open_shared(joblog.log_path(cfg['dir'], j.name),
+                             cfg['max_bytes'], cfg['backups'])
+    try:
+        log.write(f'--- [{dt}] {" ".join(cmd)}\n'.encode())
+        if pool := a.worker_pool():
+            code, rusage, last = _run_in_pool(pool, j, run, log,
+                                              cfg['forward_lines'])
+        else:
+            code, rusage, last = _run_in_subprocess(cmd, run, log,
+                                                    cfg['forward_lines'])
+        log.write(f'--- exit code {code}\n'.encode())
+    finally:
+        joblog.close_shared(log)
+    run.finished(code, rusage)
+    if code != 0 and last:
+        _forward_output(j, code, last)
+
+def _fire_job(a, name):
+    if (j := a.jobs[name]).is_active:
+        a.fire_job(j)
+
+def _event_from_broker(a, json_obj):
+    try:
+        event = json.loads(json_obj)
+        names = a.triggers.get(event.get('event'), ())
+    except (ValueError, AttributeError, TypeError) as e:
+        # Raising would stop the event consumer for good.
+        print(f'  Dropped malformed event {json_obj!r}: {e!r}')
+        return
+    for name in names:
+        if (j := a.jobs[name]).is_active:
+            a.fire_job(j, event)
 
-class Assistant:
+def _report_dag(d: dag.DagRun):
+    if not d.critical_path:
+        print(f'  DAG <{d.root}>: nothing ran.')
+        return
+    path = ' -> '.join(f'{n} ({t:.1f}s)' for n, t in d.critical_path)
+    print(f'  DAG <{d.root}>: {len(d.finished)} runs, {len(d.left_out)} '
+          f'left out, {d.duration():.1f}s. Critical path: {path}')
+
+class _Node:
+    """Runs jobs on this machine, see _job_runner."""
+    def __init__(self):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def worker_pool(self):
+        """Warm worker pool if settings select the 'pool' executor mode."""
+        cfg = settings.executor_cfg(settings.cached())
+        if cfg['mode'] != 'pool':
+            return None
+        with self._pool_lock:
+            if not self._pool:
+                self._pool = workers.WorkerPool(cfg['pool_size'],
+                    cfg['preload'], cfg['max_runs'], cfg['max_rss_mb'])
+        return self._pool
+
+
+class Assistant(_Node):
     def __init__(self, msg_from_broker=_msg_from_broker):
+        super().__init__()
         self.jobs = {}
-        self.scheduler = scheduler.Scheduler(_job_runner, runner_arg=self)
+        self.triggers = {}  # {event name: [job name,]}
+        self.dependents = {}  # {job name: [names of jobs depending on it]}
+        self._history = None
+        self._history_lock = threading.Lock()
+        s = settings.cached()
+        cfg = settings.executor_cfg(s)
+        self.stats = stats.RunStats()
+        self.local_broker = None
+        if (b_cfg := settings.broker_cfg(s))['transport'] == 'local':
+            self.local_broker = api.serve_local(b_cfg['socket'])
+        if (c_cfg := settings.cluster_cfg(s))['dispatch']:
+            self.executor = remote.Dispatcher(self._run_done,
+                                              c_cfg['result_timeout'])
+        else:
+            self.executor = executor.JobExecutor(
+                functools.partial(_job_runner, self), cfg['max_concurrent'],
+                on_done=self._run_done)
+        sched_cfg = settings.scheduler_cfg(s)
+        self.scheduler = scheduler.Scheduler(_fire_job, runner_arg=self,
+            state_file=sched_cfg['state_file'],
+            standby=bool(sched_cfg['lock_file']))
         self._listen_msg_broker(msg_from_broker)
+        self.lease = None
+        if sched_cfg['lock_file']:
+            print('Standby until the scheduler lock is acquired.')
+            self.lease = leader.Lease(sched_cfg['lock_file'],
+                                      self._take_over).start()
+        else:
+            self._listen_events()
         self._ensure_settings_file_present()
+
+    def _take_over(self):
+        print('Scheduler lock acquired, firing jobs.')
+        self.scheduler.take_over()
+        self._listen_events()
     
     def _ensure_settings_file_present(self):
         if not settings.from_file():
             fname = settings.create_settings_file()
             print(f'NOTE: creating default settings file {fname}')
 
+    def history(self):
+        """Run history store, None if history is off in settings."""
+        cfg = settings.history_cfg(settings.cached())
+        if not cfg['file']:
+            return None
+        with self._history_lock:
+            if not self._history:
+                self._history = history.HistoryStore(cfg['file'],
+                                                     cfg['retention_days'])
+        return self._history
+
+    def _run_done(self, run):
+        if h := self.history():
+            h.add_run(run)
+        self.stats.add(run)
+
     def _listen_msg_broker(self, msg_from_broker):
+        cfg = settings.broker_cfg(settings.cached())
+
+        def _on_message(body):
+            r = msg_from_broker(body)
+            if h := self.history():
+                msg = json.loads(body)
+                h.add_message(msg.get('job_name'), msg.get('text'))
+            return r
+
         t = threading.Thread(group=None, target=api.receiver,
-            args=(msg_from_broker,), daemon=True)
+            args=(_on_message, cfg['prefetch'], cfg['workers']),
+            daemon=True)
+        t.start()
+
+    def _listen_events(self):
+        t = threading.Thread(group=None, target=api.event_receiver,
+            args=(functools.partial(_event_from_broker, self),), daemon=True)
         t.start()
 
+    def _unindex_job(self, name):
+        """Drop name from triggers and dependents, before the job is
+        added again."""
+        for index in (self.triggers, self.dependents):
+            for key, names in list(index.items()):
+                if name in names:
+                    names.remove(name)
+                    if not names:
+                        del index[key]
+
     def _add_schedule_job(self, j):
+        self._unindex_job(j.name)
         self.jobs.update({j.name: j})
+        for event in j.triggers:
+            self.triggers.setdefault(event, []).append(j.name)
+        for d in j.depends_on:
+            self.dependents.setdefault(d, []).append(j.name)
         self._reschedule_job(j.name)
 
-    def add_job(self, name, path, params, is_active):
+    def add_job(self, name, path, params, is_active, **kwargs):
         if name in self.jobs:
             raise AssistantAddJobException(f'Job {name} is already in the list.')
-        j = job.Job(name, path, params, is_active)
+        j = job.Job(name, path, params, is_active, **kwargs)
+        job.check_dependencies([*self.jobs.values(), j])
         self._add_schedule_job(j)
 
     def load_job_from_json(self, job_dict):
         j = job.from_cfg(job_dict)
+        job.check_dependencies([*self.jobs.values(), j])
         self._add_schedule_job(j)
 
+    def fire_job(self, j, event=None):
+        """Run the job, and then the jobs depending on it as a DAG."""
+        if j.name not in self.dependents:
+            return self.executor.fire(j, event)
+        d = dag.DagRun(j.name, self.jobs, self.dependents, self.executor.fire,
+                       _report_dag, event, self.stats.last)
+        d.start()
+        return d
+
     def jobs_json(self):
         cfg = {'jobs': {}}
         for name, j in self.jobs.items():
@@ -80,15 +311,38 @@ class Assistant:
         for _, job in self.jobs.items():
             pprint.pprint(job.json())
 
+    def _event(self, j, sched):
+        jitter = j.jitter
+        if jitter is None:
+            jitter = settings.scheduler_cfg(settings.cached())['jitter']
+        return scheduler.Event(j.name, sched, j.catch_up, jitter)
+
     def reschedule_job(self, name, sched):
-        self.jobs[name].schedule.append(sched)
-        self._reschedule_job(name)
+        j = self.jobs[name]
+        j.schedule.append(sched)
+        self.scheduler.schedule_event(self._event(j, sched),
+                                      active=j.is_active)
+
+    def unschedule_job(self, name, sched):
+        self.jobs[name].schedule.remove(sched)
+        self.scheduler.cancel_event(name, sched)
 
     def _reschedule_job(self, name):
-        self.scheduler.cancel_events(name)
-        for s in self.jobs[name].schedule:
-            e = scheduler.Event(name, s)
-            self.scheduler.schedule_event(e)
+        j = self.jobs[name]
+        # Kept schedules are replaced in place and keep their watermarks.
+        for s in set(self.scheduler.jobs.get(name, {})) - set(j.schedule):
+            self.scheduler.cancel_event(name, s)
+        for s in j.schedule:
+            self.scheduler.schedule_event(self._event(j, s),
+                                          active=j.is_active)
+
+    def enable_job(self, name):
+        self.jobs[name].is_active = True
+        self.scheduler.resume_events(name)
+
+    def disable_job(self, name):
+        self.jobs[name].is_active = False
+        self.scheduler.pause_events(name)
 
     def next_run(self):
         return self.scheduler.next_run()
@@ -116,9 +370,34 @@ def cmd_add_job(a):
     params = input('  Params (opt): ') or None
     is_active = input('  Is active? y/[n]: ')
     is_active = True if is_active.lower() == 'y' else False
+    max_instances = input('  Max instances at a time [1]: ') or '1'
+    if not max_instances.isdigit() or int(max_instances) < 1:
+        print(f'  Incorrect max instances ({max_instances})')
+        return
+    _o_options = executor.Overlap.list()
+    overlap = input(f'  When still running ({_o_options}) [skip]: ') or 'skip'
+    if not overlap in _o_options:
+        print(f'  Incorrect option ({overlap})')
+        return
+    timeout = input('  Timeout in seconds (opt): ') or None
+    if timeout and (not timeout.isdigit() or int(timeout) < 1):
+        print(f'  Incorrect timeout ({timeout})')
+        return
+    jitter = input('  Jitter in seconds (opt, settings by default): ') or None
+    if jitter and not jitter.isdigit():
+        print(f'  Incorrect jitter ({jitter})')
+        return
+    _c_options = scheduler.CatchUp.list()
+    catch_up = input(f'  Missed runs ({_c_options}) [skip]: ') or 'skip'
+    if not catch_up in _c_options:
+        print(f'  Incorrect option ({catch_up})')
+        return
     is_input_correct = input('  Is input correct? Create this job? [y]/n: ')
     if is_input_correct.lower() != 'n':
-        a.add_job(name, path, params, is_active)
+        a.add_job(name, path, params, is_active,
+                  max_instances=int(max_instances), overlap=overlap,
+                  timeout=timeout and int(timeout), catch_up=catch_up,
+                  jitter=jitter and int(jitter))
         print(f'  Job <{name}> was added.')
 
 def cmd_save_jobs(a):
@@ -133,8 +412,10 @@ def cmd_save_jobs(a):
     print(f'  File {name} was created.')
 
 def _load_jobs(a, cfg):
-    for _, job_cfg in cfg['jobs'].items():
-        a.load_job_from_json(job_cfg)
+    jobs = [job.from_cfg(c) for c in cfg['jobs'].values()]
+    job.check_dependencies([*a.jobs.values(), *jobs])
+    for j in jobs:
+        a._add_schedule_job(j)
 
 def _load_jobs_from_file(a, name):
     with open(name) as f:
@@ -146,30 +427,150 @@ def cmd_load_jobs_from_config(a):
     if not os.path.exists(fname):
         print(f'  File {fname} doesn\'t exists.')
         return
-    _load_jobs_from_file(a, fname)
+    try:
+        _load_jobs_from_file(a, fname)
+    except job.JobDependencyCycleException as e:
+        print(f'  Jobs were not loaded. {e}')
 
 def cmd_schedule_job(a: Assistant):
     name = input('  Job name: ')
     if not name in a.jobs:
         print(f'  Job <{name}> doesn\'t exists.')
         return
-    t = input(f'  Time ({scheduler.TIME_FMT}): ')
-    t = datetime.strptime(t, scheduler.TIME_FMT).time()
     _i_options = scheduler.Interval.list()
     interval = input(f'  Interval ({_i_options}): ')
     if not interval in _i_options:
         print(f'  Incorrect interval ({interval})')
         return
-    interval_arg = None
-    if _a_options := scheduler._intervals[interval]:
+    t, interval_arg = None, None
+    if interval in scheduler._compiled:
+        example = {scheduler.Interval.cron: '*/10 8-18 * * mon-fri',
+                   scheduler.Interval.every: '5m between 08:00 and 18:00'}
+        interval_arg = input(f'  Expression (e.g. {example[interval]}): ')
+    else:
+        t = input(f'  Time ({scheduler.TIME_FMT}): ')
+        t = datetime.strptime(t, scheduler.TIME_FMT).time()
+    if _a_options := scheduler._intervals.get(interval):
         interval_arg = input(f'  Interval argument ({_a_options}): ')
         if not interval_arg in _a_options:
             print(f'  Incorrect argument ({interval_arg})')
             return
-    s = scheduler.Schedule(t, interval, interval_arg)
+    try:
+        s = scheduler.Schedule(t, interval, interval_arg)
+    except scheduler.ScheduleInitException as e:
+        print(f'  {e}')
+        return
     a.reschedule_job(name, s)
     print(f'  Job was rescheduled ({a.jobs[name].schedule_json()})')
 
+def cmd_unschedule_job(a: Assistant):
+    name = input('  Job name: ')
+    if not name in a.jobs:
+        print(f'  Job <{name}> doesn\'t exists.')
+        return
+    schedule = a.jobs[name].schedule
+    for i, s in enumerate(schedule):
+        print(f'  {i}: {s.json()}')
+    i = input('  Schedule number to remove: ')
+    if not i.isdigit() or int(i) >= len(schedule):
+        print(f'  Incorrect schedule number ({i})')
+        return
+    a.unschedule_job(name, schedule[int(i)])
+    print(f'  Job was rescheduled ({a.jobs[name].schedule_json()})')
+
+def _cmd_set_job_active(a: Assistant, is_active):
+    name = input('  Job name: ')
+    if not name in a.jobs:
+        print(f'  Job <{name}> doesn\'t exists.')
+        return
+    if is_active:
+        a.enable_job(name)
+    else:
+        a.disable_job(name)
+    print(f'  Job <{name}> is {"enabled" if is_active else "disabled"}.')
+
+def cmd_enable_job(a: Assistant):
+    _cmd_set_job_active(a, True)
+
+def cmd_disable_job(a: Assistant):
+    _cmd_set_job_active(a, False)
+
+def cmd_job_stats(a: Assistant):
+    summary = a.stats.summary()
+    if not summary:
+        print('  No runs recorded yet.')
+        return
+    print(f'  {"job":20} {"runs":>5} {"failed":>6} {"avg wall":>9} '
+          f'{"max wall":>9} {"avg cpu":>8} {"max rss":>9}')
+    for name, s in sorted(summary.items(),
+                          key=lambda i: -i[1]['avg_wall_time']):
+        cpu = f'{s["avg_cpu_time"]:7.2f}s' if s["avg_cpu_time"] is not None \
+            else f'{"-":>8}'
+        rss = f'{s["max_rss_kb"] // 1024:6} MB' if s["max_rss_kb"] \
+            else f'{"-":>9}'
+        print(f'  {name:20} {s["runs"]:5} {s["failed"]:6} '
+              f'{s["avg_wall_time"]:8.2f}s {s["max_wall_time"]:8.2f}s '
+              f'{cpu} {rss}')
+
+def cmd_export_job_stats(a: Assistant):
+    name = input('  Enter file name: ')
+    if os.path.exists(name):
+        print('  (!) File with this name already exists. Please pick another name.')
+        return
+    with open(name, 'wt') as f:
+        json.dump(a.stats.json(), f, indent=4)
+    print(f'  File {name} was created.')
+
+def _history_or_print(a: Assistant):
+    if not (h := a.history()):
+        print('  History is off (see history -> file in settings.json).')
+    return h
+
+def _fmt_time(t):
+    return datetime.fromtimestamp(t).strftime('%Y/%m/%d %H:%M:%S')
+
+def cmd_job_history(a: Assistant):
+    if not (h := _history_or_print(a)):
+        return
+    name = input('  Job name: ')
+    n = input('  Number of runs [10]: ') or '10'
+    if not n.isdigit():
+        print(f'  Incorrect number ({n})')
+        return
+    for r in h.last_runs(name, int(n)):
+        print(f'  [{_fmt_time(r["start_time"])}] {r["status"]:6} '
+              f'exit {r["exit_code"]}, {r["wall_time"]:.2f}s')
+
+def cmd_job_failure_rate(a: Assistant):
+    if not (h := _history_or_print(a)):
+        return
+    for name in h.job_names():
+        rate = h.failure_rate(name)
+        print(f'  {name:20} '
+              + ('     -' if rate is None else f'{rate:6.1%}'))
+
+def cmd_job_p95(a: Assistant):
+    if not (h := _history_or_print(a)):
+        return
+    for name in h.job_names():
+        p95 = h.p95_duration(name)
+        print(f'  {name:20} '
+              + ('       -' if p95 is None else f'{p95:8.2f}s'))
+
+def cmd_tail_job_log(a: Assistant):
+    name = input('  Job name: ')
+    n = input('  Number of lines [20]: ') or '20'
+    if not n.isdigit():
+        print(f'  Incorrect number ({n})')
+        return
+    cfg = settings.logs_cfg(settings.cached())
+    path = joblog.log_path(cfg['dir'], name)
+    if not os.path.exists(path):
+        print(f'  No output of <{name}> in {cfg["dir"]}.')
+        return
+    for line in joblog.tail(path, int(n)):
+        print(f'  {line}')
+
 def commands():
     c = command.Commands()
     c.add(command.Cmd(['q'], cmd_exit, 'Quit'))
@@ -185,6 +586,29 @@ def commands():
     j_sched = command.Cmd(['schedule','sched'], cmd_schedule_job,
                           'Schedule specific job')
     jobs.add_subcmd(j_sched)
+    j_unsched = command.Cmd(['unschedule','unsched'], cmd_unschedule_job,
+                            'Remove a schedule of specific job')
+    jobs.add_subcmd(j_unsched)
+    j_enable = command.Cmd(['enable'], cmd_enable_job, 'Enable specific job')
+    jobs.add_subcmd(j_enable)
+    j_disable = command.Cmd(['disable'], cmd_disable_job,
+                            'Disable specific job')
+    jobs.add_subcmd(j_disable)
+    j_stats = command.Cmd(['stats'], cmd_job_stats,
+                          'Resource usage of recent runs per job')
+    j_stats.add_subcmd(command.Cmd(['export'], cmd_export_job_stats,
+                                   'Save runs and stats to a json file'))
+    jobs.add_subcmd(j_stats)
+    j_history = command.Cmd(['history','hist'], cmd_job_history,
+                            'Last runs of specific job')
+    j_history.add_subcmd(command.Cmd(['failures'], cmd_job_failure_rate,
+                                     'Failure rate per job'))
+    j_history.add_subcmd(command.Cmd(['p95'], cmd_job_p95,
+                                     '95th percentile run time per job'))
+    jobs.add_subcmd(j_history)
+    j_tail = command.Cmd(['tail'], cmd_tail_job_log,
+                         'Last lines of output of specific job')
+    jobs.add_subcmd(j_tail)
     j_next = command.Cmd(['next_run','next'], cmd_next_job_run,
                        'Print time when the next job should run')
     jobs.add_subcmd(j_next)
@@ -195,7 +619,31 @@ def check_load_jobs_at_startup(a):
     if len(sys.argv) == 2:
         _load_jobs_from_file(a, sys.argv[1])
 
+def worker_main(argv):
+    """`assistant worker`: run jobs fired by the scheduling Assistant."""
+    cfg = settings.cluster_cfg(settings.cached())
+    p = argparse.ArgumentParser(prog='assistant worker')
+    p.add_argument('--labels', default=','.join(cfg['labels']),
+                   help='comma separated, jobs with one of them run here')
+    p.add_argument('--capacity', type=int, default=cfg['capacity'],
+                   help='runs at a time')
+    p.add_argument('--broker', help='host:port of RabbitMQ')
+    args = p.parse_args(argv)
+    b_cfg = settings.broker_cfg(settings.cached())
+    if b_cfg['transport'] == 'local' and not args.broker:
+        api.use_local(b_cfg['socket'])
+    if args.broker:
+        host, _, port = args.broker.partition(':')
+        api.PIKA_HOST, api.PIKA_PORT = host, int(port or api.PIKA_PORT)
+    w = remote.Worker(functools.partial(_job_runner, _Node()),
+                      [l for l in args.labels.split(',') if l], args.capacity)
+    print(f'Worker {w.id} (labels {w.labels}, capacity {w.capacity}).')
+    w.run()
+
 def main():
+    if sys.argv[1:2] == ['worker']:
+        worker_main(sys.argv[2:])
+        return
     a = Assistant()
     check_load_jobs_at_startup(a)
     cmds = commands()
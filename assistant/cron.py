@@ -0,0 +1,165 @@
+"""Compiled schedule rules: cron expressions and fixed intervals.
+
+A rule is compiled once and answers next_after(dt) with a few bit operations
+instead of stepping through minutes. Cron fields become int bitsets (bit n set
+when value n matches); the next matching value is the lowest set bit at or
+above the current one.
+"""
+import calendar
+import datetime
+import re
+
+
+class CronSyntaxException(Exception):
+    pass
+
+_MONTHS = ['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+           'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+_DAYS = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+# (min, max, names) of minute, hour, day of month, month, day of week.
+_FIELDS = [(0, 59, None), (0, 23, None), (1, 31, None),
+           (1, 12, {n: i + 1 for i, n in enumerate(_MONTHS)}),
+           (0, 7, {n: i for i, n in enumerate(_DAYS)})]
+_MACROS = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+# Years searched for a fire, covers Feb 29 between 2096 and 2104.
+_MAX_YEARS = 9
+
+
+def _next_bit(mask, n):
+    """Lowest set bit of mask at or above n, None if there is none."""
+    mask = mask >> n << n
+    return (mask & -mask).bit_length() - 1 if mask else None
+
+def _value(s, names):
+    if names and s.lower() in names:
+        return names[s.lower()]
+    if not s.isdigit():
+        raise CronSyntaxException(f'Incorrect value ({s}).')
+    return int(s)
+
+def _parse_field(field, lo, hi, names):
+    mask = 0
+    for item in field.split(','):
+        rng, _, step = item.partition('/')
+        if rng == '*':
+            start, end = lo, hi
+        elif '-' in rng:
+            start, end = (_value(v, names) for v in rng.split('-', 1))
+        else:
+            start = _value(rng, names)
+            end = hi if step else start
+        step = _value(step, None) if step else 1
+        if not lo <= start <= end <= hi or step < 1:
+            raise CronSyntaxException(f'Incorrect field ({field}).')
+        for v in range(start, end + 1, step):
+            mask |= 1 << v
+    return mask
+
+
+class Cron:
+    """Standard 5-field cron expression: minute hour day-of-month month
+    day-of-week. As in cron, when both day fields are restricted a day
+    matching either of them fires."""
+    def __init__(self, expr):
+        self.expr = expr
+        fields = _MACROS.get(expr.strip(), expr).split()
+        if len(fields) != 5:
+            raise CronSyntaxException(f'Expected 5 fields ({expr}).')
+        (self.minutes, self.hours, self.dom, self.months, dow) = (
+            _parse_field(f, *spec) for f, spec in zip(fields, _FIELDS))
+        if dow & 1 << 7:  # 7 is Sunday too
+            dow = (dow | 1) & ~(1 << 7)
+        self.dow = dow
+        self.dom_any = fields[2].startswith('*')
+        self.dow_any = fields[4].startswith('*')
+        # Days of a month (bit 1 is the 1st) matching dow, by the
+        # weekday of the month's first day.
+        self._dow_days = [
+            sum(1 << d for d in range(1, 32) if dow >> (first + d - 1) % 7 & 1)
+            for first in range(7)]
+        if self.next_after(datetime.datetime(2000, 1, 1)) is None:
+            raise CronSyntaxException(f'Expression never fires ({expr}).')
+
+    def _days(self, year, month):
+        first, n = calendar.monthrange(year, month)
+        valid = (1 << n + 1) - 2
+        dow_days = self._dow_days[(first + 1) % 7]  # cron Sunday is 0
+        if self.dom_any:
+            return dow_days & valid
+        if self.dow_any:
+            return self.dom & valid
+        return (self.dom | dow_days) & valid
+
+    def next_after(self, dt):
+        """First fire time strictly after dt, None if there is none."""
+        t = dt.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        year, month, day, hour, minute = t.year, t.month, t.day, t.hour, t.minute
+        while year <= dt.year + _MAX_YEARS:
+            if (m := _next_bit(self.months, month)) is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if m != month:
+                month, day, hour, minute = m, 1, 0, 0
+            if (d := _next_bit(self._days(year, month), day)) is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if d != day:
+                day, hour, minute = d, 0, 0
+            if (h := _next_bit(self.hours, hour)) is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if h != hour:
+                hour, minute = h, 0
+            if (mi := _next_bit(self.minutes, minute)) is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, mi)
+
+
+_EVERY = re.compile(r'^(?:every\s+)?(\d+)\s*([smh])(?:\s+between\s+(\S+)\s+'
+                    r'and\s+(\S+))?$', re.IGNORECASE)
+_UNITS = {'s': 1, 'm': 60, 'h': 3600}
+_DAY = datetime.timedelta(days=1)
+
+def _time_of_day(s):
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            t = datetime.datetime.strptime(s, fmt).time()
+        except ValueError:
+            continue
+        return datetime.timedelta(hours=t.hour, minutes=t.minute,
+                                  seconds=t.second)
+    raise CronSyntaxException(f'Incorrect time ({s}).')
+
+
+class Every:
+    """Fixed interval, e.g. "15s" or "5m between 08:00 and 18:00". Fire
+    times are aligned to the window start (midnight if there is no window)
+    and restart from it every day."""
+    def __init__(self, spec):
+        self.spec = spec
+        if not (m := _EVERY.match(spec.strip())):
+            raise CronSyntaxException(f'Incorrect interval ({spec}).')
+        n, unit, start, end = m.groups()
+        self.period = datetime.timedelta(seconds=int(n) * _UNITS[unit.lower()])
+        self.start = _time_of_day(start) if start else datetime.timedelta()
+        self.end = _time_of_day(end) if end else _DAY
+        if not self.period or self.start > self.end:
+            raise CronSyntaxException(f'Incorrect interval ({spec}).')
+
+    def next_after(self, dt):
+        """First fire time strictly after dt."""
+        midnight = datetime.datetime.combine(dt.date(), datetime.time())
+        since = dt - midnight
+        k = 0 if since < self.start else (since - self.start) // self.period + 1
+        t = self.start + k * self.period
+        if t > self.end or t >= _DAY:
+            return midnight + _DAY + self.start
+        return midnight + t
@@ -0,0 +1,139 @@
+"""Runs of a job together with every job depending on it."""
+import datetime
+import threading
+
+from .executor import Overlap, RunStatus
+
+
+def downstream(root, dependents):
+    """Names of root and of all jobs depending on it, directly or not."""
+    graph, todo = {root}, [root]
+    while todo:
+        for d in dependents.get(todo.pop(), ()):
+            if d not in graph:
+                graph.add(d)
+                todo.append(d)
+    return graph
+
+
+class DagRun:
+    """Fires root, then every downstream job as soon as all of its
+    dependencies inside the graph finished ok. Independent branches run in
+    parallel on the executor. A job whose dependency failed, was skipped or
+    is inactive does not run, nor does anything below it.
+
+    A dependency outside the graph (another root of a fan-in job) counts
+    as ok if its last run, last_run(name), was ok. So with C depending on
+    A and B, C runs after A only if B's last run succeeded, and after
+    each ok run of A or B.
+
+    fire(job, event, on_done) starts a run and returns it (None if skipped
+    or queued); on_done(run) must be called when it ends. report(dag) is
+    called once every job ran or was left out.
+    """
+    def __init__(self, root, jobs, dependents, fire, report=None, event=None,
+                 last_run=lambda name: None):
+        self.root = root
+        self.jobs = jobs  # {name: Job}
+        self.graph = downstream(root, dependents)
+        self.fire = fire
+        self.report = report
+        self.event = event
+        self.last_run = last_run
+        self.runs = {}  # {name: Run}
+        self.finished = set()
+        self.left_out = set()
+        self.critical_path = None  # [(name, wall time),] once finished
+        self._waiting = {n: {d for d in jobs[n].depends_on if d in self.graph}
+                         for n in self.graph}
+        self._dependents = {n: [d for d in dependents.get(n, ())
+                                if d in self.graph] for n in self.graph}
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._start(self.root)
+            self._check_finished()
+
+    def _start(self, name):
+        j = self.jobs[name]
+        if not j.is_active:
+            self._leave_out(name)
+            return
+        if name != self.root and (failed := self._failed_outside(j)):
+            print(f'  DAG <{self.root}>: <{name}> left out, last run of '
+                  f'{failed} did not succeed.')
+            self._leave_out(name)
+            return
+        r = self.fire(j, self.event, self._done)
+        if r:
+            self.runs[name] = r
+        elif j.overlap != Overlap.queue:
+            print(f'  DAG <{self.root}>: <{name}> was skipped.')
+            self._leave_out(name)
+
+    def _failed_outside(self, j):
+        """Dependencies of j outside the graph whose last run was not ok."""
+        failed = []
+        for d in j.depends_on:
+            if d not in self.graph:
+                r = self.last_run(d)
+                if not r or r.status != RunStatus.ok:
+                    failed.append(d)
+        return failed
+
+    def _leave_out(self, name):
+        todo = [name]
+        while todo:
+            n = todo.pop()
+            if n not in self.left_out:
+                self.left_out.add(n)
+                todo.extend(self._dependents[n])
+
+    def _done(self, run):
+        with self._lock:
+            name = run.job_name
+            self.runs[name] = run
+            self.finished.add(name)
+            if run.status != RunStatus.ok:
+                for d in self._dependents[name]:
+                    self._leave_out(d)
+            else:
+                for d in self._dependents[name]:
+                    self._waiting[d].discard(name)
+                    if not self._waiting[d] and d not in self.left_out:
+                        self._start(d)
+            self._check_finished()
+
+    def _check_finished(self):
+        if self.critical_path is not None:
+            return
+        if len(self.finished | self.left_out) < len(self.graph):
+            return
+        self.critical_path = self._critical_path()
+        if self.report:
+            self.report(self)
+
+    def _end(self, name):
+        r = self.runs[name]
+        return r.start_time + datetime.timedelta(seconds=r.wall_time)
+
+    def _critical_path(self):
+        """Chain of runs that determined when the DAG finished: the last run
+        to end, its dependency that ended last, and so on up to the root."""
+        ended = [n for n, r in self.runs.items()
+                 if r.start_time and r.wall_time is not None]
+        if not ended:
+            return []
+        path = [max(ended, key=self._end)]
+        while deps := [d for d in self.jobs[path[-1]].depends_on
+                       if d in ended]:
+            path.append(max(deps, key=self._end))
+        return [(n, self.runs[n].wall_time) for n in reversed(path)]
+
+    def duration(self):
+        """Seconds from the root's start to the end of the last run."""
+        if self.critical_path:
+            first, last = self.critical_path[0][0], self.critical_path[-1][0]
+            return (self._end(last) - self.runs[first].start_time
+                    ).total_seconds()
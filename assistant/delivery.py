@@ -0,0 +1,108 @@
+import collections
+import concurrent.futures
+import queue
+import threading
+
+from .ratelimit import RateLimitedException
+
+
+class Delivery:
+    """Delivery stage between the broker consumer and the messenger.
+
+    Messages are kept in a FIFO queue per key (channel). A small pool of
+    workers drains the queues; a key is owned by one worker at a time, so
+    messages keep their order and a slow or rate-limited channel does not
+    block the others. On RateLimitedException the message stays at the head
+    of its queue and the key is retried after retry_after seconds.
+    """
+    def __init__(self, send, workers=4):
+        self.send = send
+        self._queues = {}  # {key: deque([(payload, future),])}
+        self._ready = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(workers):
+            t = threading.Thread(target=self._worker, daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, payload):
+        f = concurrent.futures.Future()
+        with self._lock:
+            if q := self._queues.get(key):
+                q.append((payload, f))
+            else:
+                self._queues[key] = collections.deque([(payload, f)])
+                self._ready.put(key)
+        return f
+
+    def pending(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.values())
+
+    def _worker(self):
+        while True:
+            key = self._ready.get()
+            with self._lock:
+                payload, f = self._queues[key][0]
+            try:
+                self.send(payload)
+            except RateLimitedException as e:
+                t = threading.Timer(e.retry_after, self._ready.put, (key,))
+                t.daemon = True
+                t.start()
+                continue
+            except Exception as e:
+                f.set_exception(e)
+            else:
+                f.set_result(None)
+            with self._lock:
+                q = self._queues[key]
+                q.popleft()
+                if q:
+                    self._ready.put(key)
+                else:
+                    del self._queues[key]
+
+
+class Coalescer:
+    """Merges messages of the same job arriving within the job's window into
+    one digest payload, which is submitted when the window closes. Digests
+    longer than file_threshold characters are marked to be sent as a file.
+    """
+    def __init__(self, submit, window, file_threshold=4000):
+        self.submit = submit  # submit(key, payload) -> Future
+        self.window = window  # window(job_name) -> seconds
+        self.file_threshold = file_threshold
+        self._pending = {}  # {job_name: [(text, future),]}
+        self._lock = threading.Lock()
+
+    def add(self, msg):
+        job_name = msg.get('job_name')
+        f = concurrent.futures.Future()
+        with self._lock:
+            if items := self._pending.get(job_name):
+                items.append((msg.get('text'), f))
+                return f
+            self._pending[job_name] = [(msg.get('text'), f)]
+        t = threading.Timer(self.window(job_name), self._flush, (job_name,))
+        t.daemon = True
+        t.start()
+        return f
+
+    def _flush(self, job_name):
+        with self._lock:
+            items = self._pending.pop(job_name)
+        text = '\n'.join(str(t) for t, _ in items)
+        payload = {'job_name': job_name, 'text': text, 'count': len(items)}
+        if len(text) > self.file_threshold:
+            payload['as_file'] = True
+        merged = self.submit(job_name, payload)
+
+        def _done(m):
+            for _, f in items:
+                if e := m.exception():
+                    f.set_exception(e)
+                else:
+                    f.set_result(None)
+        merged.add_done_callback(_done)
@@ -0,0 +1,189 @@
+import collections
+import concurrent.futures
+from datetime import datetime
+import os
+import signal
+import threading
+import time
+
+
+class Overlap:
+    """What to do when a job fires while max_instances runs are active."""
+    skip = "skip"
+    queue = "queue"
+    kill = "kill"
+    @staticmethod
+    def list():
+        return ["skip", "queue", "kill"]
+
+
+class RunStatus:
+    ok = "ok"
+    failed = "failed"
+    killed = "killed"
+    timeout = "timeout"
+
+
+class Run:
+    """One execution of a job and its resource usage. The runner calls
+    started() and sets pid once the process exists, then finished().
+    event is the event dict that triggered the run, if any."""
+    def __init__(self, job_name, event=None):
+        self.job_name = job_name
+        self.event = event
+        self.fire_time = datetime.now()
+        self.start_time = None
+        self.pid = None
+        self.killed = False
+        self.timed_out = False
+        self.start_latency = None  # seconds from fire to start
+        self.wall_time = None
+        self.cpu_time = None  # user + system seconds
+        self.max_rss_kb = None
+        self.exit_code = None
+        self._fired = time.monotonic()
+        self._started = None
+
+    def started(self, pid=None):
+        self.start_time = datetime.now()
+        self._started = time.monotonic()
+        self.start_latency = self._started - self._fired
+        self.pid = pid
+        if self.killed and pid:
+            # Killed while waiting to start, e.g. for a pool worker.
+            _signal_run(pid, signal.SIGTERM)
+
+    def finished(self, exit_code, rusage=None):
+        self.wall_time = time.monotonic() - self._started
+        self.exit_code = exit_code
+        if rusage:
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+            self.max_rss_kb = rusage.ru_maxrss
+
+    @property
+    def status(self):
+        if self.killed:
+            return RunStatus.killed
+        if self.timed_out:
+            return RunStatus.timeout
+        return RunStatus.ok if self.exit_code == 0 else RunStatus.failed
+
+    def json(self):
+        return {
+            "job_name": self.job_name,
+            "fire_time": self.fire_time.isoformat(),
+            "start_time": self.start_time and self.start_time.isoformat(),
+            "start_latency": self.start_latency,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "max_rss_kb": self.max_rss_kb,
+            "exit_code": self.exit_code,
+            "status": self.status
+        }
+
+
+# Seconds between SIGTERM and SIGKILL of a timed out run.
+KILL_GRACE = 5
+
+def _signal_run(pid, sig):
+    """Signal the process group the run leads, or just the process."""
+    try:
+        if os.getpgid(pid) == pid:
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class JobExecutor:
+    """Runs jobs on a bounded thread pool, at most max_workers at a time.
+
+    Per job at most job.max_instances runs are active. A fire beyond that
+    is skipped, queued until a run of the job finishes, or kills the oldest
+    active run, according to job.overlap. A run taking longer than
+    job.timeout seconds gets SIGTERM, and SIGKILL KILL_GRACE seconds later.
+    Runners start jobs in a new process group, so children die with them.
+    """
+    def __init__(self, runner, max_workers=8, on_done=None):
+        self.runner = runner  # runner(job, run), blocks until the run ends
+        self.on_done = on_done  # on_done(run) for every finished run
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self._active = {}  # {job_name: [run,]}
+        self._queued = {}  # {job_name: deque([(job, event, done),])}
+        self._timers = {}  # {run: timeout timer}
+        self._lock = threading.Lock()
+
+    def active(self, name):
+        with self._lock:
+            return list(self._active.get(name, []))
+
+    def fire(self, job, event=None, done=None):
+        """Start (or skip/queue) a run of job, return the Run if started.
+        done(run) is called when this run ends, after on_done."""
+        with self._lock:
+            active = self._active.setdefault(job.name, [])
+            if len(active) >= job.max_instances:
+                if job.overlap == Overlap.skip:
+                    print(f'  Job <{job.name}> is still running, skipping.')
+                    return None
+                if job.overlap == Overlap.queue:
+                    self._queued.setdefault(job.name, collections.deque()
+                                            ).append((job, event, done))
+                    return None
+                self._kill(active[0])
+            return self._start(job, event, done)
+
+    def _start(self, job, event=None, done=None):
+        r = Run(job.name, event)
+        self._active[job.name].append(r)
+        self._pool.submit(self._run, job, r, done)
+        return r
+
+    def _kill(self, r):
+        r.killed = True
+        if r.pid:
+            _signal_run(r.pid, signal.SIGTERM)
+
+    def _timer(self, delay, r, sig):
+        t = self._timers[r] = threading.Timer(delay, self._timeout, (r, sig))
+        t.daemon = True
+        t.start()
+
+    def _timeout(self, r, sig):
+        with self._lock:
+            if r not in self._timers:  # the run is over
+                return
+            if not r.pid:  # not started yet
+                self._timer(0.1, r, sig)
+                return
+            r.timed_out = True
+            _signal_run(r.pid, sig)
+            if sig == signal.SIGTERM:
+                self._timer(KILL_GRACE, r, signal.SIGKILL)
+
+    def _run(self, job, r, done=None):
+        if job.timeout:
+            with self._lock:
+                self._timer(job.timeout, r, signal.SIGTERM)
+        try:
+            if not r.killed:
+                self.runner(job, r)
+            if self.on_done and r.wall_time is not None:
+                self.on_done(r)
+        except Exception as e:
+            print(f'  Job <{job.name}> failed to run: {e!r}')
+        finally:
+            with self._lock:
+                if t := self._timers.pop(r, None):
+                    t.cancel()
+                active = self._active[job.name]
+                active.remove(r)
+                queued = self._queued.get(job.name)
+                if queued and len(active) < job.max_instances:
+                    self._start(*queued.popleft())
+            if done:
+                done(r)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,164 @@
+import queue
+import sqlite3
+import threading
+import time
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job_name TEXT NOT NULL,
+    fire_time REAL NOT NULL,
+    start_time REAL NOT NULL,
+    start_latency REAL,
+    wall_time REAL,
+    cpu_time REAL,
+    max_rss_kb INTEGER,
+    exit_code INTEGER,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_job_start ON runs (job_name, start_time);
+CREATE INDEX IF NOT EXISTS runs_status ON runs (status);
+CREATE INDEX IF NOT EXISTS runs_job_wall ON runs (job_name, wall_time);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    job_name TEXT,
+    time REAL NOT NULL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_job_time ON messages (job_name, time);
+"""
+
+_INSERT_RUN = """INSERT INTO runs (job_name, fire_time, start_time,
+    start_latency, wall_time, cpu_time, max_rss_kb, exit_code, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+_INSERT_MESSAGE = "INSERT INTO messages (job_name, time, text) VALUES (?, ?, ?)"
+
+_RUN_COLUMNS = ["job_name", "fire_time", "start_time", "start_latency",
+                "wall_time", "cpu_time", "max_rss_kb", "exit_code", "status"]
+
+# Seconds between retention prunes done by the writer thread.
+PRUNE_INTERVAL = 3600
+
+
+class HistoryStore:
+    """Run and message history in SQLite.
+
+    Writes are queued and committed by a background thread in batches of up
+    to batch_size rows (or whatever arrived within flush_interval seconds),
+    so callers never wait for the disk. The writer also deletes rows older
+    than retention_days once per PRUNE_INTERVAL. Times are unix timestamps.
+    """
+    def __init__(self, path, retention_days=None, batch_size=500,
+                 flush_interval=1.0):
+        self.path = path
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._q = queue.Queue()
+        with self._connect() as conn:
+            conn.executescript(_SCHEMA)
+        self._t = threading.Thread(target=self._writer, daemon=True)
+        self._t.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def add_run(self, run):
+        self._q.put((_INSERT_RUN, (
+            run.job_name, run.fire_time.timestamp(),
+            run.start_time.timestamp(), run.start_latency, run.wall_time,
+            run.cpu_time, run.max_rss_kb, run.exit_code, run.status)))
+
+    def add_message(self, job_name, text, t=None):
+        self._q.put((_INSERT_MESSAGE, (job_name, t or time.time(), text)))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is committed."""
+        done = threading.Event()
+        self._q.put(done)
+        return done.wait(timeout)
+
+    def _writer(self):
+        conn = self._connect()
+        next_prune = 0
+        while True:
+            items = [self._q.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.batch_size and \
+                    not isinstance(items[-1], threading.Event):
+                try:
+                    timeout = max(0, deadline - time.monotonic())
+                    items.append(self._q.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            rows = {}
+            for i in items:
+                if not isinstance(i, threading.Event):
+                    rows.setdefault(i[0], []).append(i[1])
+            try:
+                with conn:
+                    for sql, args in rows.items():
+                        conn.executemany(sql, args)
+            except sqlite3.Error as e:
+                print(f'  Failed to write history: {e!r}')
+            if self.retention_days and time.monotonic() >= next_prune:
+                self._prune(conn, self.retention_days)
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+            for i in items:
+                if isinstance(i, threading.Event):
+                    i.set()
+
+    def _prune(self, conn, retention_days):
+        before = time.time() - retention_days * 24 * 3600
+        with conn:
+            # Per job, so deletes use the (job_name, start_time) index.
+            names = [r[0] for r in conn.execute(
+                "SELECT DISTINCT job_name FROM runs")]
+            for name in names:
+                conn.execute("DELETE FROM runs WHERE job_name = ? AND "
+                             "start_time < ?", (name, before))
+            conn.execute("DELETE FROM messages WHERE time < ?", (before,))
+
+    def prune(self, retention_days):
+        with self._connect() as conn:
+            self._prune(conn, retention_days)
+
+    def _query(self, sql, args=()):
+        conn = self._connect()
+        try:
+            return conn.execute(sql, args).fetchall()
+        finally:
+            conn.close()
+
+    def job_names(self):
+        return [r[0] for r in self._query(
+            "SELECT DISTINCT job_name FROM runs ORDER BY job_name")]
+
+    def last_runs(self, name, n=10):
+        rows = self._query(
+            f"SELECT {', '.join(_RUN_COLUMNS)} FROM runs WHERE job_name = ? "
+            "ORDER BY start_time DESC LIMIT ?", (name, n))
+        return [dict(zip(_RUN_COLUMNS, r)) for r in rows]
+
+    def failure_rate(self, name, since=None):
+        """Share of runs since the timestamp that did not end ok."""
+        total, failed = self._query(
+            "SELECT count(*), coalesce(sum(status != 'ok'), 0) FROM runs "
+            "WHERE job_name = ? AND start_time >= ?", (name, since or 0))[0]
+        return failed / total if total else None
+
+    def p95_duration(self, name):
+        """95th percentile of wall time over the kept runs of the job."""
+        n, = self._query("SELECT count(*) FROM runs WHERE job_name = ? "
+                         "AND wall_time IS NOT NULL", (name,))[0]
+        if not n:
+            return None
+        rows = self._query(
+            "SELECT wall_time FROM runs WHERE job_name = ? AND wall_time "
+            "IS NOT NULL ORDER BY wall_time LIMIT 1 OFFSET ?",
+            (name, min(n - 1, int(n * 0.95))))
+        return rows[0][0]
@@ -1,14 +1,44 @@
 from datetime import datetime
 
-from .scheduler import Schedule, TIME_FMT
+from .executor import Overlap
+from .scheduler import CatchUp, Schedule, TIME_FMT
 
 
+class JobInitException(Exception):
+    pass
+
+class JobDependencyCycleException(Exception):
+    pass
+
 class Job:
-    def __init__(self, name, path, params=None, is_active=False):
+    def __init__(self, name, path, params=None, is_active=False,
+                 max_instances=1, overlap=Overlap.skip, timeout=None,
+                 catch_up=CatchUp.skip, jitter=None, triggers=None,
+                 depends_on=None, label=None):
+        if overlap not in Overlap.list():
+            raise JobInitException(f'Incorrect overlap policy ({overlap}).')
+        if max_instances < 1:
+            raise JobInitException('max_instances must be at least 1.')
+        if catch_up not in CatchUp.list():
+            raise JobInitException(f'Incorrect catch up policy ({catch_up}).')
+        if timeout is not None and timeout <= 0:
+            raise JobInitException('timeout must be positive.')
+        if jitter is not None and jitter < 0:
+            raise JobInitException('jitter must not be negative.')
         self.name = name
         self.path = path
         self.params:str = params  # space separated
         self.is_active = is_active
+        self.max_instances = max_instances  # runs of this job at a time
+        self.overlap = overlap  # when max_instances runs are active
+        self.timeout = timeout  # seconds, None runs without a limit
+        self.catch_up = catch_up  # for runs missed while Assistant was down
+        self.jitter = jitter  # seconds, None uses the settings' jitter
+        self.triggers = list(triggers or [])  # events that launch the job
+        self.depends_on = list(depends_on or [])  # upstream job names
+        self.label = label  # runs only on workers with it, see remote
+        if name in self.depends_on:
+            raise JobDependencyCycleException(f'Job {name} depends on itself.')
         self.schedule = []
     def schedule_json(self):
         return [s.json() for s in self.schedule]
@@ -22,8 +52,39 @@ class Job:
 
 def from_cfg(cfg_dict):
     c = cfg_dict
-    j = Job(c["name"], c["path"], c["params"], c["is_active"])
+    j = Job(c["name"], c["path"], c["params"], c["is_active"],
+            c.get("max_instances", 1), c.get("overlap", Overlap.skip),
+            c.get("timeout"), c.get("catch_up", CatchUp.skip),
+            c.get("jitter"), c.get("triggers"), c.get("depends_on"),
+            c.get("label"))
     for s in c["schedule"]:
-        t = datetime.strptime(s["time"], TIME_FMT).time()
-        j.schedule.append(Schedule(t, s["interval"], s["interval_arg"]))
+        t = s["time"] and datetime.strptime(s["time"], TIME_FMT).time()
+        j.schedule.append(Schedule(t, s["interval"], s.get("interval_arg")))
     return j
+
+def check_dependencies(jobs):
+    """Raise JobDependencyCycleException if depends_on of the jobs form a
+    cycle. Dependencies on jobs not in jobs are ignored."""
+    deps = {j.name: j.depends_on for j in jobs}
+    done = set()
+    for root in deps:
+        if root in done:
+            continue
+        stack = [(root, iter(deps[root]))]
+        on_path = {root}
+        while stack:
+            name, it = stack[-1]
+            for d in it:
+                if d in on_path:
+                    cycle = [n for n, _ in stack]
+                    cycle = cycle[cycle.index(d):] + [d]
+                    raise JobDependencyCycleException(
+                        f'Dependency cycle: {" -> ".join(cycle)}')
+                if d in deps and d not in done:
+                    stack.append((d, iter(deps[d])))
+                    on_path.add(d)
+                    break
+            else:
+                stack.pop()
+                on_path.discard(name)
+                done.add(name)
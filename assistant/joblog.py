@@ -0,0 +1,126 @@
+"""Per-job log files for the output of job runs."""
+import collections
+import os
+import selectors
+import threading
+
+# Bytes read from a pipe at a time.
+CHUNK = 64 * 1024
+# Longest line kept for forwarding, longer lines are cut.
+MAX_LINE = 4096
+
+
+def log_path(log_dir, job_name):
+    name = job_name.lower().replace(' ', '_').replace(os.sep, '_')
+    return os.path.join(log_dir, f'{name}.log')
+
+
+class RotatingLog:
+    """Appends to path; once it grows past max_bytes it is renamed to
+    path.1 (path.1 to path.2, ...) keeping at most backups old files.
+    Writes are thread-safe."""
+    def __init__(self, path, max_bytes=1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._f = open(path, 'ab')
+        self._size = self._f.tell()
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes):
+        with self._lock:
+            if self._size and self._size + len(data) > self.max_bytes:
+                self._rotate()
+            self._f.write(data)
+            self._size += len(data)
+
+    def _rotate(self):
+        self._f.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f'{self.path}.{i}'):
+                os.replace(f'{self.path}.{i}', f'{self.path}.{i + 1}')
+        if self.backups:
+            os.replace(self.path, f'{self.path}.1')
+        self._f = open(self.path, 'wb')
+        self._size = 0
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+
+_shared = {}  # {path: [RotatingLog, users]}
+_shared_lock = threading.Lock()
+
+def open_shared(path, max_bytes=1024 * 1024, backups=3):
+    """The RotatingLog of path, one for all concurrent runs of a job so
+    they do not race on rotation. Give it back with close_shared()."""
+    with _shared_lock:
+        if not (entry := _shared.get(path)):
+            entry = _shared[path] = [RotatingLog(path, max_bytes, backups), 0]
+        entry[1] += 1
+        return entry[0]
+
+def close_shared(log):
+    with _shared_lock:
+        entry = _shared[log.path]
+        entry[1] -= 1
+        if not entry[1]:
+            del _shared[log.path]
+            log.close()
+
+
+class _LastLines:
+    """Last n lines of a byte stream, each cut to MAX_LINE bytes."""
+    def __init__(self, n):
+        self.lines = collections.deque(maxlen=n)
+        self._partial = b''
+
+    def feed(self, data):
+        if not self.lines.maxlen:
+            return
+        parts = (self._partial + data).split(b'\n')
+        self._partial = parts.pop()[:MAX_LINE]
+        self.lines.extend(p[:MAX_LINE] for p in parts)
+
+    def result(self):
+        lines = list(self.lines)
+        if self._partial:
+            lines.append(self._partial)
+        return [line.decode(errors='replace') for line in lines]
+
+
+def capture(fds, log, keep_lines=0):
+    """Copy everything from the pipe fds into log until all of them are
+    closed, CHUNK bytes at a time. Returns the last keep_lines lines."""
+    last = _LastLines(keep_lines)
+    with selectors.DefaultSelector() as sel:
+        for fd in fds:
+            sel.register(fd, selectors.EVENT_READ)
+        open_fds = len(fds)
+        while open_fds:
+            for key, _ in sel.select():
+                data = os.read(key.fd, CHUNK)
+                if not data:
+                    sel.unregister(key.fd)
+                    open_fds -= 1
+                    continue
+                log.write(data)
+                last.feed(data)
+    return last.result()
+
+
+def tail(path, n=20, block=8192):
+    """Last n lines of the file, reading backwards from its end."""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = b''
+        while pos and data.count(b'\n') <= n:
+            step = min(block, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.decode(errors='replace').splitlines()
+    return lines[-n:]
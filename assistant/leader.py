@@ -0,0 +1,64 @@
+"""Single active scheduler among Assistants sharing a lock file.
+
+The leader holds an exclusive flock on the file for as long as its process
+lives; the kernel (or the file server, for shared storage) releases it when
+the process or its host dies. Standbys try to take the lock every POLL
+seconds, so one of them takes over well within a second.
+"""
+import fcntl
+import os
+import socket
+import threading
+
+POLL = 0.1
+
+
+class Lease:
+    """Calls on_acquired() once this process holds the lock on path."""
+    def __init__(self, path, on_acquired, interval=POLL):
+        self.path = path
+        self.on_acquired = on_acquired
+        self.interval = interval
+        self._f = None
+        self._stopped = threading.Event()
+
+    @property
+    def is_held(self):
+        return self._f is not None
+
+    def try_acquire(self):
+        f = open(self.path, 'a+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        f.seek(0)
+        f.truncate()
+        f.write(f'{socket.gethostname()}:{os.getpid()}\n')
+        f.flush()
+        self._f = f
+        return True
+
+    def holder(self):
+        """host:pid of the leader, as written by it."""
+        with open(self.path) as f:
+            return f.read().strip()
+
+    def _wait(self):
+        while not self._stopped.is_set():
+            if self.try_acquire():
+                self.on_acquired()
+                return
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        threading.Thread(target=self._wait, daemon=True).start()
+        return self
+
+    def release(self):
+        self._stopped.set()
+        if f := self._f:
+            self._f = None
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
@@ -0,0 +1,387 @@
+"""Broker over a Unix domain socket for single-box setups, no RabbitMQ.
+
+LocalBroker runs in the Assistant process and keeps queues and topic
+exchanges in memory. Clients (Assistant itself, jobs, workers) use
+BlockingConnection, which has the subset of pika's BlockingConnection and
+channel API used by api: queues, topic exchanges, transactions, consumers
+with prefetch and acks. Messages are not persisted.
+
+Frames are (op, a, b) with a and b byte strings:
+    D queue, 0|1      declare a queue, 1 is exclusive: deleted with the
+                      connection
+    X exchange        declare a topic exchange
+    B queue, exchange\\0pattern
+    P exchange\\0routing key, body
+    T , P frames      commit: publish all of the P frames at once
+    Y                 sync, answered with K once everything before is handled
+    Q prefetch        unacked deliveries per connection, 0 is unlimited
+    C queue, 0|1      consume, 1 is auto-ack
+    A delivery tag    ack
+    M delivery tag\\0queue, body   (to the client) delivery
+"""
+import collections
+import os
+import re
+import select
+import socket
+import struct
+import threading
+
+_HEADER = struct.Struct('!cII')
+
+
+class BrokerError(Exception):
+    pass
+
+
+def topic_re(pattern):
+    """Topic binding pattern: '*' is one word, '#' zero or more words."""
+    words = []
+    for w in pattern.split('.'):
+        words.append({'*': r'[^.]+', '#': r'.*'}.get(w, re.escape(w)))
+    return re.compile(r'\.'.join(words).replace(r'\..*', r'(\..*)?')
+                      .replace(r'.*\.', r'(.*\.)?') + '$')
+
+def _frame(op, a=b'', b=b''):
+    return _HEADER.pack(op, len(a), len(b)) + a + b
+
+def _read_frames(sock, buf):
+    """Frames in buf after one recv, and the unparsed rest. EOF raises."""
+    if not (data := sock.recv(65536)):
+        raise BrokerError('Connection closed by the other side.')
+    return _split_frames(buf + data)
+
+def _split_frames(buf):
+    frames = []
+    while len(buf) >= _HEADER.size:
+        op, la, lb = _HEADER.unpack_from(buf)
+        end = _HEADER.size + la + lb
+        if len(buf) < end:
+            break
+        a = buf[_HEADER.size:_HEADER.size + la]
+        frames.append((op, a, buf[_HEADER.size + la:end]))
+        buf = buf[end:]
+    return frames, buf
+
+
+class _Client:
+    """Connection of a client, served by a LocalBroker thread. Outgoing
+    frames are queued and written by a thread of their own, so a client
+    that does not read blocks nobody else."""
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.prefetch = 0
+        self.unacked = {}  # {delivery tag: (queue, body)}
+        self.exclusive = []  # queues deleted when the client disconnects
+        self.tag = 0
+        self._out = collections.deque()
+        self._closed = False
+        self._cv = threading.Condition()
+
+    def send(self, data):
+        with self._cv:
+            self._out.append(data)
+            self._cv.notify()
+
+    def _write(self):
+        while True:
+            with self._cv:
+                while not self._out and not self._closed:
+                    self._cv.wait()
+                if self._closed:
+                    return
+                data = b''.join(self._out)
+                self._out.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                return
+
+    def can_deliver(self, auto_ack):
+        return auto_ack or not self.prefetch or \
+            len(self.unacked) < self.prefetch
+
+    def deliver(self, queue, body, auto_ack):
+        self.tag += 1
+        if not auto_ack:
+            self.unacked[self.tag] = (queue, body)
+        self.send(_frame(b'M', f'{self.tag}\0{queue}'.encode(), body))
+
+    def serve(self):
+        b, buf = self.broker, b''
+        threading.Thread(target=self._write, daemon=True).start()
+        try:
+            while True:
+                frames, buf = _read_frames(self.sock, buf)
+                for op, x, y in frames:
+                    if op == b'P':
+                        exchange, _, key = x.decode().partition('\0')
+                        b.publish(exchange, key, y)
+                    elif op == b'T':
+                        b.commit(_split_frames(y)[0])
+                    elif op == b'A':
+                        b.ack(self, int(x))
+                    elif op == b'D':
+                        b.declare(x.decode())
+                        if y == b'1':
+                            self.exclusive.append(x.decode())
+                    elif op == b'X':
+                        b.exchanges.setdefault(x.decode(), [])
+                    elif op == b'B':
+                        exchange, _, pattern = y.decode().partition('\0')
+                        b.bind(x.decode(), exchange, pattern)
+                    elif op == b'Y':
+                        self.send(_frame(b'K'))
+                    elif op == b'Q':
+                        self.prefetch = int(x)
+                    elif op == b'C':
+                        b.consume(self, x.decode(), y == b'1')
+        except (OSError, BrokerError):
+            pass
+        finally:
+            b.disconnected(self)
+            with self._cv:
+                self._closed = True
+                self._cv.notify()
+            self.sock.close()
+
+
+class LocalBroker:
+    """Serves clients on the Unix socket at path, one thread each."""
+    def __init__(self, path):
+        self.path = path
+        self.queues = collections.defaultdict(collections.deque)
+        self.exchanges = {}  # {name: [(compiled pattern, queue),]}
+        self.consumers = collections.defaultdict(list)  # {queue: [(c, auto)]}
+        self._lock = threading.RLock()
+        self._clients = []
+        self._sock = None
+
+    def start(self):
+        """Listen on path; a socket file nobody listens on is replaced."""
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)  # left by a previous run
+            else:
+                raise BrokerError(f'A broker is running at {self.path}.')
+            finally:
+                probe.close()
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        self._sock.listen(64)
+        threading.Thread(target=self._accept, args=(self._sock,),
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop listening and drop every client connection."""
+        if sock := self._sock:
+            self._sock = None
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+            os.unlink(self.path)
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for c in clients:
+            try:
+                c.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _accept(self, lsock):
+        while True:
+            try:
+                s, _ = lsock.accept()
+            except OSError:
+                return
+            c = _Client(self, s)
+            with self._lock:
+                self._clients.append(c)
+            threading.Thread(target=c.serve, daemon=True).start()
+
+    def declare(self, queue):
+        with self._lock:
+            self.queues[queue]
+
+    def bind(self, queue, exchange, pattern):
+        with self._lock:
+            self.exchanges.setdefault(exchange, []).append(
+                (topic_re(pattern), queue))
+
+    def publish(self, exchange, routing_key, body):
+        with self._lock:
+            if exchange:
+                queues = {q for p, q in self.exchanges.get(exchange, [])
+                          if p.match(routing_key)}
+            else:
+                # Like RabbitMQ, drop messages for queues never declared.
+                queues = [routing_key] if routing_key in self.queues else []
+            for queue in queues:
+                self.queues[queue].append(body)
+                self._dispatch(queue)
+
+    def commit(self, frames):
+        with self._lock:
+            for _, x, y in frames:
+                exchange, _, key = x.decode().partition('\0')
+                self.publish(exchange, key, y)
+
+    def consume(self, client, queue, auto_ack):
+        with self._lock:
+            self.consumers[queue].append((client, auto_ack))
+            self._dispatch(queue)
+
+    def ack(self, client, tag):
+        with self._lock:
+            if client.unacked.pop(tag, None):
+                # The freed slot may go to any queue of the client.
+                for queue in list(self.queues):
+                    self._dispatch(queue)
+
+    def disconnected(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            for queue, body in reversed(list(client.unacked.values())):
+                self.queues[queue].appendleft(body)
+            client.unacked.clear()
+            for queue, consumers in self.consumers.items():
+                consumers[:] = [c for c in consumers if c[0] is not client]
+            for queue in client.exclusive:
+                self.queues.pop(queue, None)
+                self.consumers.pop(queue, None)
+                for bindings in self.exchanges.values():
+                    bindings[:] = [b for b in bindings if b[1] != queue]
+            for queue in list(self.queues):
+                self._dispatch(queue)
+
+    def _dispatch(self, queue):
+        pending = self.queues[queue]
+        consumers = self.consumers[queue]
+        progress = True
+        while pending and progress:
+            progress = False
+            for c, auto_ack in consumers:
+                if pending and c.can_deliver(auto_ack):
+                    c.deliver(queue, pending.popleft(), auto_ack)
+                    progress = True
+
+
+class _Method:
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
+
+
+class BlockingConnection:
+    """Client connection to a LocalBroker, also its only channel. Like
+    pika's, it is not thread-safe apart from add_callback_threadsafe."""
+    def __init__(self, path):
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(path)
+        except OSError as e:
+            self._sock.close()
+            raise BrokerError(f'No local broker at {path}: {e}') from e
+        self._buf = b''
+        self._consumers = {}  # {queue: callback}
+        self._tx = None  # P frames of the transaction
+        self._synced = False
+        self._callbacks = collections.deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self.is_open = True
+
+    def channel(self):
+        return self
+
+    def _send(self, op, a=b'', b=b''):
+        try:
+            self._sock.sendall(_frame(op, a, b))
+        except OSError as e:
+            self.close()
+            raise BrokerError(str(e)) from e
+
+    def _sync(self):
+        self._send(b'Y')
+        self._synced = False
+        while not self._synced:
+            self.process_data_events(None)
+
+    def queue_declare(self, queue, exclusive=False, auto_delete=False):
+        self._send(b'D', queue.encode(), b'1' if exclusive else b'0')
+        self._sync()
+
+    def exchange_declare(self, exchange, exchange_type='topic'):
+        self._send(b'X', exchange.encode())
+        self._sync()
+
+    def queue_bind(self, queue, exchange, routing_key):
+        self._send(b'B', queue.encode(), f'{exchange}\0{routing_key}'.encode())
+        self._sync()
+
+    def tx_select(self):
+        self._tx = []
+
+    def tx_commit(self):
+        self._send(b'T', b'', b''.join(self._tx))
+        self._tx.clear()
+        self._sync()
+
+    def basic_publish(self, exchange, routing_key, body):
+        if isinstance(body, str):
+            body = body.encode()
+        if self._tx is not None:
+            self._tx.append(_frame(b'P', f'{exchange}\0{routing_key}'.encode(),
+                                   body))
+            return
+        self._send(b'P', f'{exchange}\0{routing_key}'.encode(), body)
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        self._send(b'Q', str(prefetch_count).encode())
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self._consumers[queue] = (on_message_callback, auto_ack)
+        self._send(b'C', queue.encode(), b'1' if auto_ack else b'0')
+
+    def basic_ack(self, delivery_tag):
+        self._send(b'A', str(delivery_tag).encode())
+
+    def add_callback_threadsafe(self, callback):
+        self._callbacks.append(callback)
+        self._wake_w.send(b'x')
+
+    def process_data_events(self, time_limit=0):
+        if not self.is_open:
+            raise BrokerError('Connection is closed.')
+        r, _, _ = select.select([self._sock, self._wake_r], [], [], time_limit)
+        if self._wake_r in r:
+            self._wake_r.recv(4096)
+            while self._callbacks:
+                self._callbacks.popleft()()
+        if self._sock in r:
+            try:
+                frames, self._buf = _read_frames(self._sock, self._buf)
+            except (OSError, BrokerError) as e:
+                self.close()
+                raise BrokerError(f'Connection lost: {e}') from e
+            for op, a, b in frames:
+                if op == b'K':
+                    self._synced = True
+                elif op == b'M':
+                    tag, _, queue = a.decode().partition('\0')
+                    callback, _ = self._consumers[queue]
+                    callback(self, _Method(int(tag)), None, b)
+
+    def start_consuming(self):
+        while self.is_open:
+            self.process_data_events(None)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self._sock.close()
+            self._wake_r.close()
+            self._wake_w.close()
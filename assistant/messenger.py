@@ -1,50 +1,206 @@
+import json
+import os
+import threading
+import urllib.error
+
 import slack_sdk
+from slack_sdk.errors import SlackApiError
+
+from .ratelimit import RateLimitedException, RateLimiter
+
+# (requests per second, burst) per Web API method, following Slack's tiers
+# (tier 2: 20/min, tier 3: 50/min, tier 4: 100/min). chat.postMessage is
+# limited to about one message per second per channel.
+SLACK_RATE_LIMITS = {
+    'api.test': (100 / 60, 5),
+    'conversations.list': (20 / 60, 3),
+    'conversations.create': (20 / 60, 3),
+    'conversations.invite': (50 / 60, 3),
+    'chat.postMessage': (1, 3),
+    'files.upload_v2': (20 / 60, 3),
+}
+SLACK_PER_CHANNEL_METHODS = ['chat.postMessage']
 
 class SlackConnectionException(Exception):
     pass
 
-def _is_slack_connection_ok():
-    if api_response := slack_sdk.WebClient(token="").api_test():
+def _is_slack_connection_ok(client=None):
+    client = client or slack_sdk.WebClient(token="")
+    if api_response := client.api_test():
         return api_response.data["ok"]
 
 def _slack_channels(client):
-    try:
-        res = client.conversations_list()
-        if res.data['ok']:
-            return [ch['name'] for ch in res.data['channels']]
-    except:
-        pass
+    """{name: id} of all channels, following conversations_list cursors."""
+    channels = {}
+    cursor = None
+    while True:
+        res = client.conversations_list(cursor=cursor, limit=1000)
+        for ch in res.data['channels']:
+            channels[ch['name']] = ch['id']
+        cursor = res.data.get('response_metadata', {}).get('next_cursor')
+        if not cursor:
+            return channels
 
 def _slack_invite(client, channel, users):
     client.conversations_invite(channel=channel, users=users)
 
+def _slack_error(e):
+    return e.response.get('error') if e.response else None
+
 class MessengerClientAuthSetupException(Exception):
     pass
 
 def _to_slack_channel_name(job_name):
     return job_name.lower().replace(' ', '_')
 
-def _slack_prepare_channel(client, user_id, job_name):
+class ChannelRegistry:
+    """Channel name -> id map. The workspace is listed once, then the map is
+    updated by created channels and dropped when Slack reports it stale.
+    If path is set, the map is kept in that json file between restarts."""
+    def __init__(self, path=None):
+        self.path = path
+        self._ids = None
+        self._lock = threading.Lock()
+
+    def _read_file(self):
+        if self.path and os.path.exists(self.path):
+            with open(self.path) as f:
+                return json.load(f)
+
+    def _write_file(self):
+        if self.path:
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wt') as f:
+                json.dump(self._ids, f)
+            os.replace(tmp, self.path)
+
+    def channel_id(self, client, name):
+        with self._lock:
+            if self._ids is None:
+                self._ids = self._read_file()
+                if self._ids is None:
+                    self._ids = _slack_channels(client)
+                    self._write_file()
+            return self._ids.get(name)
+
+    def add(self, name, channel_id):
+        with self._lock:
+            if self._ids is not None:
+                self._ids[name] = channel_id
+                self._write_file()
+
+    def invalidate(self):
+        with self._lock:
+            self._ids = None
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+def _slack_prepare_channel(client, user_id, job_name, registry):
     name = _to_slack_channel_name(job_name)
-    channels = _slack_channels(client)
-    if not name in channels:
+    if ch_id := registry.channel_id(client, name):
+        return ch_id
+    try:
         res = client.conversations_create(name=name, is_private=False)
-        ch_id = res.data['channel']['id']
-        _slack_invite(client, channel=ch_id, users=[user_id])
-    return name
+    except SlackApiError as e:
+        if _slack_error(e) != 'name_taken':
+            raise
+        # Created elsewhere since the workspace was listed.
+        registry.invalidate()
+        if ch_id := registry.channel_id(client, name):
+            return ch_id
+        raise
+    ch_id = res.data['channel']['id']
+    registry.add(name, ch_id)
+    _slack_invite(client, channel=ch_id, users=[user_id])
+    return ch_id
 
-def _slack_send(client, user_id, payload):
-    job_name = payload.get('job_name')
+def _slack_post(client, channel, payload):
     text = payload.get('text')
-    channel = _slack_prepare_channel(client, user_id, job_name)
-    client.chat_postMessage(channel=channel, text=text)
+    if payload.get('as_file'):
+        name = _to_slack_channel_name(payload.get('job_name'))
+        client.files_upload_v2(channel=channel, content=text,
+                               filename=f'{name}.txt', title=name)
+    else:
+        client.chat_postMessage(channel=channel, text=text)
+
+def _slack_send(client, user_id, payload, registry):
+    job_name = payload.get('job_name')
+    channel = _slack_prepare_channel(client, user_id, job_name, registry)
+    try:
+        _slack_post(client, channel, payload)
+    except SlackApiError as e:
+        if _slack_error(e) != 'channel_not_found':
+            raise
+        registry.invalidate()
+        channel = _slack_prepare_channel(client, user_id, job_name, registry)
+        _slack_post(client, channel, payload)
+
+class _RateLimitedClient:
+    """Proxies WebClient API calls through the rate limiter. A 429 response
+    pauses the method's bucket and raises RateLimitedException."""
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        call = getattr(self._client, name)
+        method = name.replace('_', '.', 1)  # chat_postMessage -> chat.postMessage
+
+        def limited(**kwargs):
+            channel = kwargs.get('channel')
+            self._limiter.acquire(method, channel)
+            try:
+                return call(**kwargs)
+            except SlackApiError as e:
+                if e.response.status_code != 429:
+                    raise
+                retry_after = int(e.response.headers.get('Retry-After', 1))
+                self._limiter.pause(method, retry_after, channel)
+                raise RateLimitedException(retry_after) from e
+        return limited
+
+class SlackSession:
+    """Long-lived client for one token. The connection check (api.test)
+    runs only after a send failed to reach Slack, not for every message."""
+    def __init__(self, token, user_id, base_url=None, channels_file=None):
+        kwargs = {'base_url': base_url} if base_url else {}
+        self.client = slack_sdk.WebClient(token, **kwargs)
+        self.api = _RateLimitedClient(self.client, RateLimiter(
+            SLACK_RATE_LIMITS, per_key=SLACK_PER_CHANNEL_METHODS))
+        self.user_id = user_id
+        self.channels = ChannelRegistry(channels_file)
+        self.is_connection_ok = True
+
+    def check_connection(self):
+        try:
+            self.is_connection_ok = bool(_is_slack_connection_ok(self.api))
+        except urllib.error.URLError:
+            self.is_connection_ok = False
+        return self.is_connection_ok
+
+    def send(self, payload):
+        if not self.is_connection_ok and not self.check_connection():
+            raise SlackConnectionException()
+        try:
+            _slack_send(self.api, self.user_id, payload, self.channels)
+        except urllib.error.URLError as e:
+            self.is_connection_ok = False
+            raise SlackConnectionException() from e
+
+_sessions = {}  # {(token, user_id, base_url, channels_file): SlackSession}
+_sessions_lock = threading.Lock()
+
+def _slack_session(cfg):
+    key = (cfg.get('token'), cfg.get('user_id'), cfg.get('base_url'),
+           cfg.get('channels_file'))
+    with _sessions_lock:
+        if not (session := _sessions.get(key)):
+            session = _sessions[key] = SlackSession(*key)
+    return session
 
 def _slack_send_message_main(cfg, payload):
-    if not _is_slack_connection_ok():
-        raise SlackConnectionException()
-    if token := cfg.get('token'):
-        client = slack_sdk.WebClient(token)
-        _slack_send(client, cfg.get('user_id'), payload)
+    if cfg.get('token'):
+        _slack_session(cfg).send(payload)
     else:
         raise MessengerClientAuthSetupException('Missing messanger token')
 
@@ -0,0 +1,72 @@
+import threading
+import time
+
+
+class RateLimitedException(Exception):
+    """The remote side asked to retry after retry_after seconds."""
+    def __init__(self, retry_after):
+        super().__init__(f'Rate limited, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """rate tokens per second, up to capacity tokens saved for bursts."""
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._t = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._t) * self.rate)
+        self._t = now
+
+    def try_acquire(self):
+        """Take a token, or return seconds to wait until one is available."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while wait := self.try_acquire():
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Empty the bucket so the next token is available in seconds."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+class RateLimiter:
+    """Token buckets per method, and per method and key (e.g. channel) for
+    methods listed in per_key."""
+    def __init__(self, limits, per_key=(), default=None):
+        self.limits = limits  # {method: (rate, capacity)}
+        self.per_key = set(per_key)
+        self.default = default
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, method, key=None):
+        if method not in self.per_key:
+            key = None
+        with self._lock:
+            if not (b := self._buckets.get((method, key))):
+                if not (limit := self.limits.get(method, self.default)):
+                    return None
+                b = self._buckets[(method, key)] = TokenBucket(*limit)
+        return b
+
+    def acquire(self, method, key=None):
+        if b := self.bucket(method, key):
+            b.acquire()
+
+    def pause(self, method, seconds, key=None):
+        if b := self.bucket(method, key):
+            b.pause(seconds)
@@ -0,0 +1,201 @@
+"""Runs of jobs on other nodes over RabbitMQ work queues.
+
+The scheduling Assistant publishes "run job X" commands instead of running
+jobs itself; `assistant worker` nodes consume them and run the jobs. A job
+with a label goes to the "<PIKA_JOBS_QUEUE>.<label>" queue, consumed only by
+workers started with that label, any other job to PIKA_JOBS_QUEUE, consumed
+by every worker. A worker takes at most capacity commands at a time (its
+prefetch) and acks one only when the run is over, so the commands of a
+worker that dies go to the other workers.
+
+Every Dispatcher has its own exclusive reply queue, named in each command
+(reply_to), for the results. Workers announce their capacity and labels on
+PIKA_WORKERS_EXCHANGE every HELLO_INTERVAL seconds, to every Dispatcher.
+"""
+import concurrent.futures
+from datetime import datetime
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from . import api
+from . import executor
+from . import job
+
+HELLO_INTERVAL = 30
+# Seconds between checks for pending commands without a result.
+EXPIRE_CHECK = 1
+# Seconds to wait for the reply queue before publishing a command.
+READY_TIMEOUT = 5
+
+
+def jobs_queue(label=None):
+    return f'{api.PIKA_JOBS_QUEUE}.{label}' if label else api.PIKA_JOBS_QUEUE
+
+def _apply_result(run, d):
+    """Copy the json of a Run finished on a worker into run."""
+    run.start_time = d['start_time'] and datetime.fromisoformat(
+        d['start_time'])
+    for k in ('start_latency', 'wall_time', 'cpu_time', 'max_rss_kb',
+              'exit_code'):
+        setattr(run, k, d[k])
+    run.killed = d['status'] == executor.RunStatus.killed
+    run.timed_out = d['status'] == executor.RunStatus.timeout
+
+
+class Worker:
+    """Consumes run commands and runs the jobs with runner(job, run)."""
+    def __init__(self, runner, labels=(), capacity=4):
+        self.id = f'{socket.gethostname()}:{os.getpid()}'
+        self.labels = list(labels)
+        self.capacity = capacity
+        self.executor = executor.JobExecutor(runner, capacity)
+        self._results = api.Publisher(queue=None)
+        self._hello = api.Publisher(exchange=api.PIKA_WORKERS_EXCHANGE)
+
+    def _reply(self, cmd, run):
+        msg = {'type': 'result', 'id': cmd['id'], 'worker': self.id,
+               'run': run}
+        self._results.publish(json.dumps(msg), routing_key=cmd['reply_to'])
+
+    def _on_command(self, body):
+        cmd = json.loads(body)
+        if cmd['expires'] < time.time():
+            print(f'  Command for <{cmd["job"]["name"]}> expired, dropped.')
+            return None
+        f = concurrent.futures.Future()
+
+        def _done(run):
+            self._reply(cmd, run.json())
+            f.set_result(run)
+
+        if not self.executor.fire(job.from_cfg(cmd['job']), cmd['event'],
+                                  _done):
+            # Skipped or queued here by the job's overlap policy.
+            if cmd['job']['overlap'] == executor.Overlap.queue:
+                return f
+            self._reply(cmd, None)
+            return None
+        return f
+
+    def _announce(self):
+        while True:
+            try:
+                self._hello.publish(json.dumps({'type': 'hello',
+                    'worker': self.id, 'labels': self.labels,
+                    'capacity': self.capacity}), routing_key=self.id)
+            except api.PublishException as e:
+                print(f'  Failed to announce the worker: {e!r}')
+            time.sleep(HELLO_INTERVAL)
+
+    def run(self):
+        """Announce the worker and consume commands, blocks."""
+        threading.Thread(target=self._announce, daemon=True).start()
+        queues = [jobs_queue(l) for l in self.labels] + [jobs_queue()]
+        api.receiver(self._on_command, prefetch=self.capacity,
+                     workers=self.capacity, queues=queues)
+
+
+class Dispatcher:
+    """Fires jobs on workers, a JobExecutor stand-in for the scheduling
+    Assistant. fire() returns a Run that is filled in when the worker's
+    result arrives; then on_done(run) and done(run) are called.
+
+    A command without a result after result_timeout seconds is given up:
+    done(run) is called with the run unfinished, and a worker still
+    holding the command drops it.
+
+    Overlap is only handled here for skip: a fire is skipped while
+    max_instances runs of the job are in flight on any worker. Other
+    policies apply per worker.
+    """
+    def __init__(self, on_done=None, result_timeout=3600):
+        self.on_done = on_done
+        self.result_timeout = result_timeout
+        self.reply_to = f'{api.PIKA_RESULTS_QUEUE}.{uuid.uuid4().hex}'
+        self.workers = {}  # {worker id: {'labels', 'capacity', 'seen'}}
+        self._pending = {}  # {command id: (run, done, expires)}
+        self._publishers = {}  # {queue: Publisher}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        threading.Thread(target=api.event_receiver, args=(self._on_result,),
+            kwargs={'exchange': api.PIKA_WORKERS_EXCHANGE,
+                    'queue': self.reply_to, 'exclusive': True,
+                    'ready': self._ready}, daemon=True).start()
+        threading.Thread(target=self._expire_loop, daemon=True).start()
+
+    def active(self, name):
+        with self._lock:
+            return self._active(name)
+
+    def _active(self, name):
+        return [r for r, _, _ in self._pending.values() if r.job_name == name]
+
+    def _publisher(self, queue):
+        with self._lock:
+            if not (p := self._publishers.get(queue)):
+                p = api.Publisher(queue=queue, confirm=True)
+                self._publishers[queue] = p
+            return p
+
+    def fire(self, job, event=None, done=None):
+        expires = time.time() + self.result_timeout
+        with self._lock:
+            if (job.overlap == executor.Overlap.skip
+                    and len(self._active(job.name)) >= job.max_instances):
+                print(f'  Job <{job.name}> is still running, skipping.')
+                return None
+            r = executor.Run(job.name, event)
+            cmd_id = uuid.uuid4().hex
+            self._pending[cmd_id] = (r, done, expires)
+        cmd = {'id': cmd_id, 'job': job.json(), 'event': event,
+               'reply_to': self.reply_to, 'expires': expires}
+        self._ready.wait(READY_TIMEOUT)
+        self._publisher(jobs_queue(job.label)).publish(json.dumps(cmd))
+        return r
+
+    def _expire_loop(self):
+        while True:
+            time.sleep(EXPIRE_CHECK)
+            self._expire(time.time())
+
+    def _expire(self, now):
+        with self._lock:
+            expired = [(i, p) for i, p in self._pending.items() if p[2] < now]
+            for i, _ in expired:
+                del self._pending[i]
+        for _, (r, done, _) in expired:
+            print(f'  No result for <{r.job_name}> within '
+                  f'{self.result_timeout}s, giving up.')
+            if done:
+                done(r)
+
+    def _on_result(self, body):
+        msg = json.loads(body)
+        if msg['type'] == 'hello':
+            if msg['worker'] not in self.workers:
+                print(f'  Worker {msg["worker"]} joined (labels '
+                      f'{msg["labels"]}, capacity {msg["capacity"]}).')
+            self.workers[msg['worker']] = {'labels': msg['labels'],
+                'capacity': msg['capacity'], 'seen': time.time()}
+            return
+        with self._lock:
+            if not (pending := self._pending.pop(msg['id'], None)):
+                return  # given up on
+        r, done, _ = pending
+        if msg['run']:
+            _apply_result(r, msg['run'])
+            if self.on_done and r.wall_time is not None:
+                self.on_done(r)
+        else:
+            print(f'  Job <{r.job_name}> is still running on '
+                  f'{msg["worker"]}, skipped.')
+        if done:
+            done(r)
+
+    def shutdown(self):
+        for p in self._publishers.values():
+            p.close()
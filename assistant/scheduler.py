@@ -1,16 +1,24 @@
 import datetime
-import schedule
-import time
+import heapq
+import itertools
+import json
+import os
 import threading
+import time
+import zlib
+
+from . import cron
 
 
 class Interval:
     daily = "daily"
     workdays = "workdays"
     weekday = "weekday"
+    cron = "cron"  # interval_arg is a cron expression
+    every = "every"  # interval_arg like "15s", "5m between 08:00 and 18:00"
     @staticmethod
     def list():
-        return ["daily", "workdays", "weekday"]
+        return ["daily", "workdays", "weekday", "cron", "every"]
 
 class Day:
     Sunday = "Sunday"
@@ -34,6 +42,11 @@ _intervals = {
     Interval.workdays: [],
     Interval.weekday: Day.list()
 }
+# Intervals compiled from interval_arg, their schedules have no time.
+_compiled = {
+    Interval.cron: cron.Cron,
+    Interval.every: cron.Every
+}
 
 class ScheduleInitException(Exception):
     pass
@@ -41,91 +54,453 @@ class ScheduleInitException(Exception):
 TIME_FMT = "%H:%M:%S"
 
 class Schedule:
-    """Schedule time, interval and interval argument if needed."""
+    """Schedule time, interval and interval argument if needed. cron and
+    every schedules take no time, interval_arg is compiled instead."""
     def __init__(self, time: datetime.time, interval: str, interval_arg=None):
-        if _intervals[interval]:
-            if not interval_arg in _intervals[interval]:
-                raise ScheduleInitException("Incorrect interval argument.")
+        if interval in _compiled:
+            if time is not None:
+                raise ScheduleInitException(f"{interval} takes no time.")
+            try:
+                rule = _compiled[interval](interval_arg or "")
+            except cron.CronSyntaxException as e:
+                raise ScheduleInitException(str(e)) from e
         else:
-            if interval_arg:
-                raise ScheduleInitException("Incorrect interval argument.")
-        if not isinstance(time, datetime.time):
-            raise ScheduleInitException("Time must be datetime.time")
+            if _intervals[interval]:
+                if not interval_arg in _intervals[interval]:
+                    raise ScheduleInitException("Incorrect interval argument.")
+            else:
+                if interval_arg:
+                    raise ScheduleInitException("Incorrect interval argument.")
+            if not isinstance(time, datetime.time):
+                raise ScheduleInitException("Time must be datetime.time")
+            rule = _DaysAt(_schedule_days(interval, interval_arg), time)
         self.time = time
         self.interval = interval
         self.interval_arg = interval_arg
+        self.rule = rule  # rule.next_after(dt) -> next fire time
     def time_str(self, fmt=TIME_FMT):
-        return self.time.strftime(fmt)
+        return self.time and self.time.strftime(fmt)
     def json(self):
-        r = self.__dict__.copy()
-        r["time"] = self.time_str()
-        return r
+        return {"time": self.time_str(), "interval": self.interval,
+                "interval_arg": self.interval_arg}
+
+
+class CatchUp:
+    """What to do with fires missed while the machine was asleep or
+    Assistant was not running."""
+    skip = "skip"
+    once = "once"
+    all = "all"
+    @staticmethod
+    def list():
+        return ["skip", "once", "all"]
 
 
 class Event:
-    def __init__(self, name, schedule):
+    """jitter (seconds) delays every fire by a stable offset within it,
+    derived from the name, so events of a busy slot are spread out."""
+    def __init__(self, name, schedule, catch_up=CatchUp.skip, jitter=0):
         self.name = name
         self.schedule = schedule
+        self.catch_up = catch_up
+        self.jitter = jitter
+
+    def offset(self):
+        ms = int(self.jitter * 1000)
+        return datetime.timedelta(
+            milliseconds=zlib.crc32(self.name.encode()) % ms if ms else 0)
+
+
+def _event_key(event):
+    return f'{event.name} {json.dumps(event.schedule.json(), sort_keys=True)}'
+
+class Watermarks:
+    """Time of the last handled fire per event: every fire up to it was
+    run or deliberately skipped. If path is set, watermarks are kept in that
+    json file between restarts."""
+    def __init__(self, path=None):
+        # Saves happen later on the engine thread, whatever the cwd is then.
+        self.path = path and os.path.abspath(path)
+        self._marks = {}  # {event key: datetime}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        """Read the file again, e.g. after another Assistant wrote it."""
+        with self._lock:
+            if self.path and os.path.exists(self.path):
+                with open(self.path) as f:
+                    self._marks = {k: datetime.datetime.fromisoformat(v)
+                                   for k, v in json.load(f).items()}
+            self._dirty = False
+
+    def get(self, key):
+        with self._lock:
+            return self._marks.get(key)
+
+    def set(self, key, dt):
+        with self._lock:
+            self._marks[key] = dt
+            self._dirty = True
 
+    def discard(self, key):
+        with self._lock:
+            if self._marks.pop(key, None):
+                self._dirty = True
 
-def _schedule_run_pending(_schedule):
-    while True:
-        _schedule.run_pending()
-        time.sleep(1)
+    def save(self):
+        with self._lock:
+            if not (self.path and self._dirty):
+                return
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wt') as f:
+                json.dump({k: v.isoformat() for k, v in self._marks.items()},
+                          f)
+            os.replace(tmp, self.path)
+            self._dirty = False
 
-def _run_event_non_blocking(runner, arg, name):
-    t = threading.Thread(group=None, target=runner, args=(arg, name),
-        daemon=True)
-    t.start()
 
-def _scheduler_runner(*args):
-    sched, event = args[0]
-    _run_event_non_blocking(sched.job_runner, sched.job_runner_arg, event.name)
+_weekday_num = {day: i for i, day in enumerate(
+    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday",
+     "Sunday"])}
+
+def _schedule_days(interval, interval_arg):
+    """Weekdays (Monday is 0) on which the schedule fires."""
+    if interval == Interval.daily:
+        return frozenset(range(7))
+    if interval == Interval.workdays:
+        return frozenset(_weekday_num[d] for d in Day.workDays())
+    return frozenset([_weekday_num[interval_arg]])
+
+class _DaysAt:
+    """Fires at time on the weekdays in days."""
+    def __init__(self, days, time):
+        self.days = days
+        self.time = time
+
+    def next_after(self, dt):
+        """First fire time strictly after dt."""
+        for i in range(8):
+            day = dt.date() + datetime.timedelta(days=i)
+            if day.weekday() in self.days:
+                run = datetime.datetime.combine(day, self.time)
+                if run > dt:
+                    return run
+
+class _Entry:
+    """Event in the engine's heap, next_run is its next fire time. seq
+    identifies the entry's live heap item, None when it is not scheduled
+    (cancelled or paused)."""
+    __slots__ = ('event', 'key', 'rule', 'offset', 'next_run', 'seq')
+    def __init__(self, event):
+        self.event = event
+        self.key = _event_key(event)
+        self.rule = event.schedule.rule
+        self.offset = event.offset()
+        self.next_run = None
+        self.seq = None
+
+    @property
+    def is_scheduled(self):
+        return self.seq is not None
+
+    def next_after(self, dt):
+        """First fire time strictly after dt, None if there is none."""
+        t = self.rule.next_after(dt - self.offset)
+        return t and t + self.offset
+
+    def missed_fires(self, now, limit):
+        """Number of fires from next_run up to now, at most limit."""
+        n, t = 0, self.next_run
+        while t and t <= now and n < limit:
+            n += 1
+            t = self.next_after(t)
+        return n
+
+# Upper bound for a single sleep, so wall clock changes are noticed.
+MAX_SLEEP = 60
+# Rebuild the heap once more than half of it (and more than this) is
+# stale items of cancelled or paused entries.
+COMPACT_MIN = 64
+# A fire found due later than this (seconds), or within a forward jump of
+# the wall clock (suspend, clock change) larger than JUMP, was missed and
+# is handled by the event's CatchUp policy.
+MISSED_AFTER = 60
+JUMP = 5
+# Upper bound of fires replayed at once by CatchUp.all.
+MAX_CATCH_UP = 100
+# Seconds the marks of added entries wait to be saved, so loading many
+# jobs writes the state file once.
+SAVE_DELAY = 1
+
+def _is_live(item):
+    return item[1] == item[2].seq
+
+class _Engine:
+    """Min-heap of entries ordered by next run time. The engine thread
+    sleeps on a condition until the earliest deadline; adding an entry or
+    clearing the engine wakes it. Removed entries leave stale heap items,
+    which are dropped lazily when they reach the top of the heap.
+
+    Handled fires move the event's watermark. An entry added with catch_up
+    starts from its watermark, so fires missed while Assistant was down are
+    found due at once and handled by the event's CatchUp policy.
+
+    Marks of handled fires are saved before firing. Marks set by add()
+    are saved by the engine thread SAVE_DELAY seconds later, together.
+
+    An inactive (standby) engine keeps its heap up to date but neither
+    fires nor moves watermarks. take_over() restarts every entry from the
+    watermarks the previous active engine saved, which it does before
+    firing, so a fire is not repeated by the engine taking over."""
+    def __init__(self, fire, watermarks=None, active=True):
+        self._fire = fire  # fire(event), called outside of the lock
+        self.watermarks = watermarks or Watermarks()
+        self.active = active
+        self._heap = []  # [(next_run, seq, entry),]
+        self._seq = itertools.count()
+        self._stale = 0
+        self._stopped = False
+        self._save_at = None  # monotonic time of the delayed save
+        self._cv = threading.Condition()
+        self._t = threading.Thread(group=None, target=self._run, daemon=True)
+        self._t.start()
+
+    def __len__(self):
+        return len(self._heap) - self._stale
+
+    def add(self, entry, now=None, catch_up=False):
+        """Schedule entry (again) from its next fire time after now, or
+        after its watermark if catch_up is set."""
+        with self._cv:
+            if entry.is_scheduled:
+                return
+            self._start_from_mark(entry, now or datetime.datetime.now(),
+                                  catch_up)
+            self._push(entry)
+            self._save_later()
+            if entry.is_scheduled and self._heap[0][2] is entry:
+                self._cv.notify()
+
+    def _start_from_mark(self, entry, now, catch_up):
+        mark = self.watermarks.get(entry.key)
+        if mark and (catch_up or mark > now):
+            entry.next_run = entry.next_after(mark)
+        else:
+            # Fires up to now are not due, e.g. for a resumed event.
+            entry.next_run = entry.next_after(now)
+            self.watermarks.set(entry.key, now)
+
+    def _save_later(self):
+        if self._save_at is None:
+            self._save_at = time.monotonic() + SAVE_DELAY
+            self._cv.notify()
+
+    def _save(self):
+        # A standby must not overwrite the marks of the active engine.
+        if self.active:
+            self.watermarks.save()
+        self._save_at = None
+
+    def take_over(self, now=None):
+        """Become active, continuing from the saved watermarks."""
+        with self._cv:
+            self.watermarks.reload()
+            now = now or datetime.datetime.now()
+            entries = [i[2] for i in self._heap if _is_live(i)]
+            self._heap = []
+            for e in entries:
+                self._start_from_mark(e, now, catch_up=True)
+                self._push(e)
+            self._stale = 0
+            self.active = True
+            self._save()
+            self._cv.notify()
+
+    def _push(self, entry):
+        if entry.next_run is None:
+            # The rule has no fire time left; the engine must not stop.
+            entry.seq = None
+            print(f'  <{entry.event.name}> does not fire any more, '
+                  'unscheduled.')
+            return
+        entry.seq = next(self._seq)
+        heapq.heappush(self._heap, (entry.next_run, entry.seq, entry))
+
+    def remove(self, entry):
+        with self._cv:
+            if entry.is_scheduled:
+                entry.seq = None
+                self._stale += 1
+                if self._stale > COMPACT_MIN and \
+                        self._stale * 2 > len(self._heap):
+                    self._compact()
+
+    def discard_mark(self, entry):
+        """Forget the watermark of a cancelled entry."""
+        with self._cv:
+            self.watermarks.discard(entry.key)
+            self._save_later()
+
+    def _compact(self):
+        self._heap = [i for i in self._heap if _is_live(i)]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    def clear(self):
+        with self._cv:
+            for item in self._heap:
+                item[2].seq = None
+            self._heap.clear()
+            self._stale = 0
+            if self._save_at is not None:
+                self._save()
+            self._stopped = True
+            self._cv.notify()
+
+    def _top(self):
+        while self._heap and not _is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+            self._stale -= 1
+        return self._heap[0][2] if self._heap else None
+
+    def next_run(self):
+        with self._cv:
+            if e := self._top():
+                return e.next_run
+
+    def _fires(self, e, now, jumped_from):
+        """Number of times to fire the due entry."""
+        late = (now - e.next_run).total_seconds() > MISSED_AFTER
+        if not late and not (jumped_from and e.next_run > jumped_from):
+            return 1
+        if e.event.catch_up == CatchUp.skip:
+            return 0
+        if e.event.catch_up == CatchUp.once:
+            return 1
+        return e.missed_fires(now, MAX_CATCH_UP)
+
+    def _pop_due(self, now, jumped_from=None):
+        due, handled = [], False
+        while (e := self._top()) and e.next_run <= now:
+            heapq.heappop(self._heap)
+            if not self.active:
+                e.next_run = e.next_after(now)
+                self._push(e)
+                continue
+            if n := self._fires(e, now, jumped_from):
+                due.append((e, n))
+            else:
+                print(f'  Skipping missed run of <{e.event.name}> '
+                      f'({e.next_run}).')
+            self.watermarks.set(e.key, now)
+            handled = True
+            e.next_run = e.next_after(now)
+            self._push(e)
+        if handled:
+            # Before firing, and also when every due fire was skipped.
+            self._save()
+        return due
+
+    def _run(self):
+        wall, mono = datetime.datetime.now(), time.monotonic()
+        while True:
+            with self._cv:
+                while True:
+                    if self._stopped:
+                        return
+                    now, now_mono = datetime.datetime.now(), time.monotonic()
+                    # The monotonic clock does not move while suspended.
+                    expected = wall + datetime.timedelta(
+                        seconds=now_mono - mono)
+                    jumped_from = None
+                    if abs(jump := (now - expected).total_seconds()) > JUMP:
+                        print(f'  Wall clock jumped by {jump:.0f}s.')
+                        jumped_from = expected if jump > 0 else None
+                    wall, mono = now, now_mono
+                    if due := self._pop_due(now, jumped_from):
+                        break
+                    timeout = MAX_SLEEP
+                    if self._save_at is not None:
+                        if now_mono >= self._save_at:
+                            self._save()
+                        else:
+                            timeout = self._save_at - now_mono
+                    if e := self._top():
+                        timeout = min(timeout,
+                                      (e.next_run - now).total_seconds())
+                    self._cv.wait(timeout)
+            for e, n in due:
+                for _ in range(n):
+                    self._fire(e.event)
+
 
 class Scheduler:
-    def __init__(self, runner, runner_arg):
-        self.jobs = {}  # {name: [job,]}
+    """Entries are indexed by job name and Schedule, so adding, changing or
+    cancelling one schedule touches only its own entry. Watermarks of the
+    events are kept in state_file, if set. A standby scheduler fires
+    nothing until take_over()."""
+    def __init__(self, runner, runner_arg, state_file=None, standby=False):
+        self.jobs = {}  # {name: {schedule: entry}}
         self.job_runner = runner
         self.job_runner_arg = runner_arg
-        self._s = schedule.Scheduler()
-        self._run_scheduler_non_blocking()
-    
+        self._s = _Engine(self._fire, Watermarks(state_file),
+                          active=not standby)
+
     def __del__(self):
         self._s.clear()
 
-    def _run_scheduler_non_blocking(self):
-        self._t = threading.Thread(group=None, target=_schedule_run_pending,
-            args=(self._s,), daemon=True)
-        self._t.start()
+    def _fire(self, event):
+        # Runs on the engine thread, job_runner must not block.
+        try:
+            self.job_runner(self.job_runner_arg, event.name)
+        except Exception as e:
+            print(f'  Failed to fire <{event.name}>: {e!r}')
 
-    def _add_job(self, name, job):
-        if name in self.jobs:
-            self.jobs[name].append(job)
-        else:
-            self.jobs.update({name: [job]})
-
-    def schedule_event(self, event: Event):
-        t = event.schedule.time_str()
-        if event.schedule.interval == Interval.daily:
-            j = self._s.every().day.at(t).do(_scheduler_runner, (self, event))
-            self._add_job(event.name, j)
-        elif event.schedule.interval == Interval.weekday:
-            weekday = event.schedule.interval_arg.lower()
-            sched_day = getattr(self._s.every(), weekday)
-            j = sched_day.at(t).do(_scheduler_runner, (self, event))
-            self._add_job(event.name, j)
-        elif event.schedule.interval == Interval.workdays:
-            for day in Day.workDays():
-                sched_day = getattr(self._s.every(), day.lower())
-                j = sched_day.at(t).do(_scheduler_runner, (self, event))
-                self._add_job(event.name, j)
-        
+    def schedule_event(self, event: Event, active=True):
+        """Schedule the event, replacing the entry of the same Schedule.
+        Fires missed since its watermark are caught up. Inactive events are
+        only indexed until resume_events."""
+        entries = self.jobs.setdefault(event.name, {})
+        if old := entries.get(event.schedule):
+            self._s.remove(old)
+        e = entries[event.schedule] = _Entry(event)
+        if active:
+            self._s.add(e, catch_up=True)
+
+    def _cancel(self, e):
+        self._s.remove(e)
+        # Keys embed the schedule, marks of cancelled ones would pile up.
+        self._s.discard_mark(e)
+
+    def cancel_event(self, name, schedule):
+        entries = self.jobs.get(name, {})
+        if e := entries.pop(schedule, None):
+            self._cancel(e)
+        if not entries:
+            self.jobs.pop(name, None)
 
     def cancel_events(self, name):
-        if jobs := self.jobs.get(name):
-            for j in jobs:
-                self._s.cancel_job(j)
-            del self.jobs[name]
-    
+        if entries := self.jobs.pop(name, None):
+            for e in entries.values():
+                self._cancel(e)
+
+    def pause_events(self, name):
+        """Take the events out of the heap, keeping their entries."""
+        for e in self.jobs.get(name, {}).values():
+            self._s.remove(e)
+
+    def resume_events(self, name):
+        for e in self.jobs.get(name, {}).values():
+            self._s.add(e)
+
     def next_run(self):
-        return self._s.next_run
\ No newline at end of file
+        return self._s.next_run()
+
+    @property
+    def is_standby(self):
+        return not self._s.active
+
+    def take_over(self):
+        self._s.take_over()
@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+import time
 
 SETTINGS_FILE = 'settings.json'
 SETTINGS_DEFAULT = {
@@ -7,6 +9,46 @@ SETTINGS_DEFAULT = {
         'name': 'slack',
         'token': None,
         'user_id': None
+    },
+    'broker': {
+        'transport': 'rabbitmq',  # or 'local': no RabbitMQ, single box
+        'socket': 'assistant.sock',  # of the 'local' broker
+        'prefetch': 16,  # unacked messages in flight, 0 consumes one by one
+        'workers': 4
+    },
+    'executor': {
+        'max_concurrent': 8,  # runs of all jobs at a time
+        'mode': 'subprocess',  # or 'pool': warm worker processes
+        'pool_size': 2,
+        'preload': [],  # modules imported once by pool workers
+        'max_runs': 100,  # runs before a pool worker is replaced
+        'max_rss_mb': 512
+    },
+    'history': {
+        'file': None,  # SQLite run history, e.g. 'history.db'; off if null
+        'retention_days': 90
+    },
+    'coalescing': {
+        'window': 0,  # seconds, 0 sends every message on its own
+        'jobs': {},  # {job_name: window}
+        'file_threshold': 4000  # longer digests are uploaded as a file
+    },
+    'scheduler': {
+        'state_file': 'scheduler.json',  # last fires, to catch up missed runs
+        'jitter': 0,  # seconds fires of a job are spread over, per job name
+        'lock_file': None  # shared by Assistants of which one fires jobs
+    },
+    'logs': {
+        'dir': 'logs',  # output of runs, one file per job
+        'max_bytes': 1024 * 1024,  # size at which a log is rotated
+        'backups': 3,  # rotated files kept per job
+        'forward_lines': 0  # last lines sent to the messenger on failure
+    },
+    'cluster': {
+        'dispatch': False,  # run jobs on `assistant worker` nodes
+        'result_timeout': 3600,  # seconds before a dispatched run is given up
+        'labels': [],  # of `assistant worker` on this node
+        'capacity': 4  # runs at a time of `assistant worker` on this node
     }
 }
 
@@ -16,6 +58,38 @@ def messenger_cfg(s):
     else:
         print(f'Messenger is not configured. Check {SETTINGS_FILE}.')
 
+def _section_cfg(s, section):
+    """Section of settings with defaults for keys missing in the file."""
+    cfg = dict(SETTINGS_DEFAULT[section])
+    if s and (c := s.get(section)):
+        cfg.update(c)
+    return cfg
+
+def broker_cfg(s):
+    return _section_cfg(s, 'broker')
+
+def executor_cfg(s):
+    return _section_cfg(s, 'executor')
+
+def history_cfg(s):
+    return _section_cfg(s, 'history')
+
+def coalescing_cfg(s):
+    return _section_cfg(s, 'coalescing')
+
+def scheduler_cfg(s):
+    return _section_cfg(s, 'scheduler')
+
+def logs_cfg(s):
+    return _section_cfg(s, 'logs')
+
+def cluster_cfg(s):
+    return _section_cfg(s, 'cluster')
+
+def coalescing_window(s, job_name):
+    cfg = coalescing_cfg(s)
+    return cfg['jobs'].get(job_name, cfg['window'])
+
 class SettingsFileExists(Exception):
     pass
 
@@ -32,3 +106,55 @@ def from_file(fname=SETTINGS_FILE):
     if os.path.exists(path):
         with open(path) as f:
             return json.load(f)
+
+
+_NOT_LOADED = object()
+
+class SettingsCache:
+    """Settings parsed once and reloaded only when the file changes.
+    The file is stat-ed at most once per check_interval seconds. version
+    is bumped on every (re)load, so consumers can rebuild derived objects
+    (e.g. messenger clients) when it changes."""
+    def __init__(self, fname=SETTINGS_FILE, check_interval=1.0):
+        self.fname = fname
+        self.check_interval = check_interval
+        self.version = 0
+        self._settings = None
+        self._file_id = _NOT_LOADED
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(os.path.join(os.getcwd(), self.fname))
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def get(self):
+        now = time.monotonic()
+        if (self._checked_at is not None
+                and now - self._checked_at < self.check_interval):
+            return self._settings
+        with self._lock:
+            file_id = self._stat()
+            if file_id != self._file_id:
+                try:
+                    self._settings = from_file(self.fname)
+                except json.JSONDecodeError:
+                    # Half-written file, keep the previous settings.
+                    return self._settings
+                self._file_id = file_id
+                self.version += 1
+            # Only now, other threads skip the lock once this is set.
+            self._checked_at = now
+        return self._settings
+
+
+_cache = SettingsCache()
+
+def cached():
+    return _cache.get()
+
+def version():
+    return _cache.version
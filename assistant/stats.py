@@ -0,0 +1,53 @@
+import collections
+import threading
+
+
+class RunStats:
+    """Records of the last max_runs runs per job, kept in memory."""
+    def __init__(self, max_runs=100):
+        self.max_runs = max_runs
+        self._runs = {}  # {job_name: deque([run,])}
+        self._lock = threading.Lock()
+
+    def add(self, run):
+        with self._lock:
+            if not (runs := self._runs.get(run.job_name)):
+                runs = self._runs[run.job_name] = collections.deque(
+                    maxlen=self.max_runs)
+            runs.append(run)
+
+    def last(self, name):
+        """Last recorded run of the job, None if there is none."""
+        with self._lock:
+            if runs := self._runs.get(name):
+                return runs[-1]
+
+    def runs(self, name=None):
+        with self._lock:
+            if name:
+                return list(self._runs.get(name, []))
+            return [r for runs in self._runs.values() for r in runs]
+
+    def summary(self):
+        """{job_name: aggregated stats} over the recorded runs."""
+        res = {}
+        with self._lock:
+            items = [(name, list(runs)) for name, runs in self._runs.items()]
+        for name, runs in items:
+            wall = [r.wall_time for r in runs]
+            cpu = [r.cpu_time for r in runs if r.cpu_time is not None]
+            rss = [r.max_rss_kb for r in runs if r.max_rss_kb is not None]
+            res[name] = {
+                "runs": len(runs),
+                "failed": sum(1 for r in runs if r.exit_code != 0),
+                "avg_wall_time": sum(wall) / len(wall),
+                "max_wall_time": max(wall),
+                "avg_cpu_time": sum(cpu) / len(cpu) if cpu else None,
+                "max_rss_kb": max(rss) if rss else None,
+                "last_exit_code": runs[-1].exit_code
+            }
+        return res
+
+    def json(self):
+        return {"runs": [r.json() for r in self.runs()],
+                "summary": self.summary()}
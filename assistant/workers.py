@@ -0,0 +1,148 @@
+"""Pool of warm worker processes for running job scripts.
+
+Every worker is a fresh interpreter which imports the preload modules once.
+For each run it forks a child that executes the job script with runpy, so
+the run has its own argv and module state but skips interpreter startup and
+the preloaded imports. Workers are replaced after max_runs runs, or after
+a run whose peak RSS (pages shared with the worker included) passed
+max_rss_mb. Output fds of a run are passed to the
+worker over its connection and become the child's stdout and stderr.
+"""
+import importlib
+import multiprocessing
+import os
+import queue
+import runpy
+import sys
+import traceback
+from multiprocessing import reduction
+
+
+class WorkerPoolException(Exception):
+    pass
+
+def _exit_code(e: SystemExit):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code, file=sys.stderr)
+    return 1
+
+def _run_script(path, argv):
+    """Runs in the forked child, never returns."""
+    code = 0
+    try:
+        sys.argv = [path] + list(argv)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+        runpy.run_path(path, run_name='__main__')
+    except SystemExit as e:
+        code = _exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+def _worker_main(conn, preload, max_runs, max_rss_mb):
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            print(f'  Worker could not preload {name}: {e}', file=sys.stderr)
+    runs = 0
+    while True:
+        try:
+            path, argv, env, targets = conn.recv()
+            fds = [reduction.recv_handle(conn) for _ in targets]
+        except EOFError:
+            return
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            os.setsid()
+            os.environ.update(env)
+            for target, fd in zip(targets, fds):
+                os.dup2(fd, target)
+            _run_script(path, argv)
+        for fd in fds:
+            os.close(fd)
+        conn.send(('started', pid))
+        _, status, rusage = os.wait4(pid, 0)
+        runs += 1
+        # The worker's own RSS does not grow with runs, they are forked.
+        retire = runs >= max_runs or rusage.ru_maxrss / 1024 > max_rss_mb
+        conn.send(('done', os.waitstatus_to_exitcode(status), rusage, retire))
+        if retire:
+            return
+
+
+class _Worker:
+    def __init__(self, ctx, preload, max_runs, max_rss_mb):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, daemon=True,
+            args=(child_conn, preload, max_runs, max_rss_mb))
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        self.conn.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class WorkerPool:
+    """size pre-started workers. run() blocks until a worker is free."""
+    def __init__(self, size=2, preload=(), max_runs=100, max_rss_mb=512):
+        self.preload = list(preload)
+        self.max_runs = max_runs
+        self.max_rss_mb = max_rss_mb
+        self._ctx = multiprocessing.get_context('spawn')
+        self._idle = queue.Queue()
+        for _ in range(size):
+            self._idle.put(self._start_worker())
+
+    def _start_worker(self):
+        return _Worker(self._ctx, self.preload, self.max_runs, self.max_rss_mb)
+
+    def run(self, path, argv=(), on_start=None, stdout=None, stderr=None,
+            env=None):
+        """Run the script, return (exit code, resource usage of the run).
+        on_start(pid) is called once the run's process exists. stdout and
+        stderr are fds for the run's output; run() closes them. env is
+        added to the run's environment."""
+        out = {t: fd for t, fd in ((1, stdout), (2, stderr)) if fd is not None}
+        fds = list(out.values())
+        w = self._idle.get()
+        try:
+            try:
+                w.conn.send((os.path.abspath(path), list(argv), env or {},
+                             list(out)))
+                for fd in fds:
+                    reduction.send_handle(w.conn, fd, w.process.pid)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+            _, pid = w.conn.recv()
+            if on_start:
+                on_start(pid)
+            _, code, rusage, retire = w.conn.recv()
+        except (EOFError, OSError) as e:
+            w.stop()
+            self._idle.put(self._start_worker())
+            raise WorkerPoolException(f'Worker died running {path}') from e
+        if retire:
+            w.stop()
+            w = self._start_worker()
+        self._idle.put(w)
+        return code, rusage
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                return
@@ -0,0 +1,200 @@
+"""Micro benchmarks. Run: python tests/benchmarks.py [name ...]"""
+import datetime
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pika
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import broker_standin
+from assistant import api
+from assistant import history
+from assistant import scheduler
+from assistant import workers
+
+
+def _rate(n, seconds):
+    return f'{n / seconds:10.0f} msg/s'
+
+def _send_message_per_connection(msg):
+    # api.send_message before the persistent publisher.
+    conn = pika.BlockingConnection(
+        pika.ConnectionParameters(host=api.PIKA_HOST, port=api.PIKA_PORT))
+    channel = conn.channel()
+    channel.queue_declare(queue=api.PIKA_QUEUE)
+    channel.basic_publish(exchange='', routing_key=api.PIKA_QUEUE,
+                          body=json.dumps(msg))
+    conn.close()
+
+def bench_publisher(n=2000):
+    broker = broker_standin.Broker().start()
+    api.PIKA_HOST, api.PIKA_PORT = '127.0.0.1', broker.port
+    msg = {'job_name': 'bench', 'text': 'x' * 64}
+    try:
+        t = time.perf_counter()
+        for _ in range(n):
+            _send_message_per_connection(msg)
+        print(f'  connection per message: {_rate(n, time.perf_counter() - t)}')
+        t = time.perf_counter()
+        for _ in range(n):
+            api.send_message(msg)
+        print(f'  persistent publisher:   {_rate(n, time.perf_counter() - t)}')
+        t = time.perf_counter()
+        with api.batch() as b:
+            for _ in range(n):
+                b.send(msg)
+        print(f'  committed batch:        {_rate(n, time.perf_counter() - t)}')
+    finally:
+        api._publisher.close()
+        api._confirm_publisher.close()
+        broker.stop()
+    with tempfile.TemporaryDirectory() as d:
+        local = api.serve_local(os.path.join(d, 'assistant.sock'))
+        try:
+            t = time.perf_counter()
+            for _ in range(n):
+                api.send_message(msg)
+            print(f'  local broker:           '
+                  f'{_rate(n, time.perf_counter() - t)}')
+            t = time.perf_counter()
+            with api.batch() as b:
+                for _ in range(n):
+                    b.send(msg)
+            print(f'  local committed batch:  '
+                  f'{_rate(n, time.perf_counter() - t)}')
+        finally:
+            api._publisher.close()
+            api._confirm_publisher.close()
+            local.stop()
+
+def _random_schedules(n):
+    rnd = random.Random(1)
+    for _ in range(n):
+        t = datetime.time(rnd.randrange(24), rnd.randrange(60),
+                          rnd.randrange(60))
+        yield scheduler.Schedule(t, scheduler.Interval.daily)
+
+def _ms(t):
+    return f'{(time.perf_counter() - t) * 1000:9.2f} ms'
+
+def bench_scheduler(sizes=(10_000, 100_000)):
+    try:
+        import schedule
+    except ImportError:
+        schedule = None
+    for n in sizes:
+        print(f'  {n} events')
+        schedules = list(_random_schedules(n))
+        if schedule:
+            s = schedule.Scheduler()
+            t = time.perf_counter()
+            for sc in schedules:
+                s.every().day.at(sc.time_str()).do(lambda: None)
+            print(f'    schedule: add {_ms(t)}', end='')
+            t = time.perf_counter()
+            s.run_pending()
+            print(f', run_pending (every second) {_ms(t)}', end='')
+            t = time.perf_counter()
+            s.next_run
+            print(f', next_run {_ms(t)}')
+        d = tempfile.mkdtemp()
+        # With a state file, as Assistant runs it.
+        s = scheduler.Scheduler(lambda a, name: None, None,
+                                os.path.join(d, 'scheduler.json'))
+        t = time.perf_counter()
+        for sc in schedules:
+            s.schedule_event(scheduler.Event('bench', sc))
+        print(f'    heap:     add {_ms(t)}', end='')
+        t = time.perf_counter()
+        with s._s._cv:
+            s._s._pop_due(datetime.datetime.now())
+        print(f', wake-up check (at deadlines only) {_ms(t)}', end='')
+        t = time.perf_counter()
+        s.next_run()
+        print(f', next_run {_ms(t)}')
+        t = time.perf_counter()
+        s.cancel_events('bench')
+        print(f'    heap:     cancel all {_ms(t)}')
+        s._s.clear()
+        shutil.rmtree(d)
+
+_first_line_job = """
+import slack_sdk, pika, json
+import sys, time
+with open(sys.argv[1], 'w') as f:
+    f.write(repr(time.time()))
+"""
+
+def bench_job_launch(runs=20):
+    """Fire to first line of the job (after importing slack_sdk and pika,
+    which pool workers preload) latency."""
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'job.py')
+        out = os.path.join(d, 'out.txt')
+        with open(path, 'wt') as f:
+            f.write(_first_line_job)
+
+        def _latency(launch):
+            total = 0
+            for _ in range(runs):
+                t = time.time()
+                launch()
+                with open(out) as f:
+                    total += float(f.read()) - t
+            return f'{total / runs * 1000:8.1f} ms'
+
+        cold = _latency(lambda: subprocess.run([sys.executable, path, out]))
+        print(f'  cold subprocess.run: {cold}')
+        pool = workers.WorkerPool(size=1, preload=['slack_sdk', 'pika'])
+        try:
+            warm = _latency(lambda: pool.run(path, [out]))
+        finally:
+            pool.close()
+        print(f'  warm worker pool:    {warm}')
+
+def bench_history(n=1_000_000, jobs=100):
+    with tempfile.TemporaryDirectory() as d:
+        h = history.HistoryStore(os.path.join(d, 'history.db'))
+        rnd = random.Random(1)
+        now = time.time()
+        rows = [(f'job{i % jobs}', now - i, now - i, 0.01, rnd.random() * 60,
+                 1.0, 10240, 0 if rnd.random() > 0.05 else 1,
+                 'ok' if rnd.random() > 0.05 else 'failed') for i in range(n)]
+        t = time.perf_counter()
+        # Same path as add_run, without building Run objects.
+        for r in rows:
+            h._q.put((history._INSERT_RUN, r))
+        h.flush()
+        print(f'  {n} runs written by the batching writer {_ms(t)}')
+        for name, query in [
+                ('last 10 runs', lambda: h.last_runs('job7', 10)),
+                ('failure rate, last day',
+                 lambda: h.failure_rate('job7', since=now - 24 * 3600)),
+                ('p95 duration', lambda: h.p95_duration('job7'))]:
+            t = time.perf_counter()
+            query()
+            print(f'  {name:24} {_ms(t)}')
+
+
+BENCHMARKS = {
+    'publisher': bench_publisher,
+    'scheduler': bench_scheduler,
+    'job_launch': bench_job_launch,
+    'history': bench_history,
+}
+
+def main(names):
+    for name in names or BENCHMARKS:
+        print(f'{name}:')
+        BENCHMARKS[name]()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,313 @@
+"""Minimal AMQP 0-9-1 broker stand-in for tests and benchmarks.
+
+Speaks just enough of the protocol for pika's BlockingConnection: connection
+and channel handshake, queue declaration, publishing to the default exchange
+and to topic exchanges, publisher confirms, transactions, consumers with
+prefetch and acks.
+Runs in-process on a loopback port, so it can be started, stopped and
+restarted from a test.
+"""
+import collections
+import socket
+import threading
+
+import pika.frame
+import pika.spec
+from pika.spec import Basic, Channel, Confirm, Connection, Exchange, Queue
+from pika.spec import Tx
+
+from assistant.localbroker import topic_re
+
+
+class _Consumer:
+    def __init__(self, conn, channel, tag, queue, no_ack):
+        self.conn = conn
+        self.channel = channel
+        self.tag = tag
+        self.queue = queue
+        self.no_ack = no_ack
+
+
+class _Conn:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self._wlock = threading.Lock()
+        self.confirm = set()  # channels in confirm mode
+        self.tx = {}  # channel in tx mode: [uncommitted publish]
+        self.publish_seq = collections.Counter()
+        self.prefetch = {}
+        self.unacked = {}  # (channel, delivery_tag): (queue, body)
+        self.exclusive = []  # queues deleted when the connection closes
+        self.delivery_seq = collections.Counter()
+        self._pending = {}  # channel: [method, props, size, chunks]
+
+    def send(self, *frames):
+        data = b''.join(f.marshal() for f in frames)
+        with self._wlock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                pass
+
+    def method(self, ch, m):
+        self.send(pika.frame.Method(ch, m))
+
+    def deliver(self, consumer, body):
+        ch = consumer.channel
+        self.delivery_seq[ch] += 1
+        tag = self.delivery_seq[ch]
+        if not consumer.no_ack:
+            self.unacked[(ch, tag)] = (consumer.queue, body)
+        self.send(
+            pika.frame.Method(ch, Basic.Deliver(consumer.tag, tag, False,
+                                                '', consumer.queue)),
+            pika.frame.Header(ch, len(body), pika.spec.BasicProperties()),
+            pika.frame.Body(ch, body))
+
+    def can_deliver(self, consumer):
+        limit = self.prefetch.get(consumer.channel, 0)
+        if consumer.no_ack or not limit:
+            return True
+        in_flight = sum(1 for c, _ in self.unacked if c == consumer.channel)
+        return in_flight < limit
+
+    def serve(self):
+        buf = b''
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                buf += data
+                while buf:
+                    used, frame = pika.frame.decode_frame(buf)
+                    if not frame:
+                        break
+                    buf = buf[used:]
+                    if self.handle(frame) is False:
+                        return
+        except OSError:
+            pass
+        finally:
+            self.broker._disconnected(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def handle(self, frame):
+        b = self.broker
+        if isinstance(frame, pika.frame.ProtocolHeader):
+            b.stats['connections'] += 1
+            caps = {'publisher_confirms': True, 'basic.nack': True}
+            self.method(0, Connection.Start(
+                server_properties={'capabilities': caps}))
+            return
+        ch = frame.channel_number
+        if isinstance(frame, pika.frame.Header):
+            self._pending[ch][1] = frame.properties
+            self._pending[ch][2] = frame.body_size
+            if not frame.body_size:
+                self._published(ch)
+            return
+        if isinstance(frame, pika.frame.Body):
+            self._pending[ch][3].append(frame.fragment)
+            if sum(map(len, self._pending[ch][3])) >= self._pending[ch][2]:
+                self._published(ch)
+            return
+        if not isinstance(frame, pika.frame.Method):
+            return
+        m = frame.method
+        if isinstance(m, Connection.StartOk):
+            self.method(0, Connection.Tune(0, 131072, 0))
+        elif isinstance(m, Connection.Open):
+            self.method(0, Connection.OpenOk())
+        elif isinstance(m, Connection.Close):
+            self.method(0, Connection.CloseOk())
+            return False
+        elif isinstance(m, Channel.Open):
+            self.method(ch, Channel.OpenOk())
+        elif isinstance(m, Channel.Close):
+            b._requeue_channel(self, ch)
+            self.method(ch, Channel.CloseOk())
+        elif isinstance(m, Queue.Declare):
+            b.declare(m.queue)
+            if m.exclusive:
+                self.exclusive.append(m.queue)
+            self.method(ch, Queue.DeclareOk(m.queue, len(b.queues[m.queue]), 0))
+        elif isinstance(m, Exchange.Declare):
+            b.exchanges.setdefault(m.exchange, [])
+            self.method(ch, Exchange.DeclareOk())
+        elif isinstance(m, Queue.Bind):
+            b.bind(m.queue, m.exchange, m.routing_key)
+            self.method(ch, Queue.BindOk())
+        elif isinstance(m, Confirm.Select):
+            self.confirm.add(ch)
+            self.method(ch, Confirm.SelectOk())
+        elif isinstance(m, Tx.Select):
+            self.tx[ch] = []
+            self.method(ch, Tx.SelectOk())
+        elif isinstance(m, Tx.Commit):
+            b.stats['commits'] += 1
+            for args in self.tx[ch]:
+                b.publish(*args)
+            self.tx[ch].clear()
+            self.method(ch, Tx.CommitOk())
+        elif isinstance(m, Tx.Rollback):
+            self.tx[ch].clear()
+            self.method(ch, Tx.RollbackOk())
+        elif isinstance(m, Basic.Qos):
+            self.prefetch[ch] = m.prefetch_count
+            self.method(ch, Basic.QosOk())
+        elif isinstance(m, Basic.Publish):
+            self._pending[ch] = [m, None, 0, []]
+        elif isinstance(m, Basic.Consume):
+            tag = m.consumer_tag or f'ctag-{id(self)}-{ch}'
+            self.method(ch, Basic.ConsumeOk(tag))
+            b.consume(_Consumer(self, ch, tag, m.queue, m.no_ack))
+        elif isinstance(m, Basic.Ack):
+            b.ack(self, ch, m.delivery_tag)
+        elif isinstance(m, (Basic.Nack, Basic.Reject)):
+            b.nack(self, ch, m.delivery_tag, m.requeue)
+
+    def _published(self, ch):
+        m, _, _, chunks = self._pending.pop(ch)
+        if ch in self.tx:
+            self.tx[ch].append((m.routing_key, b''.join(chunks), m.exchange))
+            return
+        self.broker.publish(m.routing_key, b''.join(chunks), m.exchange)
+        if ch in self.confirm:
+            self.publish_seq[ch] += 1
+            self.method(ch, Basic.Ack(self.publish_seq[ch]))
+
+
+class Broker:
+    """Threaded AMQP stand-in listening on 127.0.0.1:<port>."""
+    def __init__(self, port=0):
+        self.port = port
+        self.queues = collections.defaultdict(collections.deque)
+        self.exchanges = {}  # {name: [(compiled pattern, queue),]}
+        self.consumers = collections.defaultdict(list)
+        self.stats = collections.Counter()
+        self.acked = []
+        self.nacked = []
+        self._lock = threading.RLock()
+        self._conns = []
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', self.port))
+        self.port = self._sock.getsockname()[1]
+        self._sock.listen(64)
+        threading.Thread(target=self._accept, args=(self._sock,),
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        """Drop every client connection, like a broker restart would."""
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._sock.close()
+            self._sock = None
+        with self._lock:
+            conns, self._conns = self._conns, []
+        for c in conns:
+            try:
+                c.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _accept(self, lsock):
+        while True:
+            try:
+                s, _ = lsock.accept()
+            except OSError:
+                return
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            c = _Conn(self, s)
+            with self._lock:
+                self._conns.append(c)
+            threading.Thread(target=c.serve, daemon=True).start()
+
+    def declare(self, queue):
+        with self._lock:
+            self.queues[queue]
+
+    def bind(self, queue, exchange, pattern):
+        with self._lock:
+            self.exchanges.setdefault(exchange, []).append(
+                (topic_re(pattern), queue))
+
+    def publish(self, routing_key, body, exchange=''):
+        with self._lock:
+            self.stats['published'] += 1
+            if exchange:
+                queues = {q for p, q in self.exchanges.get(exchange, [])
+                          if p.match(routing_key)}
+            else:
+                queues = [routing_key]
+            for queue in queues:
+                self.queues[queue].append(body)
+                self._dispatch(queue)
+
+    def consume(self, consumer):
+        with self._lock:
+            self.consumers[consumer.queue].append(consumer)
+            self._dispatch(consumer.queue)
+
+    def ack(self, conn, ch, tag):
+        with self._lock:
+            queue, body = conn.unacked.pop((ch, tag))
+            self.acked.append(body)
+            self._dispatch_all()
+
+    def nack(self, conn, ch, tag, requeue):
+        with self._lock:
+            queue, body = conn.unacked.pop((ch, tag))
+            self.nacked.append(body)
+            if requeue:
+                self.queues[queue].appendleft(body)
+            self._dispatch_all()
+
+    def _dispatch(self, queue):
+        pending = self.queues[queue]
+        consumers = self.consumers[queue]
+        progress = True
+        while pending and progress:
+            progress = False
+            for c in list(consumers):
+                if pending and c.conn.can_deliver(c):
+                    c.conn.deliver(c, pending.popleft())
+                    progress = True
+
+    def _dispatch_all(self):
+        # Prefetch is per channel, a freed slot may go to any of its queues.
+        for queue in list(self.queues):
+            self._dispatch(queue)
+
+    def _requeue_channel(self, conn, ch):
+        with self._lock:
+            for key in [k for k in conn.unacked if ch is None or k[0] == ch]:
+                queue, body = conn.unacked.pop(key)
+                self.queues[queue].appendleft(body)
+            for queue, consumers in self.consumers.items():
+                consumers[:] = [c for c in consumers if not (
+                    c.conn is conn and (ch is None or c.channel == ch))]
+
+    def _disconnected(self, conn):
+        with self._lock:
+            if conn in self._conns:
+                self._conns.remove(conn)
+            self._requeue_channel(conn, None)
+            for queue in conn.exclusive:
+                self.queues.pop(queue, None)
+                self.consumers.pop(queue, None)
+                for bindings in self.exchanges.values():
+                    bindings[:] = [b for b in bindings if b[1] != queue]
+            self._dispatch_all()
@@ -0,0 +1,94 @@
+"""Local fake of the Slack Web API for messenger tests.
+
+Counts requests per API method and keeps channels in memory. Point a
+WebClient at it with base_url=server.base_url.
+"""
+import collections
+import http.server
+import json
+import threading
+import urllib.parse
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_POST(self):
+        srv = self.server.slack
+        method = self.path.rsplit('/', 1)[-1]
+        size = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(size).decode()
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            args = json.loads(raw or '{}')
+        else:
+            args = {k: v[0] for k, v in urllib.parse.parse_qs(raw).items()}
+        status, headers, body = srv.handle(method, args)
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class SlackServer:
+    def __init__(self, channels=(), page_size=100):
+        self.requests = collections.Counter()
+        self.calls = []  # (method, args)
+        self.channels = {name: f'C{i}' for i, name in enumerate(channels)}
+        self.page_size = page_size
+        self.fail = {}  # method: (status, headers, body) for the next call
+        self._lock = threading.Lock()
+        self._httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                      _Handler)
+        self._httpd.slack = self
+        self.base_url = f'http://127.0.0.1:{self._httpd.server_port}/api/'
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    @property
+    def total(self):
+        return sum(self.requests.values())
+
+    def handle(self, method, args):
+        with self._lock:
+            self.requests[method] += 1
+            self.calls.append((method, args))
+            if method in self.fail:
+                return self.fail.pop(method)
+            return 200, {}, self._ok(method, args)
+
+    def _ok(self, method, args):
+        if method == 'conversations.list':
+            names = sorted(self.channels)
+            start = int(args.get('cursor') or 0)
+            limit = int(args.get('limit') or self.page_size)
+            limit = min(limit, self.page_size)
+            page = names[start:start + limit]
+            nxt = str(start + limit) if start + limit < len(names) else ''
+            return {'ok': True,
+                    'channels': [{'name': n, 'id': self.channels[n]}
+                                 for n in page],
+                    'response_metadata': {'next_cursor': nxt}}
+        if method == 'conversations.create':
+            name = args['name']
+            if name in self.channels:
+                return {'ok': False, 'error': 'name_taken'}
+            self.channels[name] = f'C{len(self.channels)}'
+            return {'ok': True,
+                    'channel': {'id': self.channels[name], 'name': name}}
+        if method == 'files.getUploadURLExternal':
+            return {'ok': True, 'file_id': 'F1',
+                    'upload_url': f'{self.base_url}upload'}
+        if method == 'files.completeUploadExternal':
+            return {'ok': True, 'files': [{'id': 'F1'}]}
+        return {'ok': True}
@@ -1,19 +1,41 @@
+import concurrent.futures
 import datetime
 import json
 import os
 import pytest
+import socket
+import subprocess
+import sys
+import threading
+import time
 
+import broker_standin
+import slack_standin
+from assistant import api
 from assistant import assistant
+from assistant import cron
+from assistant import dag
+from assistant import delivery
+from assistant import executor
+from assistant import history
 from assistant import job
+from assistant import joblog
+from assistant import leader
+from assistant import localbroker
 from assistant import messenger
+from assistant import ratelimit
+from assistant import remote
 from assistant import settings
 from assistant import scheduler
+from assistant import stats
+from assistant import workers
 from assistant.command import Cmd, Commands, _split_cmd
 from assistant.scheduler import Schedule, Scheduler, Interval, Day, Event
 from assistant.scheduler import ScheduleInitException, _intervals
 
 ### assistant
-def test_add_job():
+def test_add_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     a = assistant.Assistant()
     a.add_job("A", "path", params=None, is_active=False)
     assert len(a.jobs) == 1
@@ -24,7 +46,8 @@ def test_add_job():
     with pytest.raises(assistant.AssistantAddJobException):
         a.add_job("A", "path2", params=None, is_active=False)
 
-def test_dump_jobs():
+def test_dump_jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     a = assistant.Assistant()
     a.add_job("A", "path", params=None, is_active=False)
     cfg = a.jobs_json()
@@ -77,25 +100,443 @@ def test_make_cmd():
         "python", "path/to/file.py", "one=1", "two=2"
     ]
 
-def test_assistant_add_scheduled_jobs():
+def test_assistant_add_scheduled_jobs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     a = assistant.Assistant()
     assistant._load_jobs(a, _jobs_cfg)
     sched_len = len(_jobs_cfg["jobs"]["test_job"]["schedule"])
-    assert len(a.scheduler._s.jobs) == sched_len
-    sched_job = a.scheduler._s.jobs[0]
-    assert sched_job.unit == "weeks"
-    assert sched_job != a.scheduler._s.jobs[1]
+    # Inactive job: indexed, but not in the heap.
+    assert len(a.scheduler.jobs["A"]) == sched_len
+    assert len(a.scheduler._s) == 0
+    a.enable_job("A")
+    assert len(a.scheduler._s) == sched_len
+    sched_job, sched_job1 = a.scheduler.jobs["A"].values()
+    assert sched_job.event.schedule.rule.days == {4}
+    assert sched_job != sched_job1
 
-def test_assistant_schedule_workdays_job():
+def test_assistant_schedule_workdays_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     a = assistant.Assistant()
     a.add_job("A", "path", params=None, is_active=False)
     s = Schedule(datetime.time(16,45), Interval.workdays)
     a.reschedule_job("A", s)
-    assert len(a.scheduler._s.jobs) == 5
+    assert len(a.scheduler._s) == 0
+    a.enable_job("A")
+    assert len(a.scheduler._s) == 1
+    assert s.rule.days == {0, 1, 2, 3, 4}
     a.scheduler.cancel_events("A")
-    assert len(a.scheduler._s.jobs) == 0
+    assert len(a.scheduler._s) == 0
 
 
+###
+### workers
+###
+_argv_job = """
+import os, sys
+with open(sys.argv[1], 'w') as f:
+    f.write(' '.join(sys.argv[2:]) + ' ' + str(os.getpid()))
+sys.exit(int(sys.argv[2]))
+"""
+
+def test_worker_pool_runs_script(tmp_path):
+    path = tmp_path / "job.py"
+    path.write_text(_argv_job)
+    out = tmp_path / "out.txt"
+    pool = workers.WorkerPool(size=1, preload=["json"], max_runs=2)
+    pids = []
+    try:
+        for code in (3, 0, 0):
+            ret, rusage = pool.run(str(path), [str(out), str(code), "x"],
+                                   on_start=pids.append)
+            assert ret == code
+            assert rusage.ru_maxrss > 0
+            args, pid = out.read_text().rsplit(" ", 1)
+            assert args == f"{code} x"
+            assert int(pid) == pids[-1]
+    finally:
+        pool.close()
+
+def test_worker_pool_recycles_workers(tmp_path):
+    path = tmp_path / "job.py"
+    path.write_text("import os, sys; print(os.getppid(), file=open(sys.argv[1], 'w'))")
+    out = tmp_path / "out.txt"
+    pool = workers.WorkerPool(size=1, max_runs=2)
+    worker_pids = []
+    try:
+        for _ in range(3):
+            pool.run(str(path), [str(out)])
+            worker_pids.append(out.read_text().strip())
+    finally:
+        pool.close()
+    assert worker_pids[0] == worker_pids[1] != worker_pids[2]
+
+def test_worker_pool_recycles_workers_after_big_runs(tmp_path):
+    path = tmp_path / "job.py"
+    path.write_text("import os, sys\n"
+                    "big = b'x' * int(sys.argv[2]) * 2 ** 20\n"
+                    "print(os.getppid(), file=open(sys.argv[1], 'w'))")
+    out = tmp_path / "out.txt"
+    pool = workers.WorkerPool(size=1, max_rss_mb=100)
+    worker_pids = []
+    try:
+        for mb in (1, 200, 1):
+            pool.run(str(path), [str(out), str(mb)])
+            worker_pids.append(out.read_text().strip())
+    finally:
+        pool.close()
+    assert worker_pids[0] == worker_pids[1] != worker_pids[2]
+
+###
+### executor
+###
+def _blocking_runner(started, release):
+    lock = threading.Lock()
+    def runner(j, run):
+        with lock:
+            started.append(run)
+        release.wait(timeout=5)
+    return runner
+
+def test_executor_skip_and_queue():
+    started, release = [], threading.Event()
+    e = executor.JobExecutor(_blocking_runner(started, release), max_workers=4)
+    skip = job.Job("skip", "p")
+    queue = job.Job("queue", "p", overlap=executor.Overlap.queue)
+    assert e.fire(skip)
+    assert e.fire(skip) == None
+    assert e.fire(queue)
+    assert e.fire(queue) == None
+    assert _wait_for(lambda: len(started) == 2)
+    release.set()
+    assert _wait_for(lambda: len(started) == 3)
+    assert started[-1].job_name == "queue"
+    assert _wait_for(lambda: not e.active("queue") and not e.active("skip"))
+
+def test_executor_global_limit():
+    started, release = [], threading.Event()
+    e = executor.JobExecutor(_blocking_runner(started, release), max_workers=2)
+    for name in "abc":
+        e.fire(job.Job(name, "p"))
+    time.sleep(0.1)
+    assert len(started) == 2
+    release.set()
+    assert _wait_for(lambda: len(started) == 3)
+
+def test_executor_kill_previous_run():
+    procs = []
+    def runner(j, run):
+        p = subprocess.Popen(["sleep", "10"])
+        procs.append(p)
+        run.pid = p.pid
+        p.wait()
+    e = executor.JobExecutor(runner, max_workers=4)
+    j = job.Job("kill", "p", overlap=executor.Overlap.kill)
+    first = e.fire(j)
+    assert _wait_for(lambda: first.pid)
+    second = e.fire(j)
+    assert first.killed
+    assert _wait_for(lambda: procs[0].returncode == -15)
+    assert _wait_for(lambda: second.pid)
+    e._kill(second)
+
+def test_executor_kill_run_before_it_started():
+    procs, release = [], threading.Event()
+    def runner(j, run):
+        release.wait(timeout=5)  # e.g. waiting for a free pool worker
+        p = subprocess.Popen(["sleep", "10"])
+        procs.append(p)
+        run.started(p.pid)
+        p.wait()
+    e = executor.JobExecutor(runner, max_workers=4)
+    j = job.Job("kill", "p", overlap=executor.Overlap.kill)
+    first = e.fire(j)
+    time.sleep(0.1)
+    second = e.fire(j)
+    assert first.killed and not first.pid
+    release.set()
+    assert _wait_for(lambda: len(procs) == 2)
+    first_proc = procs[0] if procs[0].pid == first.pid else procs[1]
+    assert _wait_for(lambda: first_proc.returncode == -15)
+    e._kill(second)
+
+_hung_job = """
+import os, signal, subprocess, sys, time
+child = subprocess.Popen(["sleep", "30"])
+open(sys.argv[1], "w").write(str(child.pid))
+if sys.argv[2] == "ignore":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+time.sleep(30)
+"""
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+@pytest.mark.parametrize("on_term", ["exit", "ignore"])
+def test_run_timeout_kills_process_group(tmp_path, monkeypatch, on_term):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(executor, "KILL_GRACE", 0.5)
+    path = tmp_path / "job.py"
+    path.write_text(_hung_job)
+    out = tmp_path / "child.txt"
+    a = assistant.Assistant()
+    a.add_job("T", str(path), params=f"{out} {on_term}", is_active=True,
+              timeout=1)
+    run = a.executor.fire(a.jobs["T"])
+    assert _wait_for(lambda: a.stats.runs("T"), timeout=10)
+    assert run.status == executor.RunStatus.timeout
+    assert run.wall_time < 5
+    child = int(out.read_text())
+    # The child was in the job's process group, init reaps it.
+    assert _wait_for(lambda: not _is_alive(child))
+
+def test_run_stats_of_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "job.py"
+    path.write_text("import sys; sum(range(10**6)); sys.exit(2)")
+    a = assistant.Assistant()
+    a.add_job("A", str(path), params=None, is_active=True)
+    run = a.executor.fire(a.jobs["A"])
+    assert _wait_for(lambda: a.stats.runs("A"), timeout=5)
+    assert run.exit_code == 2
+    assert run.status == executor.RunStatus.failed
+    assert run.wall_time > 0
+    assert run.cpu_time > 0
+    assert run.max_rss_kb > 0
+    assert run.start_latency >= 0
+    summary = a.stats.summary()["A"]
+    assert summary["runs"] == 1
+    assert summary["failed"] == 1
+    assert summary["last_exit_code"] == 2
+    exported = json.loads(json.dumps(a.stats.json()))
+    assert exported["runs"][0]["status"] == "failed"
+
+def _dag_jobs(deps):
+    return {n: job.Job(n, "p", is_active=True, depends_on=d)
+            for n, d in deps.items()}
+
+def _dag_run(jobs, durations, codes={}):
+    def runner(j, run):
+        run.started()
+        time.sleep(durations.get(j.name, 0))
+        run.finished(codes.get(j.name, 0))
+    e = executor.JobExecutor(runner, max_workers=4)
+    dependents = {}
+    for j in jobs.values():
+        for d in j.depends_on:
+            dependents.setdefault(d, []).append(j.name)
+    reports = []
+    d = dag.DagRun("A", jobs, dependents, e.fire, reports.append)
+    d.start()
+    assert _wait_for(lambda: reports, timeout=5)
+    return d
+
+def test_dag_runs_branches_in_parallel():
+    jobs = _dag_jobs({"A": [], "B": ["A"], "C": ["A"], "D": ["B", "C"],
+                      "X": []})
+    d = _dag_run(jobs, {"B": 0.3, "C": 0.1})
+    assert d.graph == {"A", "B", "C", "D"}
+    b, c, dd = d.runs["B"], d.runs["C"], d.runs["D"]
+    assert abs((b.start_time - c.start_time).total_seconds()) < 0.1
+    assert dd.start_time >= b.start_time + datetime.timedelta(seconds=0.3)
+    assert [n for n, _ in d.critical_path] == ["A", "B", "D"]
+    assert 0.3 <= d.duration() < 1
+
+def test_dag_leaves_out_jobs_below_failure():
+    jobs = _dag_jobs({"A": [], "B": ["A"], "C": ["A"], "D": ["C"],
+                      "E": ["B", "D"]})
+    jobs["B"].is_active = False
+    d = _dag_run(jobs, {}, codes={"C": 1})
+    assert d.finished == {"A", "C"}
+    assert d.left_out == {"B", "D", "E"}
+    assert [n for n, _ in d.critical_path] == ["A", "C"]
+
+def test_dag_fan_in_needs_last_run_of_other_roots():
+    jobs = _dag_jobs({"A": [], "B": [], "C": ["A", "B"]})
+    codes, ran = {"B": 1}, []
+    def runner(j, run):
+        ran.append(j.name)
+        run.started()
+        run.finished(codes.get(j.name, 0))
+    s = stats.RunStats()
+    e = executor.JobExecutor(runner, max_workers=4, on_done=s.add)
+    dependents = {"A": ["C"], "B": ["C"]}
+
+    def _fire(root):
+        reports = []
+        d = dag.DagRun(root, jobs, dependents, e.fire, reports.append,
+                       last_run=s.last)
+        d.start()
+        assert _wait_for(lambda: reports, timeout=5)
+        return d
+
+    assert _fire("B").left_out == {"C"}
+    assert _fire("A").left_out == {"C"}
+    assert ran == ["B", "A"]
+    codes["B"] = 0
+    assert _fire("B").finished == {"B", "C"}
+    assert ran == ["B", "A", "B", "C"]
+
+def test_dependency_cycles_are_rejected(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with pytest.raises(job.JobDependencyCycleException):
+        job.from_cfg(dict(_jobs_cfg["jobs"]["test_job"], depends_on=["A"]))
+    cfg = {"jobs": {n: job.Job(n, "p", depends_on=d).json() for n, d in
+                    [("A", ["C"]), ("B", ["A"]), ("C", ["B"])]}}
+    a = assistant.Assistant()
+    with pytest.raises(job.JobDependencyCycleException, match="A -> C -> B"):
+        assistant._load_jobs(a, cfg)
+    assert a.jobs == {}
+    del cfg["jobs"]["A"]
+    assistant._load_jobs(a, cfg)
+    assert a.dependents == {"A": ["B"], "B": ["C"]}
+    with pytest.raises(job.JobDependencyCycleException):
+        a.add_job("A", "p", None, False, depends_on=["C"])
+
+def test_run_stats_keeps_last_runs():
+    s = stats.RunStats(max_runs=2)
+    for code in (0, 1, 0):
+        r = executor.Run("A")
+        r.started()
+        r.finished(code)
+        s.add(r)
+    assert len(s.runs("A")) == 2
+    assert s.summary()["A"]["failed"] == 1
+    assert s.summary()["A"]["avg_cpu_time"] == None
+
+def _finished_run(name, code, wall, start):
+    r = executor.Run(name)
+    r.started()
+    r.finished(code)
+    r.wall_time = wall
+    r.start_time = datetime.datetime.fromtimestamp(start)
+    return r
+
+def test_history_store_queries(tmp_path):
+    h = history.HistoryStore(str(tmp_path / "h.db"), flush_interval=0.01)
+    now = time.time()
+    for i in range(100):
+        h.add_run(_finished_run("A", 1 if i % 10 == 0 else 0, i, now + i))
+    h.add_run(_finished_run("B", 0, 5, now))
+    h.add_message("A", "hello")
+    assert h.flush(timeout=5)
+    last = h.last_runs("A", 3)
+    assert [r["wall_time"] for r in last] == [99, 98, 97]
+    assert last[0]["status"] == "ok"
+    assert h.failure_rate("A") == 0.1
+    assert h.failure_rate("A", since=now + 95) == 0
+    assert h.failure_rate("C") == None
+    assert h.p95_duration("A") == 95
+    assert h.p95_duration("B") == 5
+    assert h.job_names() == ["A", "B"]
+
+def test_history_store_prune(tmp_path):
+    h = history.HistoryStore(str(tmp_path / "h.db"), flush_interval=0.01)
+    h.add_run(_finished_run("A", 0, 1, time.time() - 10 * 24 * 3600))
+    h.add_run(_finished_run("A", 0, 2, time.time()))
+    h.add_message("A", "old", t=time.time() - 10 * 24 * 3600)
+    h.flush(timeout=5)
+    h.prune(retention_days=5)
+    assert [r["wall_time"] for r in h.last_runs("A")] == [2]
+    assert h._query("SELECT count(*) FROM messages") == [(0,)]
+
+def test_history_commands_without_durations(capsys):
+    class History:
+        def job_names(self):
+            return ["A"]
+        def failure_rate(self, name):
+            return None
+        def p95_duration(self, name):
+            return None
+    class A:
+        def history(self):
+            return History()
+    assistant.cmd_job_p95(A())
+    assistant.cmd_job_failure_rate(A())
+    assert capsys.readouterr().out.split('\n')[:2] == [
+        f"  {'A':20}        -", f"  {'A':20}      -"]
+
+###
+### joblog
+###
+def test_rotating_log(tmp_path):
+    path = str(tmp_path / "logs" / "a.log")
+    log = joblog.RotatingLog(path, max_bytes=10, backups=2)
+    for i in range(4):
+        log.write(f"{i} 345678\n".encode())
+    log.close()
+    assert open(path).read() == "3 345678\n"
+    assert open(path + ".1").read() == "2 345678\n"
+    assert open(path + ".2").read() == "1 345678\n"
+    assert not os.path.exists(path + ".3")
+
+def test_shared_log_of_concurrent_runs(tmp_path):
+    path = str(tmp_path / "a.log")
+    logs = [joblog.open_shared(path, max_bytes=100, backups=1000)
+            for _ in range(4)]
+    assert all(l is logs[0] for l in logs)
+
+    def _run(log, i):
+        for _ in range(100):
+            log.write(b"%d 345678\n" % i)
+        joblog.close_shared(log)
+
+    threads = [threading.Thread(target=_run, args=(l, i))
+               for i, l in enumerate(logs)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    lines = []
+    for p in os.listdir(tmp_path):
+        lines += open(tmp_path / p).read().splitlines()
+    assert sorted(lines) == sorted(f"{i} 345678" for i in range(4)
+                                   for _ in range(100))
+    assert path not in joblog._shared
+
+def test_capture_keeps_last_lines(tmp_path):
+    r, w = os.pipe()
+    log = joblog.RotatingLog(str(tmp_path / "a.log"))
+    t = threading.Thread(target=lambda: os.close(w) if os.write(
+        w, b"".join(b"line %d\n" % i for i in range(10000))) else None)
+    t.start()
+    last = joblog.capture([r], log, keep_lines=2)
+    t.join()
+    os.close(r)
+    log.close()
+    assert last == ["line 9998", "line 9999"]
+    assert len(joblog.tail(log.path, 10000)) == 10000
+    assert joblog.tail(log.path, 3) == ["line 9997", "line 9998", "line 9999"]
+
+@pytest.mark.parametrize("mode", ["subprocess", "pool"])
+def test_job_output_to_log(tmp_path, monkeypatch, mode):
+    monkeypatch.chdir(tmp_path)
+    cfg = dict(settings.SETTINGS_DEFAULT, executor=dict(
+        settings.SETTINGS_DEFAULT["executor"], mode=mode, pool_size=1),
+        logs=dict(settings.SETTINGS_DEFAULT["logs"], forward_lines=2))
+    (tmp_path / "settings.json").write_text(json.dumps(cfg))
+    monkeypatch.setattr(settings, "_cache", settings.SettingsCache())
+    sent = []
+    monkeypatch.setattr(api, "send_message", sent.append)
+    path = tmp_path / "job.py"
+    path.write_text("import sys\nprint('out')\n"
+                    "print('err', file=sys.stderr)\nsys.exit(3)")
+    a = assistant.Assistant()
+    a.add_job("Out Job", str(path), params=None, is_active=True)
+    run = a.executor.fire(a.jobs["Out Job"])
+    assert _wait_for(lambda: a.stats.runs("Out Job"), timeout=10)
+    assert run.exit_code == 3
+    lines = joblog.tail(str(tmp_path / "logs" / "out_job.log"))
+    assert sorted(lines[1:3]) == ["err", "out"]
+    assert lines[-1] == "--- exit code 3"
+    assert sent[0]["job_name"] == "Out Job"
+    assert sent[0]["text"].startswith("Job failed with exit code 3:")
+    if a._pool:
+        a._pool.close()
+
 ###
 ### job
 ###
@@ -117,6 +558,14 @@ def test_job_json():
         "path": "path",
         "params": params,
         "is_active": False,
+        "max_instances": 1,
+        "overlap": "skip",
+        "timeout": None,
+        "catch_up": "skip",
+        "jitter": None,
+        "triggers": [],
+        "depends_on": [],
+        "label": None,
         "schedule": []}
 
 def test_job_with_schedule_json():
@@ -130,6 +579,14 @@ def test_job_with_schedule_json():
         "path": "path",
         "params": None,
         "is_active": False,
+        "max_instances": 1,
+        "overlap": "skip",
+        "timeout": None,
+        "catch_up": "skip",
+        "jitter": None,
+        "triggers": [],
+        "depends_on": [],
+        "label": None,
         "schedule": [
             {
                 "time": "16:45:00",
@@ -144,6 +601,25 @@ def test_job_with_schedule_json():
         ]
     }
 
+def test_job_overlap_round_trip():
+    j = job.Job("A", "path", max_instances=2, overlap=executor.Overlap.queue)
+    j2 = job.from_cfg(j.json())
+    assert j2.max_instances == 2
+    assert j2.overlap == executor.Overlap.queue
+    j3 = job.from_cfg(_jobs_cfg["jobs"]["test_job"])
+    assert j3.max_instances == 1
+    assert j3.overlap == executor.Overlap.skip
+    with pytest.raises(job.JobInitException):
+        job.Job("A", "path", overlap="bla")
+    with pytest.raises(job.JobInitException):
+        job.Job("A", "path", max_instances=0)
+
+def test_job_timeout_round_trip():
+    assert job.from_cfg(job.Job("A", "path", timeout=30).json()).timeout == 30
+    assert job.from_cfg(_jobs_cfg["jobs"]["test_job"]).timeout == None
+    with pytest.raises(job.JobInitException):
+        job.Job("A", "path", timeout=0)
+
 def test_job_params_list():
     j = job.Job("a", "", params="a=1 b=bb")
     assert j.params_list() == ["a=1", "b=bb"]
@@ -184,6 +660,121 @@ def test_schedule_raise_on_incorrect_time():
     with pytest.raises(ScheduleInitException):
         Schedule("11:20:00", Interval.daily)
 
+def _cron_matches(c, t):
+    dow = (t.weekday() + 1) % 7
+    dom_ok, dow_ok = c.dom >> t.day & 1, c.dow >> dow & 1
+    if c.dom_any and c.dow_any:
+        day_ok = True
+    elif c.dom_any:
+        day_ok = dow_ok
+    elif c.dow_any:
+        day_ok = dom_ok
+    else:
+        day_ok = dom_ok or dow_ok
+    return bool(day_ok and c.months >> t.month & 1 and c.hours >> t.hour & 1
+                and c.minutes >> t.minute & 1)
+
+@pytest.mark.parametrize("expr", ["*/15 * * * *", "0 9-17/2 * * mon-fri",
+    "30 6 1,15 * 5", "5 4 * 1-3 sun", "@hourly"])
+def test_cron_next_after_matches_minute_scan(expr):
+    c = cron.Cron(expr)
+    t = datetime.datetime(2026, 1, 30, 23, 58, 30)
+    for _ in range(5):
+        nxt = c.next_after(t)
+        scan = t.replace(second=0, microsecond=0)
+        for _ in range(60 * 24 * 366 * 3):
+            scan += datetime.timedelta(minutes=1)
+            if _cron_matches(c, scan):
+                break
+        assert nxt == scan
+        t = nxt
+
+def test_cron_leap_day():
+    c = cron.Cron("0 0 29 2 *")
+    assert c.next_after(datetime.datetime(2026, 1, 1)) == \
+        datetime.datetime(2028, 2, 29)
+    assert c.next_after(datetime.datetime(2096, 3, 1)) == \
+        datetime.datetime(2104, 2, 29)
+
+def test_cron_rejects_bad_expressions():
+    for expr in ["* * * *", "60 * * * *", "*/0 * * * *", "0 0 31 2 *",
+                 "a * * * *", "5-1 * * * *"]:
+        with pytest.raises(cron.CronSyntaxException):
+            cron.Cron(expr)
+
+def test_every_next_after():
+    e = cron.Every("every 15s")
+    t = datetime.datetime(2026, 1, 1, 10, 0, 7)
+    assert e.next_after(t) == datetime.datetime(2026, 1, 1, 10, 0, 15)
+    assert e.next_after(datetime.datetime(2026, 1, 1, 23, 59, 50)) == \
+        datetime.datetime(2026, 1, 2)
+    w = cron.Every("5m between 08:00 and 18:00")
+    assert w.next_after(datetime.datetime(2026, 1, 1, 3)) == \
+        datetime.datetime(2026, 1, 1, 8)
+    assert w.next_after(datetime.datetime(2026, 1, 1, 8)) == \
+        datetime.datetime(2026, 1, 1, 8, 5)
+    assert w.next_after(datetime.datetime(2026, 1, 1, 17, 59)) == \
+        datetime.datetime(2026, 1, 1, 18)
+    assert w.next_after(datetime.datetime(2026, 1, 1, 18)) == \
+        datetime.datetime(2026, 1, 2, 8)
+    for spec in ["15", "0s", "5m between 18:00 and 08:00", "1m between x and y"]:
+        with pytest.raises(cron.CronSyntaxException):
+            cron.Every(spec)
+
+def test_compiled_schedule_json_round_trip():
+    j = job.Job("A", "path")
+    j.schedule.append(Schedule(None, Interval.cron, "0 9 * * mon-fri"))
+    j.schedule.append(Schedule(None, Interval.every, "30s"))
+    assert j.schedule_json()[0] == {
+        "time": None, "interval": "cron", "interval_arg": "0 9 * * mon-fri"}
+    j2 = job.from_cfg(j.json())
+    assert [s.json() for s in j2.schedule] == j.schedule_json()
+    with pytest.raises(ScheduleInitException):
+        Schedule(datetime.time(10), Interval.cron, "0 9 * * *")
+    with pytest.raises(ScheduleInitException):
+        Schedule(None, Interval.every, "soon")
+
+def test_scheduler_fires_every_second():
+    fired = []
+    s = Scheduler(lambda arg, name: fired.append(time.monotonic()), None)
+    s.schedule_event(Event("A", Schedule(None, Interval.every, "1s")))
+    assert _wait_for(lambda: len(fired) >= 2, timeout=4)
+    assert fired[1] - fired[0] == pytest.approx(1, abs=0.2)
+    s.cancel_events("A")
+
+def test_event_jitter_spreads_fires():
+    sched = Schedule(datetime.time(9), Interval.daily)
+    entries = [scheduler._Entry(Event(f"job{i}", sched, jitter=600))
+               for i in range(50)]
+    day = datetime.datetime(2026, 1, 10)
+    runs = [e.next_after(day) for e in entries]
+    assert all(datetime.datetime(2026, 1, 10, 9) <= r <
+               datetime.datetime(2026, 1, 10, 9, 10) for r in runs)
+    assert len(set(runs)) > 40
+    # Stable: the same offset every day and for the same name.
+    e = entries[0]
+    assert e.next_after(runs[0]) - runs[0] == datetime.timedelta(days=1)
+    assert scheduler._Entry(Event("job0", sched, jitter=600)).next_after(
+        day) == runs[0]
+    assert scheduler._Entry(Event("job0", sched)).next_after(day) == \
+        datetime.datetime(2026, 1, 10, 9)
+
+def test_assistant_jitter_from_settings(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = dict(settings.SETTINGS_DEFAULT, scheduler=dict(
+        settings.SETTINGS_DEFAULT["scheduler"], jitter=30))
+    (tmp_path / "settings.json").write_text(json.dumps(cfg))
+    monkeypatch.setattr(settings, "_cache", settings.SettingsCache())
+    a = assistant.Assistant()
+    a.add_job("A", "path", params=None, is_active=True)
+    a.add_job("B", "path", params=None, is_active=True, jitter=0)
+    s = Schedule(datetime.time(9), Interval.daily)
+    a.reschedule_job("A", s)
+    a.reschedule_job("B", s)
+    assert a.scheduler.jobs["A"][s].event.jitter == 30
+    assert a.scheduler.jobs["B"][s].event.jitter == 0
+    assert job.from_cfg(a.jobs["B"].json()).jitter == 0
+
 def _test_runner(a, b):
     pass
 
@@ -192,21 +783,177 @@ def test_scheduler_flow():
     t = datetime.datetime.now() + datetime.timedelta(seconds=10)
     t1 = t.time()
     s.schedule_event(Event(name="TestEvent", schedule=Schedule(t1, "daily")))
-    assert len(s._s.jobs) == 1
-    assert s._s.jobs[0].next_run.second == t.second
-    assert s._s.jobs[0].next_run.minute == t.minute
+    assert len(s._s) == 1
+    entry, = s.jobs["TestEvent"].values()
+    assert entry.next_run.second == t.second
+    assert entry.next_run.minute == t.minute
     assert len(s.jobs) == 1
     assert "TestEvent" in s.jobs
     t2 = (t + datetime.timedelta(seconds=20)).time()
     s.schedule_event(Event(name="TestEvent", schedule=Schedule(t2, "daily")))
     assert len(s.jobs) == 1
     assert len(s.jobs["TestEvent"]) == 2
-    assert len(s._s.jobs) == 2
+    assert len(s._s) == 2
     s.cancel_events("TestEvent")
-    assert len(s._s.jobs) == 0
+    assert len(s._s) == 0
     assert len(s.jobs) == 0
 
-def test_scheduler_next_job_run():
+def _stopped_engine(fired):
+    e = scheduler._Engine(fired.append)
+    e.clear()  # stops the engine thread, _pop_due is called by the test
+    return e
+
+@pytest.mark.parametrize("catch_up,fires", [
+    (scheduler.CatchUp.skip, 0), (scheduler.CatchUp.once, 1),
+    (scheduler.CatchUp.all, 3)])
+def test_engine_catches_up_from_watermark(catch_up, fires):
+    e = _stopped_engine([])
+    ev = Event("A", Schedule(datetime.time(10), Interval.daily), catch_up)
+    entry = scheduler._Entry(ev)
+    now = datetime.datetime(2026, 1, 10, 12)
+    e.watermarks.set(entry.key, datetime.datetime(2026, 1, 7, 11))
+    e.add(entry, now=now, catch_up=True)
+    assert entry.next_run == datetime.datetime(2026, 1, 8, 10)
+    due = e._pop_due(now)
+    assert sum(n for _, n in due) == fires
+    assert entry.next_run == datetime.datetime(2026, 1, 11, 10)
+    assert e.watermarks.get(entry.key) == now
+
+def test_engine_missed_fires_on_clock_jump():
+    e = _stopped_engine([])
+    ev = Event("A", Schedule(datetime.time(10), Interval.daily))
+    entry = scheduler._Entry(ev)
+    e.add(entry, now=datetime.datetime(2026, 1, 10, 9))
+    now = datetime.datetime(2026, 1, 10, 10, 0, 10)
+    assert e._pop_due(now, jumped_from=now - datetime.timedelta(
+        seconds=30)) == []
+    e, entry = _stopped_engine([]), scheduler._Entry(ev)
+    e.add(entry, now=datetime.datetime(2026, 1, 10, 9))
+    assert e._pop_due(now) == [(entry, 1)]
+
+def test_engine_unschedules_entry_without_fires():
+    class Rule:  # fires once, at 10:00 on 2026/1/10
+        def next_after(self, dt):
+            t = datetime.datetime(2026, 1, 10, 10)
+            return t if dt < t else None
+    e = _stopped_engine([])
+    ev = Event("A", Schedule(datetime.time(10), Interval.daily))
+    entry = scheduler._Entry(ev)
+    entry.rule = Rule()
+    e.add(entry, now=datetime.datetime(2026, 1, 10, 9))
+    assert e._pop_due(datetime.datetime(2026, 1, 10, 10)) == [(entry, 1)]
+    assert not entry.is_scheduled
+    assert e.next_run() is None
+    e.add(entry, now=datetime.datetime(2026, 1, 11))
+    assert not entry.is_scheduled
+    e.take_over()
+
+def test_engine_resume_does_not_catch_up():
+    e = _stopped_engine([])
+    ev = Event("A", Schedule(datetime.time(10), Interval.daily),
+               scheduler.CatchUp.all)
+    entry = scheduler._Entry(ev)
+    e.watermarks.set(entry.key, datetime.datetime(2026, 1, 1))
+    now = datetime.datetime(2026, 1, 10, 12)
+    e.add(entry, now=now)
+    assert entry.next_run == datetime.datetime(2026, 1, 11, 10)
+    assert e.watermarks.get(entry.key) == now
+
+def test_scheduler_catches_up_after_restart(tmp_path):
+    state = str(tmp_path / "state.json")
+    now = datetime.datetime.now()
+    t = now - datetime.timedelta(minutes=2)
+    ev = Event("A", Schedule(t.time(), Interval.daily), scheduler.CatchUp.once)
+    marks = scheduler.Watermarks(state)
+    marks.set(scheduler._event_key(ev), now - datetime.timedelta(days=1))
+    marks.save()
+    fired = []
+    s = Scheduler(lambda arg, name: fired.append(name), None, state)
+    s.schedule_event(ev)
+    assert _wait_for(lambda: fired == ["A"])
+    assert _wait_for(lambda: scheduler.Watermarks(state).get(
+        scheduler._event_key(ev)) > now)
+    assert s.jobs["A"][ev.schedule].next_run > now
+
+def test_engine_restart_before_first_fire_catches_up(tmp_path):
+    state = str(tmp_path / "state.json")
+    ev = Event("A", Schedule(datetime.time(10), Interval.daily),
+               scheduler.CatchUp.once)
+    t0 = datetime.datetime(2026, 1, 10, 9)
+    e = scheduler._Engine(None, scheduler.Watermarks(state))
+    e.clear()
+    e.add(scheduler._Entry(ev), now=t0)
+    # Skipped (late) fires move the saved mark too.
+    skipped = Event("B", Schedule(datetime.time(8), Interval.daily))
+    e.add(b := scheduler._Entry(skipped), now=t0 - datetime.timedelta(days=1))
+    assert e._pop_due(t0) == []
+    marks = scheduler.Watermarks(state)
+    assert marks.get(b.key) == t0
+    e2 = scheduler._Engine(None, marks)
+    e2.clear()
+    e2.add(entry := scheduler._Entry(ev), now=t0 + datetime.timedelta(days=2),
+           catch_up=True)
+    assert entry.next_run == datetime.datetime(2026, 1, 10, 10)
+    assert e2._pop_due(t0 + datetime.timedelta(days=2)) == [(entry, 1)]
+
+def test_engine_saves_added_marks_once(tmp_path):
+    state = str(tmp_path / "state.json")
+    s = Scheduler(lambda arg, name: None, None, state)
+    marks, saves = s._s.watermarks, []
+    save = marks.save
+    marks.save = lambda: saves.append(1) or save()
+    events = [Event("A", Schedule(datetime.time(h, m), Interval.daily))
+              for h in range(10) for m in range(20)]
+    for ev in events:
+        s.schedule_event(ev)
+    assert _wait_for(lambda: os.path.exists(state))
+    assert len(scheduler.Watermarks(state)._marks) == 200
+    assert len(saves) == 1
+    s.cancel_event("A", events[0].schedule)
+    s.cancel_events("A")
+    s._s.clear()
+    assert scheduler.Watermarks(state)._marks == {}
+
+def test_standby_engine_takes_over_without_duplicates(tmp_path):
+    state = str(tmp_path / "state.json")
+    ev = Event("A", Schedule(None, Interval.every, "1m"))
+    t0 = datetime.datetime(2026, 1, 10, 10, 0, 30)
+    engines = []
+    for active in (True, False):
+        e = scheduler._Engine(None, scheduler.Watermarks(state), active)
+        e.clear()  # stops the engine thread, _pop_due is called by the test
+        entry = scheduler._Entry(ev)
+        e.add(entry, now=t0)
+        engines.append((e, entry))
+    (lead, lead_entry), (standby, entry) = engines
+    for minute in (1, 2):
+        now = t0.replace(minute=minute, second=0)
+        assert lead._pop_due(now) == [(lead_entry, 1)]
+        lead.watermarks.save()
+        assert standby._pop_due(now) == []
+        assert entry.next_run == now + datetime.timedelta(minutes=1)
+    # The leader fired 10:02 and died, the 10:03 fire is due in the gap.
+    standby.take_over(now=t0.replace(minute=2))
+    assert entry.next_run == t0.replace(minute=3, second=0)
+    assert standby._pop_due(t0.replace(minute=2, second=50)) == []
+    assert standby._pop_due(t0.replace(minute=3, second=20)) == [(entry, 1)]
+
+def test_lease_fails_over(tmp_path):
+    path = str(tmp_path / "lock")
+    taken = []
+    first = leader.Lease(path, lambda: taken.append(1)).start()
+    assert _wait_for(lambda: taken == [1])
+    second = leader.Lease(path, lambda: taken.append(2)).start()
+    time.sleep(0.3)
+    assert taken == [1] and not second.is_held
+    assert second.holder() == f"{socket.gethostname()}:{os.getpid()}"
+    first.release()
+    assert _wait_for(lambda: taken == [1, 2], timeout=1)
+    assert second.is_held
+    second.release()
+
+def test_scheduler_next_job_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
     a = assistant.Assistant()
     a.add_job("A", "path", params=None, is_active=True)
     in_15_minutes = datetime.datetime.now() + datetime.timedelta(minutes=15)
@@ -221,11 +968,91 @@ def test_scheduler_next_job_run():
     a.scheduler.cancel_events("A")
     assert a.next_run() == None
 
+def test_scheduler_single_schedule_changes():
+    s = Scheduler(_test_runner, None)
+    s0 = Schedule(datetime.time(10), Interval.daily)
+    s1 = Schedule(datetime.time(11), Interval.daily)
+    s.schedule_event(Event("A", s0))
+    s.schedule_event(Event("A", s1))
+    e0 = s.jobs["A"][s0]
+    s.schedule_event(Event("A", s0))
+    assert not e0.is_scheduled
+    assert len(s._s) == 2
+    s.cancel_event("A", s1)
+    assert list(s.jobs["A"]) == [s0]
+    s.cancel_event("A", s0)
+    assert "A" not in s.jobs
+    assert len(s._s) == 0
+
+def test_assistant_enable_disable_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = assistant.Assistant()
+    a.add_job("A", "path", params=None, is_active=True)
+    s0 = Schedule(datetime.time(10), Interval.daily)
+    a.reschedule_job("A", s0)
+    entry = a.scheduler.jobs["A"][s0]
+    next_run = a.next_run()
+    a.disable_job("A")
+    assert a.jobs["A"].is_active == False
+    assert a.next_run() == None
+    a.enable_job("A")
+    assert a.scheduler.jobs["A"][s0] is entry
+    assert a.next_run() == next_run
+    assert len(a.scheduler._s) == 1
+    assert len(a.scheduler._s._heap) == 1
+
+def test_scheduler_compacts_cancelled_entries():
+    s = Scheduler(_test_runner, None)
+    for i in range(200):
+        s.schedule_event(Event(str(i), Schedule(datetime.time(10), "daily")))
+    for i in range(150):
+        s.cancel_events(str(i))
+    assert len(s._s) == 50
+    assert len(s._s._heap) < 200
+
+def test_assistant_unschedule_job(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = assistant.Assistant()
+    a.add_job("A", "path", params=None, is_active=True)
+    s0 = Schedule(datetime.time(10), Interval.daily)
+    s1 = Schedule(datetime.time(11), Interval.daily)
+    a.reschedule_job("A", s0)
+    e0 = a.scheduler.jobs["A"][s0]
+    a.reschedule_job("A", s1)
+    assert a.scheduler.jobs["A"][s0] is e0
+    a.unschedule_job("A", s0)
+    assert a.jobs["A"].schedule == [s1]
+    assert list(a.scheduler.jobs["A"]) == [s1]
+
+def test_scheduler_entry_next_after():
+    e = scheduler._Entry(Event("A", Schedule(datetime.time(9), Interval.workdays)))
+    friday = datetime.datetime(2024, 5, 3, 9)
+    assert e.next_after(friday - datetime.timedelta(seconds=1)) == friday
+    assert e.next_after(friday) == datetime.datetime(2024, 5, 6, 9)
+    e = scheduler._Entry(Event("A", Schedule(datetime.time(9), Interval.weekday,
+                                             Day.Sunday)))
+    assert e.next_after(friday) == datetime.datetime(2024, 5, 5, 9)
+
+def test_scheduler_fires_at_deadline():
+    fired = []
+    s = Scheduler(lambda a, name: fired.append((name, datetime.datetime.now())),
+                  None)
+    t = datetime.datetime.now() + datetime.timedelta(seconds=1.5)
+    t = t.replace(microsecond=0)
+    s.schedule_event(Event(name="E", schedule=Schedule(t.time(), "daily")))
+    assert _wait_for(lambda: fired, timeout=3)
+    name, fired_at = fired[0]
+    assert name == "E"
+    assert t <= fired_at < t + datetime.timedelta(seconds=0.1)
+    assert s.next_run() == t + datetime.timedelta(days=1)
+
 def test_interval():
     intervals = [
         scheduler.Interval.daily,
         scheduler.Interval.weekday,
-        scheduler.Interval.workdays
+        scheduler.Interval.workdays,
+        scheduler.Interval.cron,
+        scheduler.Interval.every
     ]
     assert set(scheduler.Interval.list()) == set(intervals)
 
@@ -250,17 +1077,477 @@ def test_is_slack_connection_ok():
 
 def test_slack_channels():
     class Result:
-        data = {'ok': True, 'channels': [{'name': 'a'}, {'name': 'b'}]}
+        data = {'ok': True, 'channels': [{'name': 'a', 'id': 'C1'},
+                                         {'name': 'b', 'id': 'C2'}]}
     class Client:
-        def conversations_list(self):
+        def conversations_list(self, **kwargs):
             return Result()
-    assert messenger._slack_channels(Client()) == ['a', 'b']
+    assert messenger._slack_channels(Client()) == {'a': 'C1', 'b': 'C2'}
 
 def test_slack_send_message_main_raises_on_bad_token():
     cfg = {'token': None}
     with pytest.raises(messenger.MessengerClientAuthSetupException):
         messenger._slack_send_message_main(cfg=cfg, payload=None)
 
+@pytest.fixture
+def slack():
+    s = slack_standin.SlackServer(channels=['job']).start()
+    yield s
+    s.stop()
+
+def _slack_cfg(slack):
+    return {'name': 'slack', 'token': 'xoxb-test', 'user_id': 'U1',
+            'base_url': slack.base_url}
+
+def test_slack_session_is_reused(slack):
+    cfg = _slack_cfg(slack)
+    for i in range(3):
+        messenger.send_message(cfg, {'job_name': 'Job', 'text': str(i)})
+    assert slack.requests['api.test'] == 0
+    assert slack.requests['chat.postMessage'] == 3
+    # The workspace is listed once, then one request per message.
+    assert slack.total == 1 + 3
+    assert messenger._slack_session(cfg) is messenger._slack_session(cfg)
+
+def test_slack_channels_pagination():
+    slack = slack_standin.SlackServer(channels=['a', 'b', 'c', 'd', 'e'],
+                                      page_size=2).start()
+    client = messenger.SlackSession('t', 'U1', slack.base_url).client
+    channels = messenger._slack_channels(client)
+    slack.stop()
+    assert list(channels) == ['a', 'b', 'c', 'd', 'e']
+    assert slack.requests['conversations.list'] == 3
+
+def test_slack_channel_registry_create_and_invalidate(slack, tmp_path):
+    path = str(tmp_path / 'channels.json')
+    session = messenger.SlackSession('t', 'U1', slack.base_url, path)
+    session.send({'job_name': 'New Job', 'text': 'a'})
+    session.send({'job_name': 'New Job', 'text': 'b'})
+    assert slack.requests['conversations.list'] == 1
+    assert slack.requests['conversations.create'] == 1
+    assert slack.requests['conversations.invite'] == 1
+    with open(path) as f:
+        assert json.load(f)['new_job'] == slack.channels['new_job']
+    # Restart reads the map from disk instead of listing the workspace.
+    session = messenger.SlackSession('t', 'U1', slack.base_url, path)
+    session.send({'job_name': 'New Job', 'text': 'c'})
+    assert slack.requests['conversations.list'] == 1
+    slack.fail['chat.postMessage'] = (
+        200, {}, {'ok': False, 'error': 'channel_not_found'})
+    session.send({'job_name': 'New Job', 'text': 'd'})
+    assert slack.requests['conversations.list'] == 2
+    assert slack.requests['chat.postMessage'] == 5
+
+def test_slack_channel_name_taken(slack):
+    session = messenger.SlackSession('t', 'U1', slack.base_url)
+    assert session.channels.channel_id(session.client, 'other') == None
+    slack.channels['other'] = 'C9'
+    session.send({'job_name': 'other', 'text': 'a'})
+    assert slack.calls[-1] == ('chat.postMessage',
+                               {'channel': 'C9', 'text': 'a'})
+
+def test_slack_session_checks_connection_after_failure(slack):
+    session = messenger.SlackSession('xoxb-test', 'U1', slack.base_url)
+    session.client.base_url = 'http://127.0.0.1:1/api/'
+    with pytest.raises(messenger.SlackConnectionException):
+        session.send({'job_name': 'job', 'text': 'a'})
+    session.client.base_url = slack.base_url
+    session.send({'job_name': 'job', 'text': 'b'})
+    assert slack.requests['api.test'] == 1
+    assert slack.requests['chat.postMessage'] == 1
+
+###
+### api
+###
+@pytest.fixture
+def broker(monkeypatch):
+    b = broker_standin.Broker().start()
+    monkeypatch.setattr(api, 'PIKA_HOST', '127.0.0.1')
+    monkeypatch.setattr(api, 'PIKA_PORT', b.port)
+    yield b
+    b.stop()
+
+def _wait_for(cond, timeout=2):
+    deadline = time.time() + timeout
+    while not cond() and time.time() < deadline:
+        time.sleep(0.01)
+    return cond()
+
+def test_publisher_reuses_connection(broker):
+    p = api.Publisher()
+    for i in range(5):
+        p.publish(json.dumps({'i': i}))
+    p.close()
+    assert _wait_for(lambda: len(broker.queues[api.PIKA_QUEUE]) == 5)
+    assert broker.stats['connections'] == 1
+
+def test_publisher_reconnects_after_broker_restart(broker):
+    p = api.Publisher()
+    p.publish('a')
+    broker.stop()
+    broker.start()
+    p.publish('b')
+    p.close()
+    assert _wait_for(lambda: len(broker.queues[api.PIKA_QUEUE]) == 2)
+    assert broker.stats['connections'] == 2
+
+def test_batch_flushes_on_size_and_exit(broker):
+    p = api.Publisher(confirm=True)
+    with api.Batch(p, max_size=3, max_delay=60) as b:
+        for i in range(4):
+            b.send({'i': i})
+        assert b.delivered == 3
+    assert b.delivered == 4
+    p.close()
+    assert len(broker.queues[api.PIKA_QUEUE]) == 4
+    # One round-trip per flush.
+    assert broker.stats['commits'] == 2
+
+def test_batch_flushes_on_delay(broker):
+    p = api.Publisher(confirm=True)
+    b = api.Batch(p, max_size=100, max_delay=0.05)
+    b.send({'i': 0})
+    assert _wait_for(lambda: b.delivered == 1)
+    p.close()
+
+def test_batch_raises_when_not_delivered(broker):
+    broker.stop()
+    p = api.Publisher(confirm=True)
+    with pytest.raises(api.BatchPublishException):
+        with api.Batch(p, max_delay=60) as b:
+            b.send({'i': 0})
+    assert b.delivered == 0
+
+def test_batch_keeps_only_unsent_messages():
+    class Publisher:
+        def __init__(self):
+            self.sent = []
+        def publish_many(self, bodies):
+            if not self.sent:
+                self.sent.extend(bodies[:2])
+                raise api.PublishException(2, OSError())
+            self.sent.extend(bodies)
+    p = Publisher()
+    b = api.Batch(p, max_delay=60)
+    for i in range(3):
+        b.send({'i': i})
+    with pytest.raises(api.BatchPublishException):
+        b.flush()
+    assert b.delivered == 2
+    b.flush()
+    assert [json.loads(m)['i'] for m in p.sent] == [0, 1, 2]
+    assert b.delivered == 3
+
+def _start_receiver(callback, prefetch, workers):
+    t = threading.Thread(target=api.receiver,
+                         args=(callback, prefetch, workers), daemon=True)
+    t.start()
+
+def test_receiver_workers_and_acks(broker):
+    def callback(body):
+        time.sleep(0.2)
+    _start_receiver(callback, prefetch=8, workers=8)
+    p = api.Publisher()
+    for i in range(8):
+        p.publish(str(i))
+    p.close()
+    t = time.time()
+    assert _wait_for(lambda: len(broker.acked) == 8)
+    assert time.time() - t < 1
+    assert len(broker.queues[api.PIKA_QUEUE]) == 0
+
+def test_receiver_dead_letters_failed_messages(broker):
+    def callback(body):
+        if body == b'bad':
+            raise ValueError(body)
+    _start_receiver(callback, prefetch=2, workers=1)
+    p = api.Publisher()
+    for body in ['ok', 'bad', 'ok']:
+        p.publish(body)
+    p.close()
+    assert _wait_for(lambda: len(broker.acked) == 3)
+    assert list(broker.queues[api.PIKA_DEAD_LETTER_QUEUE]) == [b'bad']
+
+def test_receiver_acks_after_future_completes(broker):
+    f = concurrent.futures.Future()
+    _start_receiver(lambda body: f, prefetch=1, workers=1)
+    api.Publisher().publish('a')
+    time.sleep(0.2)
+    assert broker.acked == []
+    f.set_result(None)
+    assert _wait_for(lambda: broker.acked == [b'a'])
+
+@pytest.fixture
+def local_broker(tmp_path, monkeypatch):
+    monkeypatch.setenv(api.LOCAL_SOCKET_ENV, '')
+    monkeypatch.setattr(api, 'LOCAL_SOCKET', None)
+    b = api.serve_local(str(tmp_path / 'assistant.sock'))
+    yield b
+    b.stop()
+
+def test_local_broker_acks_and_dead_letters(local_broker):
+    f = concurrent.futures.Future()
+    got = []
+    def callback(body):
+        got.append(body)
+        if body == b'bad':
+            raise ValueError(body)
+        if body == b'wait':
+            return f
+    _start_receiver(callback, prefetch=2, workers=2)
+    p = api.Publisher(confirm=True)
+    for body in ['wait', 'ok', 'bad', 'ok']:
+        p.publish(body)
+    p.close()
+    assert _wait_for(lambda: len(got) == 4)
+    assert _wait_for(lambda: list(
+        local_broker.queues[api.PIKA_DEAD_LETTER_QUEUE]) == [b'bad'])
+    client = local_broker.consumers[api.PIKA_QUEUE][0][0]
+    assert list(client.unacked.values()) == [(api.PIKA_QUEUE, b'wait')]
+    f.set_result(None)
+    assert _wait_for(lambda: not client.unacked)
+
+def test_local_broker_events_and_restart(local_broker):
+    got = []
+    threading.Thread(target=api.event_receiver, args=(got.append, 'backup.*'),
+                     daemon=True).start()
+    assert _wait_for(lambda: local_broker.exchanges.get(
+        api.PIKA_EVENTS_EXCHANGE))
+    p = api.Publisher(exchange=api.PIKA_EVENTS_EXCHANGE)
+    p.publish('a', routing_key='backup.done')
+    p.publish('b', routing_key='other.done')
+    assert _wait_for(lambda: got == [b'a'])
+    local_broker.stop()
+    b = local_broker.__class__(local_broker.path).start()
+    try:
+        p.publish('c', routing_key='backup.done')  # reconnects
+        assert list(b.queues) == []  # no binding survives the restart
+    finally:
+        p.close()
+        b.stop()
+
+def test_local_broker_is_not_blocked_by_a_slow_consumer(local_broker):
+    slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    slow.connect(local_broker.path)  # consumes, never reads
+    slow.sendall(localbroker._frame(b'D', b'slow') +
+                 localbroker._frame(b'C', b'slow', b'1'))
+    p = api.Publisher(queue='slow')
+    for _ in range(200):
+        p.publish('x' * 65536)
+    t = time.time()
+    other = api.Publisher(queue='other', confirm=True)
+    other.publish('a')
+    assert time.time() - t < 1
+    assert list(local_broker.queues['other']) == [b'a']
+    for c in (p, other, slow):
+        c.close()
+
+def test_local_broker_keeps_a_running_broker(local_broker, tmp_path):
+    with pytest.raises(localbroker.BrokerError):
+        localbroker.LocalBroker(local_broker.path).start()
+    stale = str(tmp_path / "stale.sock")
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.bind(stale)
+    s.close()
+    localbroker.LocalBroker(stale).start().stop()
+
+def test_event_triggers_subscribed_jobs(broker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(api, "_event_publisher",
+                        api.Publisher(exchange=api.PIKA_EVENTS_EXCHANGE))
+    path = tmp_path / "job.py"
+    path.write_text("import os, sys\n"
+                    "open(sys.argv[1], 'w').write(os.environ['ASSISTANT_EVENT'])")
+    a = assistant.Assistant()
+    for name in "ABC":
+        a.add_job(name, str(path), params=str(tmp_path / name),
+                  is_active=name != "C", triggers=["backup.done"])
+    a.add_job("D", str(path), params=str(tmp_path / "D"), is_active=True,
+              triggers=["other"])
+    assert a.triggers == {"backup.done": ["A", "B", "C"], "other": ["D"]}
+    assert _wait_for(lambda: broker.exchanges.get(api.PIKA_EVENTS_EXCHANGE))
+    api.publish_event("backup.done", {"size": 3})
+    assert _wait_for(lambda: len(a.stats.runs()) == 2, timeout=5)
+    for name in "AB":
+        assert json.loads((tmp_path / name).read_text()) == \
+            {"event": "backup.done", "data": {"size": 3}}
+    assert not (tmp_path / "C").exists()
+    assert not (tmp_path / "D").exists()
+
+def test_reloaded_job_is_triggered_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a = assistant.Assistant()
+    a.add_job("A", "p", None, True, triggers=["x", "y"])
+    a.load_job_from_json(job.Job("A", "p", triggers=["x"]).json())
+    assert a.triggers == {"x": ["A"]}
+    a.add_job("B", "p", None, True, depends_on=["A"])
+    a.add_job("C", "p", None, True, depends_on=["A"])
+    a.load_job_from_json(job.Job("B", "p", depends_on=["A"]).json())
+    a.load_job_from_json(job.Job("C", "p").json())
+    assert a.dependents == {"A": ["B"]}
+
+def test_malformed_events_are_dropped():
+    fired = []
+    class A:
+        triggers = {"x": ["J"]}
+        jobs = {"J": job.Job("J", "p", is_active=True)}
+        def fire_job(self, j, event=None):
+            fired.append(event)
+    for body in [b"not json", b"[1]", b'{"event": []}', b'"x"']:
+        assistant._event_from_broker(A(), body)
+    assistant._event_from_broker(A(), b'{"event": "x"}')
+    assert fired == [{"event": "x"}]
+
+def test_job_triggers_round_trip():
+    j = job.Job("A", "path", triggers=["x.done"])
+    assert job.from_cfg(j.json()).triggers == ["x.done"]
+    assert job.from_cfg(_jobs_cfg["jobs"]["test_job"]).triggers == []
+
+###
+### remote
+###
+def _start_worker(tmp_path, port, *args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen([sys.executable, "-c",
+        "import sys; from assistant import assistant; "
+        "assistant.worker_main(sys.argv[1:])",
+        "--broker", f"127.0.0.1:{port}", *args], cwd=tmp_path,
+        env=dict(os.environ, PYTHONPATH=root), stdout=subprocess.DEVNULL)
+
+def test_workers_share_and_route_runs(broker, tmp_path):
+    path = tmp_path / "job.py"
+    path.write_text("import os, sys, time\n"
+                    "time.sleep(0.3)\n"
+                    "open(sys.argv[1], 'w').write(str(os.getppid()))\n"
+                    "sys.exit(len(sys.argv) - 2)")
+    done = []
+    d = remote.Dispatcher(on_done=done.append)
+    assert d._ready.wait(2)
+    procs = [_start_worker(tmp_path, broker.port, "--capacity", "1"),
+             _start_worker(tmp_path, broker.port, "--capacity", "1",
+                           "--labels", "gpu")]
+    try:
+        assert _wait_for(lambda: len(d.workers) == 2, timeout=10)
+        runs = [d.fire(job.Job(n, str(path), str(tmp_path / n)))
+                for n in "ABCD"]
+        runs.append(d.fire(job.Job("G", str(path), str(tmp_path / "G") + " x",
+                                   label="gpu")))
+        assert d.fire(job.Job("A", str(path))) is None  # still running
+        assert _wait_for(lambda: len(done) == 5, timeout=10)
+        assert [r.status for r in runs] == ["ok"] * 4 + ["failed"]
+        assert runs[-1].exit_code == 1
+        assert all(r.wall_time >= 0.3 for r in runs)
+        pids = {n: int((tmp_path / n).read_text()) for n in "ABCDG"}
+        assert set(pids.values()) == {p.pid for p in procs}
+        assert pids["G"] == procs[1].pid
+        assert (tmp_path / "logs" / "a.log").exists()
+    finally:
+        for p in procs:
+            p.kill()
+            p.wait()
+        d.shutdown()
+
+def test_dispatchers_get_own_results_and_expire(broker):
+    done = {1: [], 2: []}
+    d1, d2 = (remote.Dispatcher(result_timeout=60) for _ in range(2))
+    assert d1._ready.wait(2) and d2._ready.wait(2)
+    r1 = d1.fire(job.Job("A", "p"), done=done[1].append)
+    r2 = d2.fire(job.Job("A", "p"), done=done[2].append)
+    assert d1.fire(job.Job("A", "p")) is None
+    cmds = [json.loads(b) for b in broker.queues[api.PIKA_JOBS_QUEUE]]
+    assert [c["reply_to"] for c in cmds] == [d1.reply_to, d2.reply_to]
+    p = api.Publisher(queue=None)
+    for c in reversed(cmds):
+        run = dict(r1.json(), start_time=None, wall_time=1.0, exit_code=0)
+        p.publish(json.dumps({"type": "result", "id": c["id"],
+                              "worker": "w", "run": run}), c["reply_to"])
+    assert _wait_for(lambda: done == {1: [r1], 2: [r2]})
+    assert r1.status == "ok" and d1.active("A") == []
+    # A command nobody answers is given up and no longer blocks skip.
+    r = d1.fire(job.Job("B", "p", label="none"), done=done[1].append)
+    assert d1.fire(job.Job("B", "p")) is None
+    d1._expire(time.time() + 61)
+    assert done[1] == [r1, r] and d1.active("B") == []
+    p.close()
+    d1.shutdown()
+    d2.shutdown()
+
+def test_job_label_round_trip():
+    assert job.from_cfg(job.Job("A", "path", label="gpu").json()).label == "gpu"
+    assert job.from_cfg(_jobs_cfg["jobs"]["test_job"]).label == None
+
+###
+### delivery
+###
+def test_token_bucket():
+    b = ratelimit.TokenBucket(rate=10, capacity=2)
+    assert b.try_acquire() == 0
+    assert b.try_acquire() == 0
+    assert 0 < b.try_acquire() <= 0.1
+    b.pause(5)
+    assert b.try_acquire() > 4
+
+def test_delivery_keeps_order_and_retries_rate_limited():
+    sent = []
+    limited = {'a': 1}
+    def send(payload):
+        key, i = payload
+        if key in limited and limited[key]:
+            limited[key] -= 1
+            raise ratelimit.RateLimitedException(0.2)
+        sent.append(payload)
+    d = delivery.Delivery(send, workers=2)
+    futures = [d.submit(k, (k, i)) for i in range(3) for k in 'ab']
+    assert _wait_for(lambda: len(sent) == 3)
+    # Channel b is not blocked by rate limited channel a.
+    assert sent == [('b', 0), ('b', 1), ('b', 2)]
+    for f in futures:
+        f.result(timeout=2)
+    assert [p for p in sent if p[0] == 'a'] == [('a', 0), ('a', 1), ('a', 2)]
+    assert d.pending() == 0
+
+def test_delivery_reports_failure():
+    def send(payload):
+        raise ValueError(payload)
+    d = delivery.Delivery(send, workers=1)
+    with pytest.raises(ValueError):
+        d.submit('a', 1).result(timeout=2)
+    assert d.pending() == 0
+
+def test_coalescer_merges_messages_within_window():
+    submitted = []
+    def submit(key, payload):
+        submitted.append(payload)
+        f = concurrent.futures.Future()
+        f.set_result(None)
+        return f
+    c = delivery.Coalescer(submit, lambda name: 0.1, file_threshold=10)
+    futures = [c.add({'job_name': 'a', 'text': str(i)}) for i in range(3)]
+    futures.append(c.add({'job_name': 'b', 'text': 'long text here'}))
+    for f in futures:
+        f.result(timeout=2)
+    submitted.sort(key=lambda p: p['job_name'])
+    assert submitted == [
+        {'job_name': 'a', 'text': '0\n1\n2', 'count': 3},
+        {'job_name': 'b', 'text': 'long text here', 'count': 1,
+         'as_file': True}]
+
+def test_slack_send_as_file(slack):
+    session = messenger.SlackSession('t', 'U1', slack.base_url)
+    session.send({'job_name': 'job', 'text': 'a\nb', 'as_file': True})
+    assert slack.requests['files.completeUploadExternal'] == 1
+    assert slack.requests['chat.postMessage'] == 0
+
+def test_slack_429_raises_rate_limited(slack):
+    session = messenger.SlackSession('t', 'U1', slack.base_url)
+    slack.fail['chat.postMessage'] = (
+        429, {'Retry-After': '7'}, {'ok': False, 'error': 'ratelimited'})
+    with pytest.raises(ratelimit.RateLimitedException) as e:
+        session.send({'job_name': 'job', 'text': 'a'})
+    assert e.value.retry_after == 7
+    bucket = session.api._limiter.bucket('chat.postMessage', 'C0')
+    assert bucket.try_acquire() > 6
+
 ###
 ### settings
 ###
@@ -271,6 +1558,13 @@ def test_messenger_cfg():
     cfg = settings.messenger_cfg({'bla': 1})
     assert cfg == None
 
+def test_coalescing_window():
+    s = {'coalescing': {'window': 2, 'jobs': {'A': 5}}}
+    assert settings.coalescing_window(s, 'A') == 5
+    assert settings.coalescing_window(s, 'B') == 2
+    assert settings.coalescing_window(None, 'B') == 0
+    assert settings.coalescing_cfg(s)['file_threshold'] == 4000
+
 def test_create_settings_file():
     p = settings.create_settings_file(fname="_test_settings.json")
     assert os.path.exists(p)
@@ -279,6 +1573,52 @@ def test_create_settings_file():
     os.remove(p)
     assert content.get('messenger')
 
+def test_settings_cache_reloads_on_change(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    c = settings.SettingsCache(fname="s.json", check_interval=0)
+    assert c.get() == None
+    assert c.version == 1
+    with open("s.json", "wt") as f:
+        json.dump({"messenger": {"name": "slack"}}, f)
+    assert c.get()["messenger"]["name"] == "slack"
+    assert c.version == 2
+    c.get()
+    assert c.version == 2
+    with open("s.json", "wt") as f:
+        json.dump({"messenger": {"name": "other"}}, f)
+    os.utime("s.json", ns=(0, 1))
+    assert c.get()["messenger"]["name"] == "other"
+    assert c.version == 3
+
+def test_settings_cache_first_load_is_not_skipped(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with open("s.json", "wt") as f:
+        json.dump({"messenger": {"name": "slack"}}, f)
+    c = settings.SettingsCache(fname="s.json", check_interval=60)
+    from_file = settings.from_file
+    def slow_from_file(fname):
+        time.sleep(0.2)
+        return from_file(fname)
+    monkeypatch.setattr(settings, "from_file", slow_from_file)
+    got = []
+    threads = [threading.Thread(target=lambda: got.append(c.get()))
+               for _ in range(4)]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join()
+    assert got == [{"messenger": {"name": "slack"}}] * 4
+
+def test_settings_cache_check_interval(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    c = settings.SettingsCache(fname="s.json", check_interval=60)
+    assert c.get() == None
+    with open("s.json", "wt") as f:
+        json.dump({}, f)
+    assert c.get() == None
+    assert c.version == 1
+
 ###
 ### command
 ###